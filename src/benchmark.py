@@ -0,0 +1,259 @@
+"""
+Benchmarks of the building blocks of the protocol and of end-to-end PSI
+runs over a grid of set sizes and overlap ratios, written as JSON so that
+the results of different commits can be compared:
+
+    python benchmark.py micro -o output/micro.json
+    python benchmark.py psi --sizes 10,50 --overlaps 0,0.5,1 -B 100 -g aes
+
+Micro-benchmarks record the time of each operation; PSI runs record the
+time, messages and bytes exchanged and the peak memory of each party.
+"""
+import json
+import os
+import platform
+import random
+import resource
+import statistics
+import subprocess
+import threading
+import time
+from multiprocessing import Process, Queue
+
+import hashing
+import ot
+import psi
+import util
+import yao
+
+BENCH_PORT = util.LOCAL_PORT + 100  # keeps benchmarks apart from running parties
+CIRCUIT = "circuits/eq32.json"
+psi.tqdm = psi._id  # no progress bars
+
+
+def bench(name, func, repeat, ops=1, **params):
+    """Time 'repeat' calls of func, each running 'ops' operations, after a warm-up call."""
+    func()  # fill the caches, e.g. compiled circuits and AES key schedules
+    times = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        func()
+        times.append((time.perf_counter() - start) / ops)
+    return {
+        "name": name,
+        **params,
+        "repeat": repeat,
+        "ops": ops,
+        "min": min(times),
+        "median": statistics.median(times),
+        "mean": statistics.mean(times),
+    }
+
+
+def bench_garbling(repeat, batch_size):
+    compiled = yao.load_circuit(CIRCUIT)
+    results = []
+    for backend in yao.BACKENDS:
+        results.append(bench("GarbledCircuit", lambda: yao.GarbledCircuit(compiled, backend=backend),
+                             repeat, backend=backend))
+        if issubclass(yao.BACKENDS[backend], yao.AESBackend):
+            results.append(bench("GarbledCircuitBatch",
+                                 lambda: yao.GarbledCircuitBatch(compiled, batch_size, backend),
+                                 repeat, ops=batch_size, backend=backend))
+    return results
+
+
+def bench_evaluation(repeat):
+    compiled = yao.load_circuit(CIRCUIT)
+    circuit = compiled.circuit
+    x = util.float_to_bit_list(1.5)
+    results = []
+    for backend in yao.BACKENDS:
+        garbled = yao.GarbledCircuit(compiled, backend=backend)
+        keys, pbits = garbled.get_keys(), garbled.get_pbits()
+        # equal values, so that every gate is evaluated with the same inputs
+        inputs = {w: (keys[w][b], pbits[w] ^ b)
+                  for w, b in zip(circuit["alice"] + circuit["bob"], x + x)}
+        a_inputs = {w: inputs[w] for w in circuit["alice"]}
+        b_inputs = {w: inputs[w] for w in circuit["bob"]}
+        pbits_out = {w: pbits[w] for w in circuit["out"]}
+        tables = garbled.get_garbled_tables()
+        results.append(bench("evaluate", lambda: yao.evaluate(compiled, tables, pbits_out,
+                                                              a_inputs, b_inputs, backend),
+                             repeat, backend=backend))
+    return results
+
+
+def bench_ot(repeat, group):
+    """Time the OT of a pair of keys, Bob's side running in a thread of the same process."""
+    logger = util.Logger("bench", "quiet")  # prints nothing
+    # in-memory channel, and a pipelined socket: OTs end with a message from
+    # Alice, which a REQ socket can't follow with the next one
+    bob_socket = util.EvaluatorSocket(util.MEMORY_SCHEME + "bench-ot")
+    alice_socket = util.GarblerSocket(util.MEMORY_SCHEME + "bench-ot", pipelined=True)
+    G = util.load_group(group) if group else None
+    alice = ot.ObliviousTransfer(alice_socket, logger, group=G)
+    bob = ot.ObliviousTransfer(bob_socket, logger, group=G)
+    msgs = (os.urandom(17), os.urandom(17))
+
+    evaluator = threading.Thread(target=lambda: [bob.ot_evaluator(1) for _ in range(repeat + 1)])
+    evaluator.start()
+    result = bench("ot", lambda: alice.ot_garbler(msgs), repeat,
+                   group=group or f"random{util.PRIME_BITS}")
+    evaluator.join()
+    # traffic per OT
+    result["messages"] = alice_socket.messages / (repeat + 1)
+    result["bytes"] = alice_socket.bytes / (repeat + 1)
+    alice_socket.close()
+    bob_socket.close()
+    return result
+
+
+def bench_conversion(repeat, count=1000):
+    rand = random.Random(0)
+    xs = [rand.uniform(-1e6, 1e6) for _ in range(count)]
+    return [
+        bench("float_to_bit_list", lambda: [util.float_to_bit_list(x) for x in xs],
+              repeat, ops=count),
+        bench("floats_to_bit_list", lambda: util.floats_to_bit_list(xs), repeat, ops=count),
+    ]
+
+
+def micro(repeat=20, batch_size=100):
+    """Run the micro-benchmarks and return their results."""
+    results = []
+    results += bench_garbling(repeat, batch_size)
+    results += bench_evaluation(repeat)
+    results.append(bench("PrimeGroup", util.PrimeGroup, repeat))
+    results.append(bench_ot(repeat, None))
+    results.append(bench_ot(repeat, "modp2048"))
+    results += bench_conversion(repeat)
+    return results
+
+
+def make_sets(n, m, overlap, seed=0):
+    """
+    Return random sets of n and m values, overlap * min(n, m) of them being
+    common, exactly representable as 32-bit floats.
+    """
+    common = round(overlap * min(n, m))
+    vals = [x + 0.5 for x in random.Random(seed).sample(range(1 << 22), n + m - common)]
+    return vals[:n], vals[n - common:n + m - common]
+
+
+def _party(party, vals, options, results):
+    logger = util.Logger(party, "quiet")  # prints nothing
+    start = time.perf_counter()
+    if party == "alice":
+        runner = psi.Alice(vals, logger, endpoint=util.garbler_endpoint(port=BENCH_PORT), **options)
+        try:
+            runner.setup()
+            matched = runner.run()
+        finally:
+            runner.close()
+    else:
+        runner = psi.Bob(vals, logger, endpoint=util.evaluator_endpoint(port=BENCH_PORT))
+        matched = runner.listen()
+    results.put((party, {
+        "time": time.perf_counter() - start,
+        "messages": runner.socket.messages,
+        "bytes": runner.socket.bytes,
+        "peak_memory": resource.getrusage(resource.RUSAGE_SELF).ru_maxrss,  # KiB
+        "matched": sorted(matched),
+    }))
+
+
+def run_psi(n, m, overlap, options, seed=0):
+    """Run PSI between two processes on sets of sizes n and m, and return its measures."""
+    vals_a, vals_b = make_sets(n, m, overlap, seed)
+    results = Queue()
+    processes = [Process(target=_party, args=("bob", vals_b, options, results)),
+                 Process(target=_party, args=("alice", vals_a, options, results))]
+    for process in processes:
+        process.start()
+    stats = dict(results.get() for _ in processes)
+    for process in processes:
+        process.join()
+    alice, bob = stats["alice"], stats["bob"]
+    return {
+        "n": n,
+        "m": m,
+        "overlap": overlap,
+        **options,
+        "time": alice["time"],
+        # Alice's socket sees every message of the session
+        "messages": alice["messages"],
+        "bytes": alice["bytes"],
+        "peak_memory": {"alice": alice["peak_memory"], "bob": bob["peak_memory"]},
+        "correct": alice["matched"] == sorted(set(vals_a) & set(vals_b)) == bob["matched"],
+    }
+
+
+def psi_grid(sizes, overlaps, options, repeat=1):
+    """Run PSI for each pair of set sizes and overlap ratio of the grid."""
+    return [run_psi(n, m, overlap, options, seed)
+            for n in sizes for m in sizes for overlap in overlaps for seed in range(repeat)]
+
+
+def _commit():
+    """Return the commit of the working tree, None outside of a git repository."""
+    try:
+        return subprocess.run(["git", "rev-parse", "HEAD"], capture_output=True, text=True,
+                              check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+if __name__ == '__main__':
+    import argparse
+
+    parser = argparse.ArgumentParser(
+        description="Benchmark the garbling, evaluation and OTs, and end-to-end PSI runs.",
+        formatter_class=argparse.RawTextHelpFormatter
+    )
+    parser.add_argument("suite", choices=["micro", "psi", "all"], nargs="?", default="all",
+                        help="the benchmarks to run (default: all)")
+    parser.add_argument("-o", dest="output", default=None,
+                        help="the JSON file to write the results to (default: stdout)")
+    parser.add_argument("-r", "--repeat", type=int, default=None,
+                        help="the number of runs of each micro-benchmark (default: 20),\n" +
+                             "or of each PSI of the grid, with different sets (default: 1)")
+    parser.add_argument("--sizes", type=lambda s: [int(x) for x in s.split(",")],
+                        default=[10, 50], help="the set sizes of the grid (default: 10,50)")
+    parser.add_argument("--overlaps", type=lambda s: [float(x) for x in s.split(",")],
+                        default=[0, 0.5, 1],
+                        help="the ratios of common values of the grid (default: 0,0.5,1)")
+    parser.add_argument("-B", "--batch-size", dest="batch_size", type=int, default=None)
+    parser.add_argument("-g", "--garbling", dest="backend", choices=list(yao.BACKENDS),
+                        default="fernet")
+    parser.add_argument("--group", choices=list(util.STANDARD_GROUPS), default=None)
+    parser.add_argument("--ot", dest="ot_mode", choices=ot.OT_MODES, default="base")
+    parser.add_argument("--bucketed", action="store_true")
+    parser.add_argument("--all-pairs", dest="all_pairs", type=int, default=None)
+    parser.add_argument("--window", type=int, default=None)
+    parser.add_argument("--hash", dest="hash_fpr", type=float, nargs="?",
+                        const=hashing.HASH_FPR, default=None)
+    parser.add_argument("--pool", dest="pool_size", type=int, default=None)
+    args = parser.parse_args()
+
+    report = {
+        "commit": _commit(),
+        "date": time.strftime("%Y-%m-%dT%H:%M:%S%z"),
+        "python": platform.python_version(),
+        "machine": platform.platform(),
+        "cpus": os.cpu_count(),
+    }
+    if args.suite in ("micro", "all"):
+        report["micro"] = micro(args.repeat or 20, args.batch_size or 100)
+    if args.suite in ("psi", "all"):
+        options = {"batch_size": args.batch_size, "backend": args.backend, "group": args.group,
+                   "ot_mode": args.ot_mode, "bucketed": args.bucketed,
+                   "all_pairs": args.all_pairs, "window": args.window,
+                   "hash_fpr": args.hash_fpr, "pool_size": args.pool_size}
+        report["psi"] = psi_grid(args.sizes, args.overlaps, options, args.repeat or 1)
+
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump(report, f, indent=2)
+    else:
+        print(json.dumps(report, indent=2))
@@ -0,0 +1,93 @@
+"""
+Loader of circuits in the Bristol Fashion format, turned into the JSON
+format of circuits/eq32.json.
+
+A Bristol Fashion file starts with the number of gates and wires, then
+the number of input values followed by their sizes in bits, then the
+number of output values followed by their sizes, and one gate per line:
+
+    <#inputs> <#outputs> <input wires> <output wires> <type>
+
+Input wires come first, output wires last, wires being numbered from 0.
+"""
+
+# Bristol gate types mapped to the gate types of our circuits
+GATE_TYPES = {"XOR": "XOR", "AND": "AND", "OR": "OR", "INV": "NOT", "NOT": "NOT"}
+
+
+def parse_bristol(path, alice_values=1, circuit_id=None):
+    """Parse a circuit in the Bristol Fashion format.
+
+    Wire IDs are shifted by one, to start from 1 as in our circuits. EQW
+    gates (wire copies) are removed by renaming their output wire, EQ
+    gates (constants) are computed from the first input wire w as
+    AND(w, NOT w) and its negation, so that their keys are as random as
+    those of any other wire, and MAND gates are split into AND gates.
+
+    Args:
+        path: The path of the file.
+        alice_values: Optional; the number of input values given by Alice,
+            the following ones being given by Bob.
+        circuit_id: Optional; the ID of the circuit, the name of the file
+            by default.
+
+    Returns:
+        A dict containing circuit spec.
+    """
+    with open(path) as f:
+        lines = [line.split() for line in f if line.strip()]
+
+    num_gates, num_wires = int(lines[0][0]), int(lines[0][1])
+    input_sizes = [int(n) for n in lines[1][1:1 + int(lines[1][0])]]
+    output_sizes = [int(n) for n in lines[2][1:1 + int(lines[2][0])]]
+    if len(lines) - 3 != num_gates:
+        raise RuntimeError(f"Expected {num_gates} gates in {path}, found {len(lines) - 3}")
+
+    alias = {}  # wire renamed by EQW gates
+    wire = lambda w: alias.get(int(w), int(w) + 1)
+    gates = []
+    next_id = num_wires + 1  # IDs of the wires added for constants
+    constants = {}  # wire computing each constant bit
+
+    def constant(bit):
+        nonlocal next_id
+        if not constants:
+            if not sum(input_sizes):
+                raise RuntimeError(f"{path} has constants but no input wire to compute them from")
+            # w XOR w would give the constant 0 an all-zero key with free-XOR
+            negation, constants[0], constants[1] = next_id, next_id + 1, next_id + 2
+            gates.append({"id": negation, "type": "NOT", "in": [1]})
+            gates.append({"id": constants[0], "type": "AND", "in": [1, negation]})
+            gates.append({"id": constants[1], "type": "NOT", "in": [constants[0]]})
+            next_id += 3
+        return constants[bit]
+
+    for line in lines[3:]:
+        num_in, num_out = int(line[0]), int(line[1])
+        ins = line[2:2 + num_in]
+        outs = line[2 + num_in:2 + num_in + num_out]
+        type = line[-1]
+        if type == "EQW":
+            alias[int(outs[0])] = wire(ins[0])
+        elif type == "EQ":
+            alias[int(outs[0])] = constant(int(ins[0]))
+        elif type == "MAND":
+            half = num_in // 2
+            for a, b, out in zip(ins[:half], ins[half:], outs):
+                gates.append({"id": wire(out), "type": "AND", "in": [wire(a), wire(b)]})
+        elif type in GATE_TYPES:
+            gates.append({"id": wire(outs[0]), "type": GATE_TYPES[type],
+                          "in": [wire(w) for w in ins]})
+        else:
+            raise RuntimeError(f"Unsupported gate type {type} in {path}")
+
+    num_alice = sum(input_sizes[:alice_values])
+    num_inputs = sum(input_sizes)
+    num_outputs = sum(output_sizes)
+    return {
+        "id": circuit_id or path.rsplit("/", 1)[-1].split(".")[0],
+        "alice": [w + 1 for w in range(num_alice)],
+        "bob": [w + 1 for w in range(num_alice, num_inputs)],
+        "out": [wire(w) for w in range(num_wires - num_outputs, num_wires)],
+        "gates": gates,
+    }
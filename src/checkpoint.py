@@ -0,0 +1,97 @@
+"""
+Checkpoints of PSI sessions, so that a session interrupted by the crash of
+either party resumes from its last completed batch instead of starting over.
+
+Each party appends a record to the journal of the session, a JSON lines
+file of the output folder, whenever it completes a batch (or a single
+comparison): its sequence number and what it changed, e.g. the values
+found in the intersection. Journals are flushed every INTERVAL seconds, so
+a crash may lose the last records of either party: a restarted session
+resumes from the last batch recorded by both, each party replaying its
+journal up to it.
+"""
+import json
+import os
+import re
+import time
+
+DIRECTORY = "output"
+INTERVAL = 5  # seconds between flushes of a journal
+SESSION_ID = re.compile(r"[\w.-]+")  # session IDs are part of file names
+
+
+def journal_path(session, party):
+    """Return the path of the journal of a party in a session."""
+    if not SESSION_ID.fullmatch(session):
+        raise RuntimeError(f"Invalid session ID {session}: use letters, digits, '.', '-' and '_'")
+    return os.path.join(DIRECTORY, f"session_{session}.{party}.jsonl")
+
+
+class Journal:
+    """
+    The journal of a party in a session: a header line holding the
+    parameters of the session, then a record per completed batch.
+
+    Attributes:
+        path     the path of the journal
+        header   the parameters of the session, None for a new session
+        records  the records of the journal, read before the session starts
+        seq      the sequence number of the last record
+    """
+    def __init__(self, path):
+        self.path = path
+        self.header = None
+        self.records = []
+        self.file = None
+        if os.path.exists(path):
+            with open(path) as f:
+                for line in f:
+                    try:
+                        entry = json.loads(line)
+                    except ValueError:  # the last line was cut by a crash
+                        break
+                    if self.header is None:
+                        self.header = entry
+                    else:
+                        self.records.append(entry)
+        self.seq = self.records[-1]["seq"] if self.records else 0
+
+    def start(self, header, seq=None):
+        """
+        Check the parameters of a resumed session, drop the records after
+        seq and open the journal to append the next ones.
+
+        Returns:
+            The records kept, to be replayed.
+        """
+        header = json.loads(json.dumps(header))  # as read back from the journal
+        if self.header is not None and self.header != header:
+            raise RuntimeError(f"The session of {self.path} was started with other parameters "
+                               f"({self.header}), start a new session")
+        self.header = header
+        if seq is not None:
+            self.records = [r for r in self.records if r["seq"] <= seq]
+            self.seq = self.records[-1]["seq"] if self.records else 0
+        # rewrite the journal without the dropped records, then append to it
+        tmp = self.path + ".tmp"
+        with open(tmp, "w") as f:
+            for entry in [self.header] + self.records:
+                f.write(json.dumps(entry) + "\n")
+        os.replace(tmp, self.path)
+        self.file = open(self.path, "a")
+        self.flushed = time.monotonic()
+        records, self.records = self.records, []
+        return records
+
+    def record(self, **entry):
+        """Append the record of the next batch, flushing the journal if it is time to."""
+        self.seq += 1
+        self.file.write(json.dumps({"seq": self.seq, **entry}) + "\n")
+        if time.monotonic() - self.flushed >= INTERVAL:
+            self.file.flush()
+            self.flushed = time.monotonic()
+
+    def close(self):
+        if self.file is not None:
+            self.file.close()
+            self.file = None
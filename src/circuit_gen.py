@@ -0,0 +1,112 @@
+"""
+Generator of equality circuits in the JSON format of circuits/eq32.json.
+
+Each party's input wires appear once and feed all the comparators that
+use them, so that a single circuit compares many values with only one
+key (and one OT) per input bit.
+"""
+import json
+
+BITS = 32  # bits per value, the size of "IEEE 754 binary32" floats
+
+
+class CircuitBuilder:
+    """
+    Allocate wire IDs and collect the gates of a circuit, input wires
+    first so that they come before every gate.
+    """
+    def __init__(self):
+        self.next_id = 1
+        self.gates = []
+
+    def wires(self, n):
+        """Return the IDs of n new input wires."""
+        ids = list(range(self.next_id, self.next_id + n))
+        self.next_id += n
+        return ids
+
+    def gate(self, type, *inputs):
+        """Add a gate and return the ID of its output wire."""
+        id = self.next_id
+        self.next_id += 1
+        self.gates.append({"id": id, "type": type, "in": list(inputs)})
+        return id
+
+    def tree(self, type, wires):
+        """Combine the wires with a balanced tree of 2-input gates of the given type."""
+        while len(wires) > 1:
+            pairs = [self.gate(type, a, b) for a, b in zip(wires[::2], wires[1::2])]
+            wires = pairs + wires[len(pairs) * 2:]
+        return wires[0]
+
+    def eq(self, a, b):
+        """Return the wire set to 1 iff the bits of the wires a and b are equal."""
+        diff = [self.gate("XOR", x, y) for x, y in zip(a, b)]
+        # NOR of each pair of differences (free-XOR friendly, as in eq32.json)
+        same = [self.gate("NOR", x, y) for x, y in zip(diff[::2], diff[1::2])]
+        if len(diff) % 2:
+            same.append(self.gate("NOT", diff[-1]))
+        return self.tree("AND", same)
+
+    def circuit(self, id, alice, bob, out):
+        return {"id": id, "alice": alice, "bob": bob, "out": out, "gates": self.gates}
+
+
+def eq_circuit(bits=BITS):
+    """Return the circuit testing whether Alice's value equals Bob's one."""
+    builder = CircuitBuilder()
+    alice, bob = builder.wires(bits), builder.wires(bits)
+    return builder.circuit(f"eq{bits}", alice, bob, [builder.eq(alice, bob)])
+
+
+def membership_circuit(k, bits=BITS):
+    """Return the circuit testing whether Alice's value is one of Bob's k values."""
+    builder = CircuitBuilder()
+    alice, bob = builder.wires(bits), builder.wires(k * bits)
+    eqs = [builder.eq(alice, bob[j * bits:(j + 1) * bits]) for j in range(k)]
+    return builder.circuit(f"member{k}x{bits}", alice, bob, [builder.tree("OR", eqs)])
+
+
+def all_pairs_circuit(k, l, bits=BITS):
+    """
+    Return the circuit testing the equality of each of Alice's k values with
+    each of Bob's l values, whose output wires are ordered row by row: the
+    output i*l + j is set to 1 iff Alice's value i equals Bob's value j.
+    """
+    builder = CircuitBuilder()
+    alice, bob = builder.wires(k * bits), builder.wires(l * bits)
+    out = [builder.eq(alice[i * bits:(i + 1) * bits], bob[j * bits:(j + 1) * bits])
+           for i in range(k) for j in range(l)]
+    return builder.circuit(f"eq{k}x{l}x{bits}", alice, bob, out)
+
+
+def write_circuit(circuit, path):
+    """Write a circuit to a JSON file readable with util.parse_json."""
+    with open(path, "w") as f:
+        json.dump({"name": circuit["id"], "circuits": [circuit]}, f)
+
+
+if __name__ == '__main__':
+    import argparse
+
+    parser = argparse.ArgumentParser(description="Generate equality circuits in JSON format.")
+    parser.add_argument("kind",
+        choices=["eq", "membership", "all-pairs"],
+        help="eq: x = y\n" +
+             "membership: x in {y_1..y_k}\n" +
+             "all-pairs: x_i = y_j for each i <= k, j <= l"
+    )
+    parser.add_argument("sizes", type=int, nargs="*",
+                        help="k for membership, k and l for all-pairs")
+    parser.add_argument("-b", "--bits", type=int, default=BITS,
+                        help=f"the number of bits per value (default: {BITS})")
+    parser.add_argument("-o", dest="output", required=True, help="the output file")
+    args = parser.parse_args()
+
+    if args.kind == "eq":
+        circuit = eq_circuit(args.bits)
+    elif args.kind == "membership":
+        circuit = membership_circuit(*args.sizes, bits=args.bits)
+    else:
+        circuit = all_pairs_circuit(*args.sizes, bits=args.bits)
+    write_circuit(circuit, args.output)
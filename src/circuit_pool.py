@@ -0,0 +1,193 @@
+"""
+Pool of pre-garbled circuits, filled by a background thread so that
+garbling leaves the critical path: the online phase only picks the keys
+of Alice's inputs and sends the circuits.
+
+Copies of a circuit are garbled in chunks with GarbledCircuitBatch and
+stored as fixed-size records holding what the online phase needs: the
+garbled tables, the p-bits of the outputs, the keys for bit 0 of the input
+wires and the free-XOR offset. The pool holds at most 'capacity' records,
+as many as fit in 'memory' bytes being kept in memory and the others
+spilled to a memory-mapped file.
+
+Garbled circuits are single-use: taken records are evicted from the pool
+and their slots overwritten with zeros, so that no copy of their keys is
+left in memory or in the spill file once they are sent. Copies made by
+NumPy along the way are beyond reach, so this is a best effort.
+"""
+import os
+import threading
+
+import numpy as np
+
+import instrumentation
+import yao
+
+CHUNK = 64  # copies garbled at once by the background thread
+MEMORY = 64 << 20  # default bytes of records kept in memory
+
+
+def record_dtype(circuit, backend):
+    """Return the NumPy dtype of the records of a compiled circuit."""
+    backend = yao.get_backend(backend)
+    n = backend.KEY_SIZE
+    _, table_size = yao.table_layout(circuit, backend)
+    return np.dtype([
+        ("tables", np.uint8, (table_size, )),
+        ("pbits_out", np.uint8, (len(circuit.out), )),
+        ("keys", np.uint8, (len(circuit.alice) + len(circuit.bob), n)),  # Alice's wires, then Bob's
+        ("R", np.uint8, (n, )),
+    ])
+
+
+def records(garbled_batch):
+    """Return the records of the copies of a GarbledCircuitBatch."""
+    circuit = garbled_batch.circuit
+    out = np.empty(garbled_batch.size, record_dtype(circuit, garbled_batch.backend))
+    out["tables"] = garbled_batch.garbled_tables
+    out["pbits_out"] = garbled_batch.pbits[:, circuit.out]
+    out["keys"] = garbled_batch.keys[:, circuit.alice + circuit.bob]
+    out["R"] = garbled_batch.R
+    return out
+
+
+class GarbledCircuitPool:
+    """
+    A pool of garbled copies of a circuit, filled in the background.
+
+    Records are stored in a ring of 'capacity' slots of raw bytes, the
+    first ones in memory and the others in the spill file.
+
+    Args:
+        circuit: A CompiledCircuit, or a dict containing circuit spec.
+        backend: The name of the garbling backend, one with fixed-size keys.
+        capacity: The maximum number of garbled circuits in the pool.
+        memory: Optional; the maximum number of bytes of records kept in memory.
+        spill_path: Optional; the file the records beyond the memory cap are
+            spilled to, None to cap the pool to the records fitting in memory.
+        metrics: Optional; the instrumentation.Metrics recording the garbling.
+    """
+    def __init__(self, circuit, backend, capacity, memory=MEMORY, spill_path=None, metrics=None):
+        self.circuit = yao.compile_circuit(circuit)
+        self.backend = backend
+        self.dtype = record_dtype(self.circuit, backend)
+        self.metrics = metrics or instrumentation.NO_METRICS
+        size = self.dtype.itemsize
+        memory_slots = min(capacity, max(memory // size, 1))
+        spill_slots = capacity - memory_slots if spill_path else 0
+        self.capacity = memory_slots + spill_slots
+        self.memory = np.zeros((memory_slots, size), np.uint8)
+        self.spill_path = spill_path if spill_slots else None
+        self.spill = None
+        if self.spill_path:
+            # only the owner may read the keys of the spilled records
+            fd = os.open(self.spill_path, os.O_RDWR | os.O_CREAT | os.O_TRUNC, 0o600)
+            os.ftruncate(fd, spill_slots * size)
+            os.close(fd)
+            self.spill = np.memmap(self.spill_path, np.uint8, "r+", shape=(spill_slots, size))
+
+        self.head = 0  # slot of the oldest record
+        self.count = 0  # number of records in the pool
+        self.garbled = 0  # number of records garbled so far
+        self.total = None  # number of records needed, None until known
+        self.closed = False
+        self.error = None  # exception raised by the background thread
+        self.cond = threading.Condition()
+        self.thread = threading.Thread(target=self._fill, daemon=True)
+        self.thread.start()
+
+    def limit(self, total):
+        """Stop garbling once 'total' records were garbled, e.g. when the number of comparisons is known."""
+        with self.cond:
+            self.total = total
+            self.cond.notify_all()
+
+    def _chunk(self):
+        """Return the number of records to garble next, 0 if the pool is full or done."""
+        n = min(CHUNK, self.capacity - self.count)
+        if self.total is not None:
+            n = min(n, self.total - self.garbled)
+        return max(n, 0)
+
+    def _fill(self):
+        try:
+            while True:
+                with self.cond:
+                    while not self.closed and self._chunk() == 0:
+                        self.cond.wait()
+                    if self.closed:
+                        return
+                    n = self._chunk()
+                    self.garbled += n
+                garbled_batch = yao.GarbledCircuitBatch(self.circuit, n, self.backend,
+                                                        metrics=self.metrics)
+                data = records(garbled_batch)
+                garbled_batch.keys[:] = 0
+                garbled_batch.R[:] = 0
+                with self.cond:
+                    if self.closed:
+                        return
+                    self._write((self.head + self.count) % self.capacity,
+                                data.view(np.uint8).reshape(n, -1))
+                    self.count += n
+                    self.cond.notify_all()
+                data.view(np.uint8)[:] = 0
+        except Exception as e:
+            with self.cond:
+                self.error = e
+                self.cond.notify_all()
+
+    def _slots(self, start, n):
+        """Yield the storage arrays and ranges of the n slots from the given one."""
+        while n:
+            if start < len(self.memory):
+                storage, lo, hi = self.memory, start, min(start + n, len(self.memory))
+            else:
+                storage, lo = self.spill, start - len(self.memory)
+                hi = min(lo + n, len(self.spill))
+            yield storage, lo, hi
+            n -= hi - lo
+            start = (start + hi - lo) % self.capacity
+
+    def _write(self, start, data):
+        k = 0
+        for storage, lo, hi in self._slots(start, len(data)):
+            storage[lo:hi] = data[k:k + hi - lo]
+            k += hi - lo
+
+    def take(self, n):
+        """
+        Return the records of n garbled circuits, waiting for them to be
+        garbled if needed, and evict them from the pool.
+        """
+        out = np.empty((n, self.dtype.itemsize), np.uint8)
+        k = 0
+        while k < n:
+            with self.cond:
+                while self.count == 0 and self.error is None:
+                    self.cond.wait()
+                if self.error is not None:
+                    raise RuntimeError("Could not fill the garbled circuit pool") from self.error
+                taken = min(n - k, self.count)
+                for storage, lo, hi in self._slots(self.head, taken):
+                    out[k:k + hi - lo] = storage[lo:hi]
+                    storage[lo:hi] = 0  # single use: wipe the slot
+                    k += hi - lo
+                self.head = (self.head + taken) % self.capacity
+                self.count -= taken
+                self.cond.notify_all()
+        self.metrics.count("pooled_circuits", n)
+        return out.view(self.dtype).reshape(n)
+
+    def close(self):
+        """Stop the background thread, then wipe the pool and delete the spill file."""
+        with self.cond:
+            self.closed = True
+            self.cond.notify_all()
+        self.thread.join()
+        self.memory[:] = 0
+        if self.spill is not None:
+            self.spill[:] = 0
+            self.spill.flush()
+            self.spill = None
+            os.remove(self.spill_path)
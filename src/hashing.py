@@ -0,0 +1,185 @@
+import hashlib
+import math
+import numpy as np
+import os
+import random
+import struct
+
+# CUCKOO HASHING
+NUM_HASHES = 3  # number of hash functions, i.e. of candidate bins per value
+BIN_FACTOR = 1.27  # number of bins per Bob's value
+STAT_PARAM = 40  # bins overflow with probability at most 2^-STAT_PARAM
+MAX_EVICTIONS = 500  # evictions before giving up on a cuckoo insertion
+MAX_SEEDS = 100  # seeds tried before giving up on building a cuckoo table
+DUMMY_TAGS = {"alice": 0, "bob": 1}  # last bit of the dummy values of each party
+
+# HASHED ELEMENTS
+HASH_FPR = 2 ** -20  # default probability that any two different elements match
+MAX_HASH_WIDTH = 128  # bits of the digests the elements are hashed to
+
+
+def num_bins(m):
+    """Return the number of bins used for a Bob's set of size m."""
+    return max(math.ceil(BIN_FACTOR * m), 2)
+
+
+def bin_size(n, bins):
+    """
+    Return the size to which Alice's bins are padded, the smallest one that
+    all NUM_HASHES * n insertions fit in with probability 1 - 2^-STAT_PARAM.
+    """
+    k = NUM_HASHES * n
+    if k == 0:
+        return 0
+    # load of a bin: binomial distribution of parameters (k, 1/bins)
+    p = 1 / bins
+    pmf = []
+    while len(pmf) <= k and (len(pmf) <= k * p or pmf[-1] > 1e-30):
+        j = len(pmf)
+        pmf.append(math.exp(math.lgamma(k + 1) - math.lgamma(j + 1) - math.lgamma(k - j + 1)
+                            + j * math.log(p) + (k - j) * math.log1p(-p)))
+    # smallest size whose tail P[load > size] is small enough, summing from the end
+    size, tail = len(pmf) - 1, 0.0
+    while size > 0 and bins * (tail + pmf[size]) < 2 ** -STAT_PARAM:
+        tail += pmf[size]
+        size -= 1
+    return min(size, n)  # a value is stored at most once per bin
+
+
+def to_bytes(x: float):
+    """Return the big-endian "IEEE 754 binary32" representation of x."""
+    return struct.pack('>f', x)
+
+
+def candidate_bins(x: float, seed: bytes, bins):
+    """Return the NUM_HASHES bins that the value x can be stored in."""
+    x = to_bytes(x)
+    return [
+        int.from_bytes(hashlib.blake2b(x, digest_size=8, key=seed,
+                                       salt=k.to_bytes(16, "big")).digest(), "big") % bins
+        for k in range(NUM_HASHES)
+    ]
+
+
+def cuckoo_table(vals, seed, bins):
+    """
+    Store each value in one of its candidate bins, evicting the values
+    already stored there if needed.
+
+    Returns:
+        A list mapping each bin to the value stored in it, or to None,
+        or None if the values do not fit in the bins with this seed.
+    """
+    table = [None] * bins
+    rand = random.Random(seed)
+    for x in vals:
+        for _ in range(MAX_EVICTIONS):
+            candidates = candidate_bins(x, seed, bins)
+            free = [b for b in candidates if table[b] is None]
+            if free:
+                table[free[0]] = x
+                break
+            b = rand.choice(candidates)
+            table[b], x = x, table[b]
+        else:
+            return None
+    return table
+
+
+def build_cuckoo_table(vals, seed=None):
+    """
+    Build the cuckoo table of Bob's values, trying fresh seeds until they
+    fit, or with the given seed, e.g. the one of a resumed session.
+
+    Returns:
+        A pair (seed, table).
+    """
+    bins = num_bins(len(vals))
+    for _ in range(MAX_SEEDS):
+        seed = seed or os.urandom(16)
+        table = cuckoo_table(vals, seed, bins)
+        if table is not None:
+            return seed, table
+        seed = None
+    raise RuntimeError(f"Could not fit {len(vals)} values in {bins} bins")
+
+
+def simple_table(vals, seed, bins):
+    """Return a list mapping each bin to the list of values having it among their candidate bins."""
+    table = [[] for _ in range(bins)]
+    for x in vals:
+        for b in set(candidate_bins(x, seed, bins)):
+            table[b].append(x)
+    return table
+
+
+def dummy(b, seed, bins, tag):
+    """
+    Return a random (finite) value that cannot be stored in bin b, so that
+    it differs from every value the other party may have stored there.
+    The last bit of its binary32 representation is the given tag, one per
+    party (DUMMY_TAGS), so that the dummies of the two parties differ too.
+    """
+    while True:
+        bits = int.from_bytes(os.urandom(4), "big") & ~1 | tag
+        if (bits >> 23) & 0xff == 0xff:  # infinity or NaN
+            continue
+        x = struct.unpack('>f', bits.to_bytes(4, "big"))[0]
+        if b not in candidate_bins(x, seed, bins):
+            return x
+
+
+def element_bytes(x):
+    """
+    Return the canonical encoding of an element, hashed to compare it:
+    integral floats are encoded as the equal ints, so that 3 and 3.0 match.
+    """
+    if isinstance(x, (float, np.floating)) and float(x).is_integer():
+        x = int(x)
+    if isinstance(x, (int, np.integer)):
+        x = int(x)
+        return b"i" + x.to_bytes((x.bit_length() + 8) // 8, "big", signed=True)
+    if isinstance(x, (float, np.floating)):
+        return b"f" + struct.pack(">d", x)
+    if isinstance(x, str):
+        return b"s" + x.encode()
+    if isinstance(x, bytes):
+        return b"b" + x
+    raise RuntimeError(f"Cannot hash an element of type {type(x).__name__}")
+
+
+def element_set(vals):
+    """
+    Return the array (of objects) of the distinct elements of vals, numbers
+    first, then strings and bytes, each kind sorted.
+    """
+    distinct = {element_bytes(x): x.item() if isinstance(x, np.generic) else x
+                for x in vals}.values()
+    kinds = (str, bytes)
+    key = lambda x: (kinds.index(type(x)) + 1, x) if isinstance(x, kinds) else (0, x)
+    elements = np.empty(len(distinct), dtype=object)
+    elements[:] = sorted(distinct, key=key)
+    return elements
+
+
+def hash_width(n, m, fpr=HASH_FPR):
+    """
+    Return the number of bits the elements are hashed to, the smallest one
+    making the probability that any of the n*m comparisons of different
+    elements is a match at most fpr.
+    """
+    width = max(math.ceil(math.log2(max(n * m, 1) / fpr)), 1)
+    if width > MAX_HASH_WIDTH:
+        raise RuntimeError(f"A false-positive rate of {fpr} needs {width} > {MAX_HASH_WIDTH} bits")
+    return width
+
+
+def hash_bits(xs, seed: bytes, width):
+    """
+    Return the first 'width' bits of the keyed hashes of the elements in xs,
+    as an array of shape (len(xs), width) of uint8 in {0, 1}.
+    """
+    digests = b"".join(hashlib.blake2b(element_bytes(x), digest_size=MAX_HASH_WIDTH // 8,
+                                       key=seed).digest() for x in xs)
+    digests = np.frombuffer(digests, np.uint8).reshape(-1, MAX_HASH_WIDTH // 8)
+    return np.unpackbits(digests, axis=1)[:, :width]
@@ -0,0 +1,128 @@
+"""
+Instrumentation of the parties: per-phase wall and CPU timers and counters,
+exported as JSON or in the Prometheus text format at the end of a run.
+The phases of a run are setup, garble, serialize, ot, evaluate and wait.
+
+Phases nest, e.g. the OTs wait for messages: each phase is only charged
+the time spent outside of the phases nested in it, so that the times of
+all phases add up to the time of the run. CPU times are those of the
+thread running the phase: the phases of different threads, e.g. of the
+garbling thread of a pipelined Alice, overlap in wall time.
+"""
+import collections
+import contextlib
+import json
+import threading
+import time
+
+class Metrics:
+    """
+    Timers and counters of a party, which may be updated from several threads.
+
+    Attributes:
+        party     the name of the party, as a label of the exported metrics
+        phases    a dict mapping each phase to a list [wall time, CPU time, calls]
+        counters  a Counter mapping each pair (name, labels) to its value,
+                  labels being a tuple of pairs (label, value)
+    """
+    def __init__(self, party):
+        self.party = party
+        self.phases = collections.defaultdict(lambda: [0.0, 0.0, 0])
+        self.counters = collections.Counter()
+        self.start = time.perf_counter()
+        self.lock = threading.Lock()
+        self.local = threading.local()  # stack of the running phases of each thread
+
+    @contextlib.contextmanager
+    def phase(self, name):
+        """Charge the time spent in the block to the given phase."""
+        stack = self.local.__dict__.setdefault("stack", [])
+        now = (time.perf_counter(), time.thread_time())
+        if stack:  # pause the enclosing phase
+            self._charge(stack[-1], now, calls=0)
+        stack.append([name, *now])
+        try:
+            yield
+        finally:
+            now = (time.perf_counter(), time.thread_time())
+            self._charge(stack.pop(), now, calls=1)
+            if stack:  # resume the enclosing phase
+                stack[-1][1:] = now
+
+    def _charge(self, entry, now, calls):
+        name, wall, cpu = entry
+        with self.lock:
+            timer = self.phases[name]
+            timer[0] += now[0] - wall
+            timer[1] += now[1] - cpu
+            timer[2] += calls
+
+    def count(self, name, n=1, **labels):
+        """Add n to the counter of the given name and labels."""
+        with self.lock:
+            self.counters[name, tuple(sorted(labels.items()))] += n
+
+    def summary(self):
+        """Return a dict summing up the timers and counters."""
+        with self.lock:
+            return {
+                "party": self.party,
+                "wall": time.perf_counter() - self.start,
+                "phases": {name: {"wall": wall, "cpu": cpu, "calls": calls}
+                           for name, (wall, cpu, calls) in self.phases.items()},
+                "counters": {_series(name, labels): value
+                             for (name, labels), value in sorted(self.counters.items())},
+            }
+
+    def to_json(self):
+        return json.dumps(self.summary(), indent=2)
+
+    def to_prometheus(self):
+        """Return the metrics in the Prometheus text exposition format."""
+        summary = self.summary()
+        party = (("party", self.party),)
+        lines = ["# TYPE psi_wall_seconds gauge",
+                 f"{_series('psi_wall_seconds', party)} {summary['wall']}"]
+        for metric, key in (("psi_phase_wall_seconds_total", "wall"),
+                            ("psi_phase_cpu_seconds_total", "cpu"),
+                            ("psi_phase_calls_total", "calls")):
+            lines.append(f"# TYPE {metric} counter")
+            for name, timer in summary["phases"].items():
+                lines.append(f"{_series(metric, party + (('phase', name),))} {timer[key]}")
+        names = sorted(set(name for name, _ in self.counters))
+        for name in names:
+            lines.append(f"# TYPE psi_{name}_total counter")
+            for (n, labels), value in sorted(self.counters.items()):
+                if n == name:
+                    lines.append(f"{_series(f'psi_{name}_total', party + labels)} {value}")
+        return "\n".join(lines) + "\n"
+
+    def export(self, path):
+        """Write the metrics to a file, in the Prometheus format if its extension is .prom."""
+        with open(path, "w") as f:
+            f.write(self.to_prometheus() if path.endswith(".prom") else self.to_json())
+
+
+class NoMetrics:
+    """Metrics that record nothing, used when instrumentation is disabled."""
+    def phase(self, name):
+        return contextlib.nullcontext()
+
+    def count(self, name, n=1, **labels):
+        pass
+
+
+NO_METRICS = NoMetrics()
+
+
+def _series(name, labels):
+    """Return the name of the series of a metric with the given labels, e.g. gates{type="AND"}."""
+    if not labels:
+        return name
+    return name + "{" + ",".join(f'{label}="{value}"' for label, value in labels) + "}"
+
+
+def count_gates(metrics, name, circuit, copies=1):
+    """Count the gates of 'copies' copies of a CompiledCircuit, by type."""
+    for type, n in circuit.gate_types.items():
+        metrics.count(name, n * copies, type=type)
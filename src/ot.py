@@ -1,14 +1,475 @@
 import hashlib
-import pickle
+import json
+import os
+import tempfile
+import numpy as np
+import instrumentation
 import util
 import yao
 
+OT_MODES = ["base", "iknp", "pool"]
+SECURITY_PARAM = 128  # number of base OTs of the OT extension, in bits
+POOL_CHUNK = 1 << 16  # number of random OTs precomputed per message
+POOL_SIZE = 1 << 20  # maximum number of random OTs precomputed at once
+
+
+def _prg(seed, counter, num_bytes):
+    """Expand a seed into 'num_bytes' pseudo-random bytes for the given counter."""
+    return hashlib.shake_256(seed + counter.to_bytes(8, "big")).digest(num_bytes)
+
+
+def _hash_rows(hash_array, rows, index, length, domain):
+    """Hash each row j of a (n, 16) array into 'length' bytes with H(index + j, row).
+
+    The first byte of the tweaks is set to 'domain', to keep the hashes of
+    different uses apart from each other and from the tweaks used for garbling.
+    H is the hash of the aes backend, which stays correlation robust for rows
+    correlated by a secret offset, e.g. q_j and q_j ^ s.
+    """
+    num_blocks = (length + 15) // 16
+    ids = ((np.arange(len(rows), dtype=np.uint64)[:, None] + np.uint64(index)) << np.uint64(32)
+           | np.arange(num_blocks, dtype=np.uint64)[None, :])
+    tweaks = np.zeros((len(rows), num_blocks, 16), np.uint8)
+    tweaks[..., 0] = domain
+    tweaks[..., 8:] = ids.astype(">u8")[..., None].view(np.uint8)
+    pads = hash_array(np.repeat(rows[:, None, :], num_blocks, axis=1), tweaks)
+    return pads.reshape(len(rows), -1)[:, :length]
+
+
+def _transpose(matrix, num_rows):
+    """Transpose a bit matrix whose rows are packed into bytes.
+
+    Args:
+        matrix: A (k, n/8) array of bytes holding a k x n bit matrix.
+        num_rows: The number n of rows of the transposed matrix.
+
+    Returns:
+        The (n, k/8) array of bytes holding the n x k transposed bit matrix.
+    """
+    bits = np.unpackbits(matrix, axis=1)[:, :num_rows]
+    return np.packbits(bits.T, axis=1)
+
+
+class IKNPExtension:
+    """IKNP OT extension, turning SECURITY_PARAM base OTs into any number of OTs.
+
+    The roles are swapped in the base OTs: the sender of the extended OTs
+    (Alice) chooses SECURITY_PARAM random bits s and receives one of each
+    pair of seeds of the receiver (Bob). Then, for each batch of n OTs, Bob
+    expands the seeds into a SECURITY_PARAM x n bit matrix T and sends
+    U = T ^ G(seeds_1) ^ r, r being his choice bits. Alice gets the rows of
+    Q = T ^ (r . s) and sends each pair of messages masked with H(j, q_j)
+    and H(j, q_j ^ s), of which Bob can only unmask the chosen one, with
+    H(j, t_j). Only hashing and bit matrix transposes are used.
+
+    Args:
+        choices: The sender's choice bits s of the base OTs, None for the receiver.
+        seeds: The seeds received by the sender, or the pairs of seeds of the receiver.
+    """
+    def __init__(self, choices, seeds):
+        self.choices = choices
+        self.seeds = seeds
+        self.counter = 0  # number of batches, for fresh PRG outputs
+        self.index = 0  # number of OTs, for distinct hash tweaks
+        self.hash = yao.AESBackend().hash_array
+        if choices is not None:
+            self.delta = np.packbits(np.array(choices, np.uint8))
+
+    @staticmethod
+    def random_choices():
+        """Return random choice bits s for the sender's base OTs."""
+        return [b & 1 for b in os.urandom(SECURITY_PARAM)]
+
+    @staticmethod
+    def random_seeds():
+        """Return random pairs of seeds for the receiver's base OTs."""
+        return [(os.urandom(16), os.urandom(16)) for _ in range(SECURITY_PARAM)]
+
+    def _next_batch(self, n):
+        """Return the PRG counter and first OT index of a batch of n OTs."""
+        counter, index = self.counter, self.index
+        self.counter += 1
+        self.index += n
+        return counter, index
+
+    def _pads(self, rows, index, length):
+        """Hash each row j of a (n, 16) array into 'length' bytes with H(index + j, row)."""
+        return _hash_rows(self.hash, rows, index, length, domain=0xff)
+
+    def request(self, bits):
+        """Receiver's side: return the matrix U for the given choice bits."""
+        n = len(bits)
+        counter, self.request_index = self._next_batch(n)
+        num_bytes = (n + 7) // 8
+        r = np.packbits(np.array(bits, np.uint8))
+        t = np.empty((SECURITY_PARAM, num_bytes), np.uint8)
+        u = np.empty((SECURITY_PARAM, num_bytes), np.uint8)
+        for i, (seed0, seed1) in enumerate(self.seeds):
+            t[i] = np.frombuffer(_prg(seed0, counter, num_bytes), np.uint8)
+            u[i] = t[i] ^ np.frombuffer(_prg(seed1, counter, num_bytes), np.uint8) ^ r
+        self.request_bits = np.array(bits, np.uint8)
+        self.request_t = _transpose(t, n)
+        return u.tobytes()
+
+    def extend(self, u, msgs):
+        """Sender's side: mask each pair of messages given the receiver's matrix U.
+
+        Args:
+            u: The matrix U sent by the receiver.
+            msgs: A list of pairs (msg1, msg2), all of the same length.
+
+        Returns:
+            The masked messages, as bytes.
+        """
+        n = len(msgs)
+        length = len(msgs[0][0])
+        if any(len(m) != length for pair in msgs for m in pair):
+            raise RuntimeError("OT extension messages must all have the same length")
+
+        m = np.frombuffer(b"".join(m for pair in msgs for m in pair), np.uint8)
+        return (m.reshape(n, 2, length) ^ self.random_pairs(u, n, length)).tobytes()
+
+    def random_pairs(self, u, n, length):
+        """Sender's side: return the random pairs of n random OTs given the receiver's matrix U.
+
+        Returns:
+            A (n, 2, length) array, of which the receiver only knows the
+            messages selected by his choice bits.
+        """
+        counter, index = self._next_batch(n)
+        num_bytes = (n + 7) // 8
+        u = np.frombuffer(u, np.uint8).reshape(SECURITY_PARAM, num_bytes)
+        q = np.empty((SECURITY_PARAM, num_bytes), np.uint8)
+        for i, (s, seed) in enumerate(zip(self.choices, self.seeds)):
+            q[i] = np.frombuffer(_prg(seed, counter, num_bytes), np.uint8)
+            if s:
+                q[i] ^= u[i]
+        q = _transpose(q, n)
+        return np.stack((self._pads(q, index, length),
+                         self._pads(q ^ self.delta, index, length)), axis=1)
+
+    def receive(self, y):
+        """Receiver's side: unmask the chosen messages of the last request."""
+        n = len(self.request_bits)
+        y = np.frombuffer(y, np.uint8).reshape(n, 2, -1)
+        chosen = y[np.arange(n), self.request_bits]
+        return [row.tobytes() for row in chosen ^ self.random_chosen(y.shape[2])]
+
+    def random_chosen(self, length):
+        """Receiver's side: return the (n, length) random messages chosen by the last request."""
+        return self._pads(self.request_t, self.request_index, length)
+
+
+def _replace(path, write):
+    """Atomically replace a file by the bytes written by write(f) to a temporary file."""
+    fd, tmp = tempfile.mkstemp(dir=os.path.dirname(path), suffix=".tmp")
+    try:
+        with os.fdopen(fd, "wb") as f:
+            write(f)
+        os.replace(tmp, path)
+    except BaseException:
+        os.remove(tmp)
+        raise
+
+
+class RandomOTPool:
+    """Pool of random OTs precomputed offline, each used once to transfer chosen messages online.
+
+    The sender holds random pairs (r_0, r_1), the receiver a random choice
+    bit c and r_c for each random OT. To receive m_b online, the receiver
+    sends the correction e = b ^ c and the sender answers with m_0 ^ r_e and
+    m_1 ^ r_{1 ^ e}, of which the receiver can only unmask m_b, with r_c
+    (Beaver's derandomization). The random messages are SECURITY_PARAM bits
+    long and hashed into masks of the length of the messages.
+
+    The pool is either kept in memory or stored in a directory, in which
+    case the random OTs are memory-mapped and the number of used ones is
+    saved as soon as they are taken, so that none of them is ever reused.
+    The random OTs are saved to new files of the next generation, then the
+    state file is replaced to point at them, so that a crash leaves either
+    the old pool or the new one, never a mix of both.
+
+    Args:
+        pool_id: The identifier of the pool, shared by both parties.
+        masks: The (n, 2, 16) array of random pairs of the sender, or the
+            (n, 16) array of random messages chosen by the receiver.
+        choices: The receiver's n choice bits, None for the sender.
+        used: Optional; the number of random OTs already used.
+        path: Optional; the directory storing the pool.
+        generation: Optional; the number of times the stored pool was saved.
+    """
+    def __init__(self, pool_id, masks, choices=None, used=0, path=None, generation=0):
+        self.pool_id = pool_id
+        self.masks = masks
+        self.choices = choices
+        self.used = used
+        self.path = path
+        self.generation = generation
+        self.hash = yao.AESBackend().hash_array
+
+    @classmethod
+    def load(cls, path):
+        """Load the pool stored in the given directory, None if there is none."""
+        if not os.path.exists(os.path.join(path, "pool.json")):
+            return None
+        with open(os.path.join(path, "pool.json")) as f:
+            state = json.load(f)
+        pool = cls(state["id"], None, None, state["used"], path, state["generation"])
+        pool.masks = np.load(pool._file("masks"), mmap_mode="r")
+        if state["receiver"]:
+            pool.choices = np.load(pool._file("choices"), mmap_mode="r")
+        return pool
+
+    def save(self, path=None):
+        """Store the pool in the given directory, by default the one it was loaded from."""
+        self.path = path or self.path
+        os.makedirs(self.path, exist_ok=True)
+        self.generation += 1
+        _replace(self._file("masks"), lambda f: np.save(f, self.masks))
+        if self.choices is not None:
+            _replace(self._file("choices"), lambda f: np.save(f, self.choices))
+        self._save_state()  # last: the pool is saved once the state points at its files
+        current = {os.path.basename(self._file(name)) for name in ("masks", "choices")}
+        for name in os.listdir(self.path):
+            if name.endswith(".npy") and name not in current:
+                os.remove(os.path.join(self.path, name))  # files of older generations
+
+    def _file(self, name):
+        """Return the path of the file of the current generation storing the given array."""
+        return os.path.join(self.path, f"{name}.{self.generation}.npy")
+
+    def _save_state(self):
+        _replace(os.path.join(self.path, "pool.json"), lambda f: f.write(json.dumps({
+            "id": self.pool_id,
+            "used": self.used,
+            "generation": self.generation,
+            "receiver": self.choices is not None,
+        }).encode()))
+
+    def state(self):
+        """Return the identifier of the pool and the number of used random OTs."""
+        return (self.pool_id, self.used)
+
+    def remaining(self):
+        """Return the number of random OTs left in the pool."""
+        return len(self.masks) - self.used
+
+    def append(self, masks, choices=None):
+        """Add random OTs to the pool, dropping the used ones."""
+        self.masks = np.concatenate((self.masks[self.used:], masks))
+        if choices is not None:
+            self.choices = np.concatenate((self.choices[self.used:], choices))
+        self.used = 0
+        if self.path:
+            self.save()
+
+    def _take(self, n):
+        """Return the masks, choice bits and index of the next n random OTs."""
+        if n > self.remaining():
+            raise RuntimeError(f"Only {self.remaining()} precomputed OTs left, {n} needed")
+        index, self.used = self.used, self.used + n
+        if self.path:
+            self._save_state()
+        choices = None if self.choices is None else np.asarray(self.choices[index:self.used])
+        return np.asarray(self.masks[index:self.used]), choices, index
+
+    def corrections(self, bits):
+        """Receiver's side: return the packed corrections e = b ^ c for the given bits."""
+        masks, choices, self.request_index = self._take(len(bits))
+        self.request_bits = np.array(bits, np.uint8)
+        self.request_masks = masks
+        return np.packbits(self.request_bits ^ choices).tobytes()
+
+    def mask(self, e, msgs):
+        """Sender's side: mask each pair of messages given the receiver's corrections.
+
+        Args:
+            e: The packed corrections sent by the receiver.
+            msgs: A list of pairs (msg1, msg2), all of the same length.
+
+        Returns:
+            The masked messages, as bytes.
+        """
+        n = len(msgs)
+        length = len(msgs[0][0])
+        if any(len(m) != length for pair in msgs for m in pair):
+            raise RuntimeError("OT messages must all have the same length")
+
+        masks, _, index = self._take(n)
+        e = np.unpackbits(np.frombuffer(e, np.uint8))[:n]
+        rows = np.arange(n)
+        pads = (_hash_rows(self.hash, masks[rows, e], index, length, domain=0xfe),
+                _hash_rows(self.hash, masks[rows, e ^ 1], index, length, domain=0xfe))
+        m = np.frombuffer(b"".join(m for pair in msgs for m in pair), np.uint8)
+        m = m.reshape(n, 2, length)
+        return np.stack((m[:, 0] ^ pads[0], m[:, 1] ^ pads[1]), axis=1).tobytes()
+
+    def receive(self, y):
+        """Receiver's side: unmask the chosen messages of the last corrections."""
+        n = len(self.request_bits)
+        y = np.frombuffer(y, np.uint8).reshape(n, 2, -1)
+        chosen = y[np.arange(n), self.request_bits]
+        pads = _hash_rows(self.hash, self.request_masks, self.request_index,
+                          y.shape[2], domain=0xfe)
+        return [row.tobytes() for row in chosen ^ pads]
+
 
 class ObliviousTransfer:
-    def __init__(self, socket, logger, enabled=True):
+    """Oblivious transfer of Bob's input keys.
+
+    Args:
+        socket: The party's socket.
+        logger: The party's logger.
+        enabled: Optional; whether to use OT or send both keys to Bob.
+        group: Optional; the PrimeGroup used by all OTs of the session,
+            agreed upon during the handshake. Without one, each OT
+            generates its own group and sends it to Bob.
+        mode: Optional; how the batched OTs are performed, base to run
+            the public-key OT for each of them, iknp to extend a few
+            base OTs run during setup, pool to use random OTs
+            precomputed during setup.
+        pool_path: Optional; the directory storing the party's pool of
+            random OTs across sessions, None to keep it in memory.
+        pool_size: Optional; the maximum number of random OTs precomputed
+            at once, the pool being refilled when it runs short. Alice's
+            is used by both parties.
+        metrics: Optional; the instrumentation.Metrics recording the OTs
+            and evaluations.
+    """
+    def __init__(self, socket, logger, enabled=True, group=None, mode="base",
+                 pool_path=None, pool_size=POOL_SIZE, metrics=None):
         self.socket = socket
         self.enabled = enabled
         self.logger = logger
+        self.group = group
+        self.mode = mode
+        self.extension = None  # IKNPExtension, once set up
+        self.pool_path = pool_path
+        self.pool = None  # RandomOTPool, once set up
+        self.pool_size = pool_size
+        self.metrics = metrics or instrumentation.NO_METRICS
+
+    def setup_garbler(self, num_ots=0):
+        """Set up the OT extension or the pool of random OTs, Alice's side, right after the handshake.
+
+        Args:
+            num_ots: Optional; the number of OTs the pool must provide.
+        """
+        if not self.enabled:
+            return
+        with self.metrics.phase("ot"):
+            if self.mode == "iknp":
+                self._setup_extension_garbler()
+            elif self.mode == "pool":
+                self._setup_pool_garbler(num_ots)
+
+    def setup_evaluator(self):
+        """Set up the OT extension or the pool of random OTs, Bob's side, right after the handshake."""
+        if not self.enabled:
+            return
+        with self.metrics.phase("ot"):
+            if self.mode == "iknp":
+                self._setup_extension_evaluator()
+            elif self.mode == "pool":
+                self._setup_pool_evaluator()
+
+    def _setup_extension_garbler(self):
+        self.logger.ot("Setting up OT extension")
+        self.socket.send("IKNP")
+        choices = IKNPExtension.random_choices()
+        seeds = self.ot_evaluator_batch(choices)
+        self.extension = IKNPExtension(choices, seeds)
+
+    def _setup_extension_evaluator(self):
+        self.logger.ot("Setting up OT extension")
+        self.socket.receive()
+        seeds = IKNPExtension.random_seeds()
+        self.ot_garbler_batch(seeds)
+        self.extension = IKNPExtension(None, seeds)
+
+    def _setup_pool_garbler(self, num_ots):
+        """
+        Offline phase, Alice's side: precompute the random OTs missing from
+        the pool, at most pool_size of them, and set up the OT extension
+        refilling it online if num_ots exceeds them.
+        """
+        if self.pool_path:
+            self.pool = RandomOTPool.load(self.pool_path)
+        state = self.pool.state() if self.pool else None
+        if not self.socket.send_wait(("POOL", state, num_ots, self.pool_size)):
+            self.pool = None  # Bob does not have the same pool
+        remaining = self.pool.remaining() if self.pool else 0
+        if num_ots <= remaining:
+            return
+
+        self._setup_extension_garbler()
+        pool_id = self.pool.pool_id if self.pool else os.urandom(8).hex()
+        missing = min(num_ots, self.pool_size) - remaining
+        if missing <= 0:
+            return
+        self.logger.ot("Precomputing %s random OTs", missing)
+        chunks = []
+        for start in range(0, missing, POOL_CHUNK):
+            n = min(POOL_CHUNK, missing - start)
+            u = self.socket.send_wait(("FILL", pool_id, n))
+            chunks.append(self.extension.random_pairs(u, n, SECURITY_PARAM // 8))
+        self._add_to_pool(pool_id, np.concatenate(chunks))
+
+    def _setup_pool_evaluator(self):
+        """Offline phase, Bob's side: precompute the random OTs missing from the pool."""
+        if self.pool_path:
+            self.pool = RandomOTPool.load(self.pool_path)
+        _, state, num_ots, self.pool_size = self.socket.receive()
+        same = self.pool is not None and state == self.pool.state()
+        if not same:
+            self.pool = None
+        self.socket.send(same)
+        remaining = self.pool.remaining() if self.pool else 0
+        if num_ots <= remaining:
+            return
+
+        self._setup_extension_evaluator()
+        missing = min(num_ots, self.pool_size) - remaining
+        if missing <= 0:
+            return
+        self.logger.ot("Precomputing %s random OTs", missing)
+        chunks, choices = [], []
+        for start in range(0, missing, POOL_CHUNK):
+            _, pool_id, n = self.socket.receive()
+            c = [b & 1 for b in os.urandom(n)]
+            self.socket.send(self.extension.request(c))
+            chunks.append(self.extension.random_chosen(SECURITY_PARAM // 8))
+            choices.append(np.array(c, np.uint8))
+        self._add_to_pool(pool_id, np.concatenate(chunks), np.concatenate(choices))
+
+    def _refill_pool_evaluator(self, n):
+        """
+        Online, Bob's side: if the pool holds fewer than the n random OTs of
+        a batch, refill it up to pool_size (or n) random OTs, a chunk per
+        round trip, before sending the corrections.
+        """
+        remaining = self.pool.remaining() if self.pool else 0
+        if remaining >= n or self.extension is None:
+            return
+        missing = max(n, self.pool_size) - remaining
+        self.logger.ot("Refilling the pool with %s random OTs", missing)
+        chunks, choices = [], []
+        for start in range(0, missing, POOL_CHUNK):
+            k = min(POOL_CHUNK, missing - start)
+            c = [b & 1 for b in os.urandom(k)]
+            self.socket.send(("FILL", k, self.extension.request(c)))
+            self.socket.receive()
+            chunks.append(self.extension.random_chosen(SECURITY_PARAM // 8))
+            choices.append(np.array(c, np.uint8))
+        self._add_to_pool(self.pool.pool_id, np.concatenate(chunks), np.concatenate(choices))
+
+    def _add_to_pool(self, pool_id, masks, choices=None):
+        if self.pool:
+            self.pool.append(masks, choices)
+            return
+        self.pool = RandomOTPool(pool_id, masks, choices)
+        if self.pool_path:
+            self.pool.save(self.pool_path)
 
     def get_result(self, a_inputs, b_keys):
         """Send Alice's inputs and retrieve Bob's result of evaluation.
@@ -26,27 +487,87 @@ class ObliviousTransfer:
         for _ in range(len(b_keys)):
             w = self.socket.receive()  # receive wire ID where to perform OT
             self.logger.ot("\n")
-            self.logger.ot(f"Received wire ID {w}")
-
-            if self.enabled:  # perform oblivious transfer
-                pair = (pickle.dumps(b_keys[w][0]), pickle.dumps(b_keys[w][1]))
-                self.ot_garbler(pair)
-            else:
-                to_send = (b_keys[w][0], b_keys[w][1])
-                self.socket.send(to_send)
+            self.logger.ot("Received wire ID %s", w)
+            self._send_keys(b_keys[w])
 
         self.logger.ot("\n" + "="*120)
         a = self.socket.receive()
         return a
 
-    def send_result(self, circuit, g_tables, pbits_out, b_inputs):
+    def get_result_batch(self, batch, b_keys):
+        """Send a batch of garbled circuits and retrieve Bob's results.
+
+        Args:
+            batch: A dict containing the garbled tables, p-bits of outputs
+                and Alice's inputs of every circuit in the batch.
+            b_keys: A list containing, for each circuit in the batch, a dict
+                mapping each Bob's wire to a pair (key, encr_bit).
+
+        Returns:
+            The output bits of all circuits of the batch, packed into bytes.
+        """
+        self.send_batch(batch, b_keys)
+        return self.socket.receive()
+
+    def send_batch(self, batch, b_keys):
+        """Send a batch of garbled circuits along with the keys of Bob's wires.
+
+        Bob's results are not waited for: a pipelined Alice retrieves them
+        later with socket.receive_result.
+
+        Args:
+            batch: A dict containing the garbled tables, p-bits of outputs
+                and Alice's inputs of every circuit in the batch.
+            b_keys: A list containing, for each circuit in the batch, a dict
+                mapping each Bob's wire to a pair (key, encr_bit).
+        """
+        self.logger.ot("Sending garbled tables and my input keys to Bob")
+        self.socket.send(batch)
+
+        # transfer the keys of all Bob's wires of all circuits at once
+        keys = [pair for keys in b_keys for pair in keys.values()]
+        with self.metrics.phase("ot"):
+            if not self.enabled:
+                self.socket.receive()
+                self.socket.send(keys)
+            elif self.mode == "iknp":
+                self.ot_garbler_ext([(key0 + bytes([encr_bit0]), key1 + bytes([encr_bit1]))
+                                     for (key0, encr_bit0), (key1, encr_bit1) in keys])
+            elif self.mode == "pool":
+                self.ot_garbler_pool([(key0 + bytes([encr_bit0]), key1 + bytes([encr_bit1]))
+                                      for (key0, encr_bit0), (key1, encr_bit1) in keys])
+            else:
+                self.socket.receive()
+                self.ot_garbler_batch([(key0 + bytes([encr_bit0]), key1 + bytes([encr_bit1]))
+                                       for (key0, encr_bit0), (key1, encr_bit1) in keys])
+        self._count_ots(len(keys))
+
+        self.logger.ot("\n" + "="*120)
+
+    def _send_keys(self, keys):
+        """Transfer one of the keys of a Bob's wire."""
+        with self.metrics.phase("ot"):
+            if self.enabled:  # perform oblivious transfer
+                (key0, encr_bit0), (key1, encr_bit1) = keys
+                self.ot_garbler((key0 + bytes([encr_bit0]), key1 + bytes([encr_bit1])))
+            else:
+                self.socket.send((keys[0], keys[1]))
+        self._count_ots(1)
+
+    def _count_ots(self, n):
+        self.metrics.count("ots", n, mode=self.mode if self.enabled else "disabled")
+
+    def send_result(self, circuit, g_tables, pbits_out, b_inputs,
+                    backend="fernet"):
         """Evaluate circuit and send the result to Alice.
 
         Args:
-            circuit: A dict containing circuit spec.
-            g_tables: Garbled tables of yao circuit.
+            circuit: A CompiledCircuit, or a dict containing circuit spec.
+            g_tables: Garbled tables of yao circuit, as a dict or laid out
+                in a contiguous buffer (backends with fixed-size keys).
             pbits_out: p-bits of outputs.
             b_inputs: A dict mapping Bob's wires to (clear) input bits.
+            backend: Optional; the garbling backend of the circuit.
         """
         # map from Alice's wires to (key, encr_bit) inputs
         a_inputs = self.socket.receive()
@@ -57,24 +578,128 @@ class ObliviousTransfer:
 
         for w, b_input in b_inputs.items():
             self.logger.ot("\n")
-            self.logger.ot(f"Sending wire ID {w}")
+            self.logger.ot("Sending wire ID %s", w)
             self.socket.send(w)
+            b_inputs_encr[w] = self._receive_key(b_input)
 
-            if self.enabled:
-                b_inputs_encr[w] = pickle.loads(self.ot_evaluator(b_input))
-                self.logger.ot(f"Received key {b_inputs_encr[w]}")
-            else:
-                pair = self.socket.receive()
-                b_inputs_encr[w] = pair[b_input]
-
+        if not isinstance(g_tables, dict):
+            g_tables = yao.unpack_tables(circuit, g_tables, backend)
         result = yao.evaluate(circuit, g_tables, pbits_out, a_inputs,
-                              b_inputs_encr)
+                              b_inputs_encr, backend, self.metrics)
 
-        self.logger.ot(f"\nSending circuit evaluation {result}")
+        self.logger.ot("\nSending circuit evaluation %s", result)
         self.logger.ot("\n" + "="*120)
         self.socket.send(result)
         return result
 
+    def send_result_batch(self, circuit, batch, b_inputs, backend="fernet"):
+        """Evaluate a batch of circuits and send the packed results to Alice.
+
+        Args:
+            circuit: A CompiledCircuit, or a dict containing circuit spec.
+            batch: The batch received from Alice, containing the garbled
+                tables, p-bits of outputs and Alice's inputs of each circuit,
+                either as lists of dicts, or as arrays with a row per circuit
+                for backends with fixed-size keys.
+            b_inputs: A list containing, for each circuit in the batch, a dict
+                mapping Bob's wires to (clear) input bits.
+            backend: Optional; the garbling backend of the circuits.
+
+        Returns:
+            A list containing the result of the evaluation of each circuit.
+        """
+        keys = self.receive_keys_batch(b_inputs)
+        return self.evaluate_batch(circuit, batch, b_inputs, keys, backend)
+
+    def receive_keys_batch(self, b_inputs, overlap=None):
+        """Retrieve the keys of Bob's wires of all circuits of a batch at once.
+
+        Args:
+            b_inputs: A list containing, for each circuit in the batch, a dict
+                mapping Bob's wires to (clear) input bits.
+            overlap: Optional; a function called while waiting for Alice's
+                last answer, e.g. to evaluate the previous batch meanwhile.
+
+        Returns:
+            The list of pairs (key, encr_bit) of Bob's wires, circuit by circuit.
+        """
+        self.logger.ot("Received garbled tables and Alice's input keys")
+        bits = [b_input for inputs in b_inputs for b_input in inputs.values()]
+        self._count_ots(len(bits))
+        with self.metrics.phase("ot"):
+            if not self.enabled:
+                pairs = self._send_wait(True, overlap)
+                return [pair[b_input] for pair, b_input in zip(pairs, bits)]
+            elif self.mode == "iknp":
+                keys = self.ot_evaluator_ext(bits, overlap)
+            elif self.mode == "pool":
+                keys = self.ot_evaluator_pool(bits, overlap)
+            else:
+                self.socket.send(True)
+                keys = self.ot_evaluator_batch(bits, overlap)
+            return [(key[:-1], key[-1]) for key in keys]
+
+    def evaluate_batch(self, circuit, batch, b_inputs, keys, backend="fernet", tagged=False):
+        """Evaluate a batch of circuits and send the packed results to Alice.
+
+        Args:
+            circuit: A CompiledCircuit, or a dict containing circuit spec.
+            batch: The batch received from Alice, as in send_result_batch.
+            b_inputs: A list containing, for each circuit in the batch, a dict
+                mapping Bob's wires to (clear) input bits.
+            keys: The keys of Bob's wires, as returned by receive_keys_batch.
+            backend: Optional; the garbling backend of the circuits.
+            tagged: Optional; whether to tag the results with util.RESULT,
+                for a pipelined Alice receiving them out of turn.
+
+        Returns:
+            A list containing the result of the evaluation of each circuit.
+        """
+        backend = yao.get_backend(backend)
+        results, out_bits = [], []
+        circuit = yao.compile_circuit(circuit)
+        a_wires = [circuit.wires[w] for w in circuit.alice]
+        out_wires = [circuit.wires[w] for w in circuit.out]
+        keys = iter(keys)
+        for k, inputs in enumerate(b_inputs):
+            b_inputs_encr = {w: next(keys) for w in inputs}
+            g_tables = batch["garbled_tables"][k]
+            pbits_out, a_inputs = batch["pbits_out"][k], batch["a_inputs"][k]
+            if not isinstance(g_tables, dict):  # rows of arrays
+                with self.metrics.phase("serialize"):
+                    g_tables = yao.unpack_tables(circuit, g_tables, backend)
+                    pbits_out = dict(zip(out_wires, pbits_out.tolist()))
+                    a_inputs = yao.unpack_inputs(a_wires, a_inputs)
+            result = yao.evaluate(circuit, g_tables, pbits_out, a_inputs,
+                                  b_inputs_encr, backend, self.metrics)
+            results.append(result)
+            out_bits.extend(result.values())
+
+        self.logger.ot("\nSending evaluation of %s circuits", len(results))
+        self.logger.ot("\n" + "="*120)
+        packed = util.pack_bits(out_bits)
+        self.socket.send((util.RESULT, packed) if tagged else packed)
+        return results
+
+    def _send_wait(self, msg, overlap=None):
+        """Send a message and wait for the answer, calling overlap meanwhile."""
+        self.socket.send(msg)
+        if overlap is not None:
+            overlap()
+        return self.socket.receive()
+
+    def _receive_key(self, b_input):
+        """Retrieve the key of a Bob's wire matching his input bit."""
+        self._count_ots(1)
+        with self.metrics.phase("ot"):
+            if self.enabled:
+                key = self.ot_evaluator(b_input)
+                key = (key[:-1], key[-1])
+                self.logger.ot("Received key %s", key)
+                return key
+            pair = self.socket.receive()
+            return pair[b_input]
+
     def ot_garbler(self, msgs):
         """Oblivious transfer, Alice's side.
 
@@ -82,27 +707,29 @@ class ObliviousTransfer:
             msgs: A pair (msg1, msg2) to suggest to Bob.
         """
         self.logger.ot("OT protocol started")
-        self.logger.ot(f"m_0 = {msgs[0].hex()}")
-        self.logger.ot(f"m_1 = {msgs[1].hex()}")
-        G = util.PrimeGroup()
-        self.socket.send_wait(G)
-        self.logger.ot(f"Using G = {G}")
+        self.logger.ot("m_0 = %s", msgs[0])
+        self.logger.ot("m_1 = %s", msgs[1])
+        G = self.group
+        if G is None:
+            G = util.PrimeGroup()
+            self.socket.send_wait(G.params())
+        self.logger.ot("Using G = %s", G)
 
         # OT protocol based on Nigel Smart’s "Cryptography Made Simple"
         c = G.gen_pow(G.rand_int())
         h0 = self.socket.send_wait(c)
-        self.logger.ot(f"Sent c = {c}")
-        self.logger.ot(f"Received h_0 = {h0}")
+        self.logger.ot("Sent c = %s", c)
+        self.logger.ot("Received h_0 = %s", h0)
         h1 = G.mul(c, G.inv(h0))
-        self.logger.ot("Computing h_1 = c * h_0^{-1} = " + str(h1))
+        self.logger.ot("Computing h_1 = c * h_0^{-1} = %s", h1)
         k = G.rand_int()
         c1 = G.gen_pow(k)
-        self.logger.ot(f"Encrypting with k = {k}")
+        self.logger.ot("Encrypting with k = %s", k)
         e0 = util.xor_bytes(msgs[0], self.ot_hash(G.pow(h0, k), len(msgs[0])))
         e1 = util.xor_bytes(msgs[1], self.ot_hash(G.pow(h1, k), len(msgs[1])))
         self.logger.ot("Sending")
-        self.logger.ot(f"e_0 = {e0.hex()}")
-        self.logger.ot(f"e_1 = {e1.hex()}")
+        self.logger.ot("e_0 = %s", e0)
+        self.logger.ot("e_1 = %s", e1)
 
         self.socket.send((c1, e0, e1))
         self.logger.ot("OT protocol ended")
@@ -117,31 +744,169 @@ class ObliviousTransfer:
             The message selected by Bob.
         """
         self.logger.ot("OT protocol started")
-        G = self.socket.receive()
-        self.logger.ot(f"Received G = {G}")
-        self.socket.send(True)
+        G = self.group
+        if G is None:
+            G = util.load_group(self.socket.receive())
+            self.logger.ot("Received G = %s", G)
+            self.socket.send(True)
 
         # OT protocol based on Nigel Smart’s "Cryptography Made Simple"
         c = self.socket.receive()
-        self.logger.ot(f"Received c = {c}")
+        self.logger.ot("Received c = %s", c)
         x = G.rand_int()
-        self.logger.ot(f"Using x = {x}")
+        self.logger.ot("Using x = %s", x)
         x_pow = G.gen_pow(x)
         h = (x_pow, G.mul(c, G.inv(x_pow)))
         c1, e0, e1 = self.socket.send_wait(h[b])
-        self.logger.ot(f"Sent h_{b} = {h[b]}")
+        self.logger.ot("Sent h_%s = %s", b, h[b])
         e = (e0, e1)
-        self.logger.ot(f"Received")
-        self.logger.ot(f"c_1 = {c1}")
-        self.logger.ot(f"e_0 = {e0.hex()}")
-        self.logger.ot(f"e_1 = {e1.hex()}")
+        self.logger.ot("Received")
+        self.logger.ot("c_1 = %s", c1)
+        self.logger.ot("e_0 = %s", e0)
+        self.logger.ot("e_1 = %s", e1)
         ot_hash = self.ot_hash(G.pow(c1, x), len(e[b]))
         mb = util.xor_bytes(e[b], ot_hash)
-        self.logger.ot(f"Computed m_{b} = {mb.hex()}")
+        self.logger.ot("Computed m_%s = %s", b, mb)
 
         self.logger.ot("OT protocol ended")
         return mb
 
+    def ot_garbler_batch(self, msgs):
+        """Oblivious transfer of many pairs of messages at once, Alice's side.
+
+        All OTs share the first message c of the protocol and the remaining
+        messages are sent as vectors, so that the whole batch takes two round
+        trips (three when the group is not agreed upon for the session).
+
+        Args:
+            msgs: A list of pairs (msg1, msg2) to suggest to Bob.
+        """
+        self.logger.ot("Batch OT protocol started for %s pairs", len(msgs))
+        G = self.group
+        if G is None:
+            G = util.PrimeGroup()
+            self.socket.send_wait(G.params())
+        self.logger.ot("Using G = %s", G)
+
+        c = G.gen_pow(G.rand_int())
+        h0s = self.socket.send_wait(c)
+        self.logger.ot("Sent c = %s", c)
+
+        to_send = []
+        for (m0, m1), h0 in zip(msgs, h0s):
+            h1 = G.mul(c, G.inv(h0))
+            k = G.rand_int()
+            e0 = util.xor_bytes(m0, self.ot_hash(G.pow(h0, k), len(m0)))
+            e1 = util.xor_bytes(m1, self.ot_hash(G.pow(h1, k), len(m1)))
+            to_send.append((G.gen_pow(k), e0, e1))
+
+        self.socket.send(to_send)
+        self.logger.ot("Batch OT protocol ended")
+
+    def ot_evaluator_batch(self, bits, overlap=None):
+        """Oblivious transfer of many pairs of messages at once, Bob's side.
+
+        Args:
+            bits: A list of Bob's input bits, each selecting one of the
+                messages of the matching pair.
+            overlap: Optional; a function called while waiting for Alice's answer.
+
+        Returns:
+            The list of messages selected by Bob.
+        """
+        self.logger.ot("Batch OT protocol started for %s bits", len(bits))
+        G = self.group
+        if G is None:
+            G = util.load_group(self.socket.receive())
+            self.logger.ot("Received G = %s", G)
+            self.socket.send(True)
+
+        c = self.socket.receive()
+        self.logger.ot("Received c = %s", c)
+        xs = [G.rand_int() for _ in bits]
+        hs = []
+        for x, b in zip(xs, bits):
+            x_pow = G.gen_pow(x)
+            hs.append(x_pow if b == 0 else G.mul(c, G.inv(x_pow)))
+
+        received = self._send_wait(hs, overlap)
+        mbs = []
+        for x, b, (c1, e0, e1) in zip(xs, bits, received):
+            e = (e0, e1)[b]
+            mbs.append(util.xor_bytes(e, self.ot_hash(G.pow(c1, x), len(e))))
+
+        self.logger.ot("Batch OT protocol ended")
+        return mbs
+
+    def ot_garbler_ext(self, msgs):
+        """Oblivious transfer of many pairs of messages with the OT extension, Alice's side.
+
+        Takes a single round trip, started by Bob.
+
+        Args:
+            msgs: A list of pairs (msg1, msg2) to suggest to Bob, all of the same length.
+        """
+        self.logger.ot("OT extension started for %s pairs", len(msgs))
+        u = self.socket.receive()
+        self.socket.send(self.extension.extend(u, msgs))
+        self.logger.ot("OT extension ended")
+
+    def ot_evaluator_ext(self, bits, overlap=None):
+        """Oblivious transfer of many pairs of messages with the OT extension, Bob's side.
+
+        Args:
+            bits: A list of Bob's input bits, each selecting one of the
+                messages of the matching pair.
+            overlap: Optional; a function called while waiting for Alice's answer.
+
+        Returns:
+            The list of messages selected by Bob.
+        """
+        self.logger.ot("OT extension started for %s bits", len(bits))
+        y = self._send_wait(self.extension.request(bits), overlap)
+        self.logger.ot("OT extension ended")
+        return self.extension.receive(y)
+
+    def ot_garbler_pool(self, msgs):
+        """Oblivious transfer of many pairs of messages with precomputed random OTs, Alice's side.
+
+        Takes a single round trip, started by Bob, with no public-key
+        operation: only the corrections and the masked messages are sent,
+        after a round trip per chunk of random OTs if Bob refills the pool.
+
+        Args:
+            msgs: A list of pairs (msg1, msg2) to suggest to Bob, all of the same length.
+        """
+        self.logger.ot("Pool OT started for %s pairs", len(msgs))
+        e = self.socket.receive()
+        chunks = []
+        while isinstance(e, tuple):  # Bob refills the pool first
+            _, n, u = e
+            chunks.append(self.extension.random_pairs(u, n, SECURITY_PARAM // 8))
+            self.socket.send(True)
+            e = self.socket.receive()
+        if chunks:
+            self._add_to_pool(self.pool.pool_id, np.concatenate(chunks))
+        self.socket.send(self.pool.mask(e, msgs))
+        self.logger.ot("Pool OT ended")
+
+    def ot_evaluator_pool(self, bits, overlap=None):
+        """Oblivious transfer of many pairs of messages with precomputed random OTs, Bob's side.
+
+        Args:
+            bits: A list of Bob's input bits, each selecting one of the
+                messages of the matching pair.
+            overlap: Optional; a function called while waiting for Alice's answer.
+
+        Returns:
+            The list of messages selected by Bob.
+        """
+        self.logger.ot("Pool OT started for %s bits", len(bits))
+        self._refill_pool_evaluator(len(bits))
+        y = self._send_wait(self.pool.corrections(bits), overlap)
+        self.logger.ot("Pool OT ended")
+        return self.pool.receive(y)
+
     @staticmethod
     def ot_hash(pub_key, msg_length):
         """Hash function for OT keys."""
@@ -1,8 +1,23 @@
 import util
+import checkpoint
+import circuit_gen
+import circuit_pool
+import hashing
 import ot
 import yao
-import pickle
-from multiprocessing import Process
+import os
+import collections
+import itertools
+import queue
+import signal
+import sys
+import cProfile
+import instrumentation
+import threading
+import numpy as np
+from concurrent.futures import ThreadPoolExecutor
+from multiprocessing import Process, Queue
+WORKER_POLL = 1  # seconds between checks that the workers are still running
 def _id(x, *args, **kwargs):
     return x
 try: 
@@ -19,24 +34,166 @@ class Alice():
     
     Alice will generate and send at most n*m garbled circuits
     where n is the size of Alice's set, m of Bob's set.
+    In batched mode, the circuits are sent batch_size at a time, each batch
+    in a single message, the keys of Bob's wires of the whole batch are
+    transferred with batched OTs, and Bob answers with the results of the
+    whole batch: O(n*m / batch_size) round trips instead of O(n*m * 32).
+    In bucketed mode, Bob stores his values in bins with cuckoo hashing and
+    Alice only compares each of her values with the values of the bins it
+    may have been stored in: 1.27*m bins of O(log n) circuits each.
+    In all-pairs mode, each circuit compares k of Alice's values with all of
+    Bob's values, so that the keys of each Bob's value are transferred once
+    per circuit instead of once per comparison.
+    In pipelined mode, Alice garbles the next batch while the previous ones
+    are in flight and being evaluated, and sends up to window batches ahead
+    of Bob's results, so that neither party waits for the other.
+    In hashed mode, the elements, of any type, are compared through their
+    keyed hashes of l bits, l being the smallest width keeping the rate of
+    false positives below hash_fpr, using an eql circuit instead of eq32.
+    In a session, both parties record their progress in checkpoint journals
+    after each batch, so that restarting the session resumes the comparisons
+    after the last batch recorded by both.
+    With a circuit pool, a background thread garbles the circuits ahead of
+    time, starting before Bob connects, and the online phase only picks the
+    keys of Alice's inputs and sends them along with pre-garbled circuits.
 
     Attributes:
-        socket  Alice's socket
-        ot      Alice's side OT
-        vals    a list containing the values in Alice's set
+        socket      Alice's socket
+        ot          Alice's side OT
+        vals        a list containing the values in Alice's set
+        batch_size  the number of circuits per batch, None to send them one by one
+        backend     the name of the garbling backend
+        group       the name of the standard group used by the OTs,
+                    None to generate a random group for the session
+        ot_mode     how Bob's keys of a batch are transferred: base, iknp or pool
+        ot_pool     the directory storing Alice's precomputed random OTs, None
+                    to keep them in memory
+        bucketed    whether to only compare values stored in the same bin
+        all_pairs   the number k of Alice's values per all-pairs circuit,
+                    None to use one eq32 circuit per comparison
+        window      the number of batches sent ahead of Bob's results,
+                    None to wait for the results of each batch
+        hash_fpr    the rate of false positives of hashed mode, None to
+                    compare the 32-bit floats themselves
+        session     the ID of the session to start or resume, None to keep
+                    no checkpoints
+        pool_size   the number of pre-garbled circuits held by the pool,
+                    None to garble the circuits when they are needed
+        pool_memory the maximum number of bytes of pre-garbled circuits kept
+                    in memory
+        pool_spill  the file the pre-garbled circuits beyond pool_memory are
+                    spilled to, None to hold fewer circuits instead
+        worker      the name of the worker pair, checked by Bob during the
+                    handshake, None for a single pair
+        endpoint    the endpoint of Bob's socket, None for the default one
+        metrics     the instrumentation.Metrics recording Alice's run, None
+                    to record nothing
     """
-    def __init__(self, vals, logger):
-        self.socket = util.GarblerSocket()
-        self.ot = ot.ObliviousTransfer(self.socket, logger, enabled=True)
-        self.vals = sorted(vals)
+    def __init__(self, vals, logger, batch_size=None, backend="fernet", group=None,
+                 ot_mode="base", ot_pool=None, bucketed=False, all_pairs=None, window=None,
+                 hash_fpr=None, session=None, pool_size=None,
+                 pool_memory=circuit_pool.MEMORY, pool_spill=None, worker=None, endpoint=None,
+                 metrics=None):
+        self.metrics = metrics or instrumentation.NO_METRICS
+        self.socket = util.GarblerSocket(endpoint, pipelined=window is not None,
+                                         metrics=metrics)
+        self.group = group
+        self.ot = ot.ObliviousTransfer(self.socket, logger, enabled=True,
+                                       group=util.load_group(group), mode=ot_mode,
+                                       pool_path=ot_pool, metrics=metrics)
+        self.hash_fpr = hash_fpr
+        self.vals = util.float_set(vals) if hash_fpr is None else hashing.element_set(vals)
         self.logger = logger
+        self.batch_size = batch_size
+        self.backend = backend
+        self.bucketed = bucketed
+        self.all_pairs = all_pairs
+        self.window = window
+        self.session = session
+        self.worker = worker
+        self.journal = None  # checkpoints of the session
+        self.ends = collections.deque()  # position after each batch sent, to resume from
+        if window is not None:
+            self.garbler = ThreadPoolExecutor(max_workers=1)
+            self.garbled = collections.deque()  # batches being garbled, in order
+            self.in_flight = collections.deque()  # batches sent, waiting for results
+        self.compiled = yao.load_circuit("circuits/eq32.json")
+        self.circuit = self.compiled.circuit
+        self.pool_options = None if pool_size is None else (pool_size, pool_memory, pool_spill)
+        self.pool = None  # pre-garbled circuits
+        if not (all_pairs or hash_fpr):
+            # the circuit is known: fill the pool while Bob connects
+            self._start_pool()
 
     """Send handshake message and wait for Bob to respond with the size of his set"""
     def setup(self):
-        self.logger.info("Waiting for Bob")
-        self.m = self.socket.send_wait(f"PSI") # size of Bob's set
-        self.logger.info(f"Alice has {len(self.vals)} values, Bob has {self.m} values")
-        self.logger.info("Starting PSI computation")
+        with self.metrics.phase("setup"):
+            self.logger.info("Waiting for Bob")
+            self.width = circuit_gen.BITS  # bits per compared value
+            self.hash_seed = None if self.hash_fpr is None else os.urandom(16)
+            if self.session is not None:
+                self.journal = checkpoint.Journal(checkpoint.journal_path(self.session, "alice"))
+                if self.hash_fpr and self.journal.header and self.journal.header["hash_seed"]:
+                    # the values of a resumed session are hashed as before
+                    self.hash_seed = bytes.fromhex(self.journal.header["hash_seed"])
+            self.m = self.socket.send_wait({ # size of Bob's set
+                "protocol": "PSI",
+                "batch_size": self.batch_size,
+                "backend": self.backend,
+                "group": self.group or self.ot.group.params(),
+                "ot_mode": self.ot.mode,
+                "bucketed": self.bucketed,
+                "all_pairs": self.all_pairs,
+                "window": self.window,
+                # Bob picks the same width of hashes from the sizes of the sets
+                "hash": None if self.hash_fpr is None else {
+                    "seed": self.hash_seed, "fpr": self.hash_fpr, "n": len(self.vals)},
+                # both parties generate the all-pairs and hashed mode circuits
+                # from the sizes of the sets
+                "circuit": None if self.all_pairs or self.hash_fpr else self.circuit,
+                # the last batch Alice recorded, Bob resuming from the last one
+                # recorded by both
+                "session": None if self.journal is None else {
+                    "id": self.session, "seq": self.journal.seq},
+                # Bob refuses the session if it is meant for another of his workers
+                "worker": self.worker,
+            })
+            if isinstance(self.m, tuple) and self.m[:1] == ("ERROR", ):
+                raise RuntimeError(f"Bob refused the session: {self.m[1]}")
+            resume = None
+            if self.journal is not None:
+                # Bob also sends the last batch recorded by both
+                self.m, resume = self.m
+            if self.hash_fpr:
+                self.width = hashing.hash_width(len(self.vals), self.m, self.hash_fpr)
+                self.circuit = circuit_gen.eq_circuit(self.width)
+                self.compiled = yao.CompiledCircuit(self.circuit)
+            if self.bucketed:
+                # Bob also sends the seed of the hash functions of his cuckoo table
+                self.m, self.seed = self.m
+                self.bins = hashing.num_bins(self.m)
+                self.bin_size = hashing.bin_size(len(self.vals), self.bins)
+                num_circuits = self.bins * self.bin_size
+            elif self.all_pairs:
+                self.circuit = circuit_gen.all_pairs_circuit(self.all_pairs, self.m, self.width)
+                self.compiled = yao.CompiledCircuit(self.circuit)
+                num_circuits = -(-len(self.vals) // self.all_pairs)
+            else:
+                num_circuits = len(self.vals) * self.m
+            # at most one OT per Bob's wire of each circuit
+            self.ot.setup_garbler(num_circuits * len(self.circuit.get("bob", [])))
+            self._start_pool()
+            if self.pool is not None:
+                self.pool.limit(num_circuits)  # don't garble more circuits than can be used
+            # the values compared, indexed by the batches, and their input bits,
+            # computed once
+            self.inputs = self.vals
+            self.input_bits = self._bits(self.inputs)
+            self._resume(resume)
+            self.logger.info(f"Alice has {len(self.vals)} values, Bob has {self.m} values")
+            if self.hash_fpr:
+                self.logger.info(f"Comparing {self.width}-bit hashes of the values")
+            self.logger.info("Starting PSI computation")
 
     """Run the PSI algorithm"""
     def run(self):
@@ -46,39 +203,62 @@ class Alice():
         (p-bits, keys and consequently the garbled tables are freshly
         generated each time, to avoid security flaws)
         """
-        circuit = util.parse_json("circuits/eq32.json")["circuits"][0]
-        matched = []
-        exclude = []
-        for i in tqdm(range(len(self.vals)), desc="Progress"):
-            for j in range(self.m):
+        if self.bucketed:
+            return self.run_bucketed()
+        if self.all_pairs:
+            return self.run_all_pairs()
+
+        circuit = self.circuit
+        matched, exclude = self.matched, self.exclude
+        batch = []
+        start = self.position or (0, 0)
+        for i in tqdm(range(start[0], len(self.vals)), desc="Progress"):
+            for j in range(start[1] if i == start[0] else 0, self.m):
                 # don't run Yao if one of the values is already in the intersection
                 if (self.vals[i] in matched) or (j in exclude):
                     continue
 
-                # create the circuit and populate the dict to send to Bob
-                garbled_circuit = yao.GarbledCircuit(circuit)
-                self.logger.circuit(str(garbled_circuit))
-                pbits = garbled_circuit.get_pbits()
-                entry = {
-                    "circuit": circuit,
-                    "garbled_circuit": garbled_circuit,
-                    "garbled_tables": garbled_circuit.get_garbled_tables(),
-                    "keys": garbled_circuit.get_keys(),
-                    "pbits": pbits,
-                    "pbits_out": {w: pbits[w]
-                              for w in circuit["out"]},
-                }
+                if self.batch_size:
+                    batch.append(([i], [j]))
+                    if len(batch) == self.batch_size:
+                        self.eval_batch(batch, matched, exclude, (i, j + 1))
+                        batch = []
+                    continue
 
+                if self.pool is not None:
+                    entry = self._pooled_entry()
+                    garbled_tables = entry["garbled_tables"]  # already packed
+                else:
+                    # create the circuit and populate the dict to send to Bob
+                    garbled_circuit = yao.GarbledCircuit(self.compiled, backend=self.backend,
+                                                         metrics=self.metrics)
+                    self.logger.circuit("%s", garbled_circuit)
+                    pbits = garbled_circuit.get_pbits()
+                    entry = {
+                        "circuit": circuit,
+                        "garbled_circuit": garbled_circuit,
+                        "garbled_tables": garbled_circuit.get_garbled_tables(),
+                        "keys": garbled_circuit.get_keys(),
+                        "pbits": pbits,
+                        "pbits_out": {w: pbits[w]
+                                  for w in circuit["out"]},
+                    }
+                    garbled_tables = entry["garbled_tables"]
+                if self.pool is None and issubclass(yao.BACKENDS[self.backend], yao.AESBackend):
+                    # fixed-size keys: send the tables as a single buffer
+                    with self.metrics.phase("serialize"):
+                        garbled_tables = yao.pack_tables(self.compiled, garbled_tables,
+                                                         self.backend)
+                # the circuit itself was sent once, in the handshake
                 to_send = {
                     "j": j, # index of the value which Bob should use to evaluate the circuit
-                    "circuit": entry["circuit"],
-                    "garbled_tables": entry["garbled_tables"],
+                    "garbled_tables": garbled_tables,
                     "pbits_out": entry["pbits_out"],
                 }
                 self.socket.send_wait(to_send)
 
                 # set Alice's bits to the ones of the value at index i in her set
-                bits_a = util.float_to_bit_list(self.vals[i])
+                bits_a = self.input_bits[i].tolist()
                 # send Alice's input bits' keys, make Bob evaluate the circuit and receive the result
                 res = self.eval_single(entry, bits_a)
 
@@ -86,9 +266,85 @@ class Alice():
                 match = bool(res[list(res.keys())[0]])
 
                 if match:
-                    matched.append(self.vals[i])
+                    matched.append(self.vals.item(i))
                     exclude.append(j)
+                self._checkpoint((i, j + 1), matched, exclude)
+
+        if batch:
+            self.eval_batch(batch, matched, exclude, (len(self.vals), 0))
+
+        return self._end(matched, exclude)
+
+    """Run the PSI algorithm comparing only the values stored in the same bin"""
+    def run_bucketed(self):
+        """
+        Every bin gets the same number of circuits, Alice's values being
+        padded with dummy values that can't be stored in the bin, hence
+        can't match Bob's value. One batch is sent per bin unless a batch
+        size is given.
+        """
+        table = hashing.simple_table(self.vals.tolist(), self.seed, self.bins)
+        index = {x: i for i, x in enumerate(self.vals.tolist())}
+        start = self.position or (0, 0)
+        # the indices of the values of each bin, the dummies being appended to
+        # Alice's values so that their bits are computed in a single pass too
+        slots, dummies = [], []
+        for b in range(start[0], self.bins):
+            if len(table[b]) > self.bin_size:
+                raise RuntimeError(f"Bin {b} overflows its {self.bin_size} slots")
+            padding = range(len(self.vals) + len(dummies),
+                            len(self.vals) + len(dummies) + self.bin_size - len(table[b]))
+            dummies.extend(hashing.dummy(b, self.seed, self.bins, hashing.DUMMY_TAGS["alice"])
+                           for _ in padding)
+            slots.append([index[x] for x in table[b]] + list(padding))
+        self.inputs = np.concatenate([self.vals, dummies])
+        self.input_bits = np.concatenate([self.input_bits, self._bits(dummies)])
+
+        matched, exclude = self.matched, self.exclude
+        batch = []
+        ends = []  # position after each slot of the batch
+        for b, slot in zip(tqdm(range(start[0], self.bins), desc="Progress"), slots):
+            first = start[1] if b == start[0] else 0
+            batch.extend(([i], [b]) for i in slot[first:])
+            ends.extend((b, t + 1) for t in range(first, self.bin_size))
+            batch_size = self.batch_size or len(batch)
+            while batch_size and len(batch) >= batch_size:
+                self.eval_batch(batch[:batch_size], matched, exclude, ends[batch_size - 1])
+                batch, ends = batch[batch_size:], ends[batch_size:]
+
+        if batch:
+            self.eval_batch(batch, matched, exclude, (self.bins, 0))
+
+        return self._end(matched, exclude)
 
+    """Run the PSI algorithm comparing blocks of Alice's values with all of Bob's values"""
+    def run_all_pairs(self):
+        """
+        The last block is padded with copies of its first value, so that all
+        circuits are the same. One batch is sent per circuit unless a batch
+        size is given.
+        """
+        k = self.all_pairs
+        matched, exclude = self.matched, self.exclude
+        batch = []
+        start = self.position or (0,)
+        for i in tqdm(range(start[0], len(self.vals), k), desc="Progress"):
+            block = list(range(i, min(i + k, len(self.vals))))
+            block += block[:1] * (k - len(block))
+            batch.append((block, list(range(self.m))))
+            if len(batch) == (self.batch_size or 1):
+                self.eval_batch(batch, matched, exclude, (i + k,))
+                batch = []
+
+        if batch:
+            self.eval_batch(batch, matched, exclude, (len(self.vals),))
+
+        return self._end(matched, exclude)
+
+    """Tell Bob that the computation is over and output the intersection"""
+    def _end(self, matched, exclude):
+        if self.window is not None:
+            self._flush(matched, exclude)
         self.logger.info("PSI computation ended")
         self.logger.minimal("{" + str(matched)[1:][:-1] + "}")
         self.socket.send_wait("OK") # tell Bob that the computation is over
@@ -96,25 +352,213 @@ class Alice():
             
     """Evaluate a circuit with the given values for Alice's bits"""
     def eval_single(self, entry, bits_a):
+        a_inputs, b_keys = self._encode_inputs(entry, bits_a)
+        result = self.ot.get_result(a_inputs, b_keys)
+        return result
+
+    """
+    Garble a circuit for each pair (ks, js) of the batch, ks being the
+    indices of Alice's inputs and js those of Bob's ones, send them to Bob in a single
+    message and record the pairs of values that are equal, end being the
+    position of the loop after the batch
+    """
+    def eval_batch(self, pairs, matched, exclude, end):
+        self.ends.append(end)
+        ks = [k for ks, _ in pairs for k in ks]
+        bits_a = self.input_bits[ks].reshape(len(pairs), -1)
+        if self.window is not None:
+            # garble this batch in the background while the previous one is sent
+            self.garbled.append((pairs, self.garbler.submit(self._garble, bits_a)))
+            if len(self.garbled) > 1:
+                self._send_batch(*self.garbled.popleft(), matched, exclude)
+            return
+
+        to_send, b_keys = self._garble(bits_a)
+        to_send["j"] = [js for _, js in pairs]
+        self._match(pairs, self.ot.get_result_batch(to_send, b_keys), matched, exclude)
+
+    """
+    Send a batch once garbled, then wait for the results of the oldest
+    batches in flight until at most window batches are ahead of Bob
+    """
+    def _send_batch(self, pairs, garbling, matched, exclude):
+        to_send, b_keys = garbling.result()
+        to_send["j"] = [js for _, js in pairs]
+        self.ot.send_batch(to_send, b_keys)
+        self.in_flight.append(pairs)
+        while len(self.in_flight) > self.window:
+            self._match(self.in_flight.popleft(), self.socket.receive_result(),
+                        matched, exclude)
+
+    """Send the remaining batches and wait for all their results"""
+    def _flush(self, matched, exclude):
+        while self.garbled:
+            self._send_batch(*self.garbled.popleft(), matched, exclude)
+        if self.in_flight:
+            self.socket.send("FLUSH")  # Bob holds the last batch until told it is the last
+            while self.in_flight:
+                self._match(self.in_flight.popleft(), self.socket.receive_result(),
+                            matched, exclude)
+        self.garbler.shutdown()
+
+    """Record the pairs of values of a batch that are equal, given Bob's packed results"""
+    def _match(self, pairs, packed, matched, exclude):
+        # one result bit per output wire of each circuit of the batch
+        n_out = len(self.circuit["out"])
+        res = util.unpack_bits(packed, len(pairs) * n_out)
+        for k, (ks, js) in enumerate(pairs):
+            # one output per pair of values, row by row
+            out = res[k * n_out:(k + 1) * n_out]
+            for i, x in enumerate(self.inputs[ks].tolist()):
+                for l, j in enumerate(js):
+                    if out[i * len(js) + l] and x not in matched:
+                        matched.append(x)
+                        exclude.append(j)
+        self._checkpoint(self.ends.popleft(), matched, exclude)
+
+    """
+    Start the journal of the session from the last batch recorded by both
+    parties, and restore the intersection found so far and the position of
+    the loop to resume from
+    """
+    def _resume(self, seq):
+        self.matched, self.exclude, self.position = [], [], None
+        if self.journal is None:
+            return
+        records = self.journal.start({
+            "n": len(self.vals),
+            "m": self.m,
+            "batch_size": self.batch_size,
+            "bucketed": self.bucketed,
+            "all_pairs": self.all_pairs,
+            "hash_seed": self.hash_seed and self.hash_seed.hex(),
+        }, seq)
+        for record in records:
+            self.matched += record["matched"]
+            self.exclude += record["exclude"]
+            self.position = tuple(record["position"])
+        self.saved = (len(self.matched), len(self.exclude))
+        if records:
+            self.logger.info(f"Resuming session {self.session} after {len(records)} batches")
+
+    """Record the position after a completed batch and the values it matched"""
+    def _checkpoint(self, position, matched, exclude):
+        if self.journal is None:
+            return
+        m, e = self.saved
+        self.journal.record(position=position, matched=matched[m:], exclude=exclude[e:])
+        self.saved = (len(matched), len(exclude))
+
+    """Flush and close the journal of the session, and wipe the pre-garbled circuits left"""
+    def close(self):
+        if self.journal is not None:
+            self.journal.close()
+        if self.pool is not None:
+            self.pool.close()
+
+    """Start garbling copies of the circuit in the background, if a circuit pool is used"""
+    def _start_pool(self):
+        if self.pool_options is None or self.pool is not None:
+            return
+        capacity, memory, spill_path = self.pool_options
+        self.pool = circuit_pool.GarbledCircuitPool(self.compiled, self.backend, capacity,
+                                                    memory, spill_path, metrics=self.metrics)
+
+    """Take a pre-garbled circuit from the pool, as an entry to evaluate in single mode"""
+    def _pooled_entry(self):
+        record = self.pool.take(1)[0]
+        compiled, R = self.compiled, record["R"]
+        self.logger.circuit("Pre-garbled %s taken from the pool", compiled.id)
+        wires = [compiled.wires[k] for k in compiled.alice + compiled.bob]
+        return {
+            "circuit": self.circuit,
+            "garbled_tables": record["tables"].tobytes(),
+            "keys": {w: (key0.tobytes(), (key0 ^ R).tobytes())
+                     for w, key0 in zip(wires, record["keys"])},
+            "pbits": {w: int(key0[-1] & 1) for w, key0 in zip(wires, record["keys"])},
+            "pbits_out": {compiled.wires[k]: int(p)
+                          for k, p in zip(compiled.out, record["pbits_out"])},
+        }
+
+    """
+    Garble a copy of the circuit for each list of Alice's input bits, all at
+    once when the backend has fixed-size keys, or take them from the circuit
+    pool, and return the garbled tables, p-bits of outputs and Alice's inputs
+    to send, along with the pairs of keys of Bob's wires of each copy
+    """
+    def _garble(self, bits_a):
+        size = len(bits_a)
+        if issubclass(yao.BACKENDS[self.backend], yao.AESBackend):
+            if self.pool is not None:
+                records = self.pool.take(size)
+                self.logger.circuit("%d pre-garbled %s taken from the pool", size, self.compiled.id)
+            else:
+                garbled_batch = yao.GarbledCircuitBatch(self.compiled, size, self.backend,
+                                                        metrics=self.metrics)
+                self.logger.circuit("%s", garbled_batch)
+                records = circuit_pool.records(garbled_batch)
+            compiled, R = self.compiled, records["R"][:, None]
+            # arrays with a row per copy, each sent as a single buffer
+            bits = np.array(bits_a, np.uint8).reshape(size, len(compiled.alice))
+            n_a = len(compiled.alice)  # Alice's keys come first in the records
+            a_keys = records["keys"][:, :n_a] ^ (bits[..., None] * R)
+            b_keys0 = records["keys"][:, n_a:]
+            b_keys1 = b_keys0 ^ R
+            b_wires = self.circuit.get("bob", [])
+            b_keys = [{w: ((key0.tobytes(), int(key0[-1] & 1)), (key1.tobytes(), int(key1[-1] & 1)))
+                       for w, key0, key1 in zip(b_wires, keys0, keys1)}
+                      for keys0, keys1 in zip(b_keys0, b_keys1)]
+            to_send = {
+                "garbled_tables": records["tables"],
+                "pbits_out": records["pbits_out"],
+                "a_inputs": a_keys,
+            }
+            return to_send, b_keys
+
+        to_send = {"garbled_tables": [], "pbits_out": [], "a_inputs": []}
+        b_keys = []
+        for bits in bits_a:
+            garbled_circuit = yao.GarbledCircuit(self.compiled, backend=self.backend,
+                                                 metrics=self.metrics)
+            self.logger.circuit("%s", garbled_circuit)
+            pbits = garbled_circuit.get_pbits()
+            entry = {
+                "circuit": self.circuit,
+                "keys": garbled_circuit.get_keys(),
+                "pbits": pbits,
+            }
+            a_inputs, b_keys_k = self._encode_inputs(entry, bits)
+            to_send["garbled_tables"].append(garbled_circuit.get_garbled_tables())
+            to_send["pbits_out"].append({w: pbits[w] for w in self.circuit["out"]})
+            to_send["a_inputs"].append(a_inputs)
+            b_keys.append(b_keys_k)
+        return to_send, b_keys
+
+    """Map Alice's bits to her input keys and Bob's wires to their pair of keys"""
+    def _encode_inputs(self, entry, bits_a):
         circuit, pbits, keys = entry["circuit"], entry["pbits"], entry["keys"]
-        outputs = circuit["out"]
         a_wires = circuit.get("alice", [])  # Alice's wires
         a_inputs = {}  # map from Alice's wires to (key, encr_bit) inputs
         b_wires = circuit.get("bob", [])  # Bob's wires
         b_keys = {  # map from Bob's wires to a pair (key, encr_bit)
-            w: self._get_encr_bits(pbits[w], key0, key1)
-            for w, (key0, key1) in keys.items() if w in b_wires
+            w: self._get_encr_bits(pbits[w], *keys[w])
+            for w in b_wires
         }
 
         for i in range(len(a_wires)):
             a_inputs[a_wires[i]] = (keys[a_wires[i]][bits_a[i]],
                                     pbits[a_wires[i]] ^ bits_a[i])
-        result = self.ot.get_result(a_inputs, b_keys)
-        return result
+        return a_inputs, b_keys
 
     def _get_encr_bits(self, pbit, key0, key1):
         return ((key0, 0 ^ pbit), (key1, 1 ^ pbit))
 
+    """Return the input bits of each value: its binary32 representation, or its hash in hashed mode"""
+    def _bits(self, xs):
+        if self.hash_fpr:
+            return hashing.hash_bits(xs, self.hash_seed, self.width)
+        return util.float_bits(xs)
+
 
 class Bob:
     """
@@ -124,15 +568,29 @@ class Bob:
     Attributes:
         socket  Bob's socket
         ot      Bob's side OT
-        vals    a list containing the values in Bob's set
+        vals    an array containing the values in Bob's set, sorted once the
+                handshake tells whether they are hashed
+        inputs  a list containing the values that Alice's indices refer to:
+                the values in Bob's set, or his cuckoo table in bucketed mode
         matched a list that will store the values that are in the intersection
+        journal the checkpoints of the session started by Alice, if any
+        worker  the name of the worker pair, None for a single pair
+        ot_pool the directory storing Bob's precomputed random OTs, None to
+                keep them in memory
+        endpoint the endpoint to bind Bob's socket to, None for the default one
+        metrics the instrumentation.Metrics recording Bob's run, None to
+                record nothing
     """
-    def __init__(self, vals, logger):
-        self.socket = util.EvaluatorSocket()
-        self.ot = ot.ObliviousTransfer(self.socket, logger, enabled=True)
-        self.vals = sorted(vals)
+    def __init__(self, vals, logger, ot_pool=None, worker=None, endpoint=None, metrics=None):
+        self.metrics = metrics or instrumentation.NO_METRICS
+        self.socket = util.EvaluatorSocket(endpoint, metrics=metrics)
+        self.ot = ot.ObliviousTransfer(self.socket, logger, enabled=True,
+                                       pool_path=ot_pool, metrics=metrics)
+        self.vals = vals
         self.logger = logger
         self.matched = []
+        self.journal = None
+        self.worker = worker
 
     """
     Wait for the handshake message and respond with the size of Bob's set.
@@ -142,13 +600,69 @@ class Bob:
         try:
             self.logger.info(f"Waiting for Alice")
             m = self.socket.receive()
-            if m == "PSI":
+            while isinstance(m, dict) and m.get("protocol") == "PSI" and m.get("worker") != self.worker:
+                # e.g. the ports of two evaluator nodes overlap: refuse and keep waiting
+                error = f"Alice's worker {m.get('worker')} reached Bob's worker {self.worker}"
+                self.logger.info(error)
+                self.socket.send(("ERROR", error))
+                m = self.socket.receive()
+            if isinstance(m, dict) and m.get("protocol") == "PSI":
+                self.socket.lock()  # refuse the messages of any other Alice
                 self.logger.info(f"Starting PSI computation")
-                self.socket.send(len(self.vals))
+                with self.metrics.phase("setup"):
+                    self.hash = m["hash"]
+                    self.width = circuit_gen.BITS
+                    if self.hash:
+                        self.vals = hashing.element_set(self.vals)
+                        self.width = hashing.hash_width(self.hash["n"], len(self.vals),
+                                                        self.hash["fpr"])
+                    else:
+                        self.vals = util.float_set(self.vals)
+                    if m["all_pairs"]:
+                        self.circuit = circuit_gen.all_pairs_circuit(m["all_pairs"], len(self.vals),
+                                                                     self.width)
+                    elif self.hash:
+                        self.circuit = circuit_gen.eq_circuit(self.width)
+                    else:
+                        self.circuit = m["circuit"]
+                    self.compiled = yao.CompiledCircuit(self.circuit)
+                    self.backend = m["backend"]
+                    self.ot.group = util.load_group(m["group"])
+                    self.ot.mode = m["ot_mode"]
+                    batched = m["batch_size"] is not None or m["bucketed"] or m["all_pairs"]
+                    pipelined = m["window"] is not None
+                    session = m["session"]
+                    if session:
+                        self.journal = checkpoint.Journal(checkpoint.journal_path(session["id"], "bob"))
+                    seed = None
+                    if m["bucketed"]:
+                        seed, table = hashing.build_cuckoo_table(self.vals, self._session_seed())
+                        # fill the empty bins with values that can't match Alice's ones
+                        tag = hashing.DUMMY_TAGS["bob"]
+                        self.inputs = np.array([hashing.dummy(b, seed, len(table), tag) if x is None else x
+                                                for b, x in enumerate(table)])
+                        reply = (len(self.vals), seed)
+                    else:
+                        self.inputs = self.vals
+                        reply = len(self.vals)
+                    if session:
+                        reply = (reply, self._resume(session, seed))
+                    self.socket.send(reply)
+                    self.input_bits = self._bits(self.inputs)  # input bits of each value
+                    self.ot.setup_evaluator()
                 m = self.socket.receive()
+                pending = None  # batch evaluated while the keys of the next one are transferred
                 while m != "OK":
-                    self.socket.send(True)
-                    self.eval_single(m)
+                    if m == "FLUSH":
+                        self._eval_pending(pending)
+                        pending = None
+                    elif pipelined:
+                        pending = self.eval_batch_pipelined(m, pending)
+                    elif batched:
+                        self.eval_batch(m)
+                    else:
+                        self.socket.send(True)
+                        self.eval_single(m)
                     m = self.socket.receive()
                 self.socket.send(True)
                 self.logger.info("PSI computation ended")
@@ -158,52 +672,322 @@ class Bob:
                 raise RuntimeError(f"Unrecognized message {m}")
         except KeyboardInterrupt:
             self.logger.info("Aborted")
+        finally:
+            if self.journal is not None:
+                self.journal.close()
+
+    """Return the seed of the cuckoo table of a resumed session, None for a new one"""
+    def _session_seed(self):
+        if self.journal is not None and self.journal.header and self.journal.header["seed"]:
+            return bytes.fromhex(self.journal.header["seed"])
+        return None
+
+    """
+    Start the journal of the session from the last batch recorded by both
+    parties, given the last one recorded by Alice, restore the intersection
+    found so far and return the batch to resume after
+    """
+    def _resume(self, session, seed):
+        seq = min(session["seq"], self.journal.seq)
+        records = self.journal.start({"n": len(self.vals), "seed": seed and seed.hex()}, seq)
+        self.matched = [x for record in records for x in record["matched"]]
+        self.saved = len(self.matched)
+        if records:
+            self.logger.info(f"Resuming session {session['id']} after {len(records)} batches")
+        return seq
+
+    """Record the values matched by a completed batch"""
+    def _checkpoint(self):
+        if self.journal is not None:
+            self.journal.record(matched=self.matched[self.saved:])
+            self.saved = len(self.matched)
 
     """
     Evaluate a circuit setting Bob's bits to the ones corresponding to
     the value at the requested index in Bob's set
     """
     def eval_single(self, entry):
-        circuit, pbits_out = entry["circuit"], entry["pbits_out"]
+        circuit, pbits_out = self.circuit, entry["pbits_out"]
         garbled_tables = entry["garbled_tables"]
         a_wires = circuit.get("alice", [])  # list of Alice's wires
         b_wires = circuit.get("bob", [])  # list of Bob's wires
 
-        bits_b = util.float_to_bit_list(self.vals[entry["j"]])
+        bits_b = self.input_bits[entry["j"]].tolist()
         b_inputs_clear = {
             b_wires[i]: bits_b[i]
             for i in range(len(b_wires))
         }
 
-        res = self.ot.send_result(circuit, garbled_tables, pbits_out, b_inputs_clear)
+        res = self.ot.send_result(self.compiled, garbled_tables, pbits_out,
+                                  b_inputs_clear, self.backend)
         res = bool(list(res.values())[0])
         if res:
-            self.matched.append(self.vals[entry["j"]])
+            self.matched.append(self.inputs.item(entry["j"]))
+        self._checkpoint()
+
+    """
+    Evaluate a batch of circuits, setting Bob's bits of each circuit to the
+    ones corresponding to the values at the requested indices in Bob's set
+    """
+    def eval_batch(self, batch):
+        b_inputs_clear = self._inputs_batch(batch)
+        results = self.ot.send_result_batch(self.compiled, batch, b_inputs_clear,
+                                            self.backend)
+        self._match_batch(batch, results)
+
+    """
+    Retrieve the keys of a batch of circuits, evaluating the pending batch
+    and sending its results meanwhile, and return the batch to evaluate next
+    """
+    def eval_batch_pipelined(self, batch, pending):
+        b_inputs_clear = self._inputs_batch(batch)
+        keys = self.ot.receive_keys_batch(b_inputs_clear,
+                                          overlap=lambda: self._eval_pending(pending))
+        return batch, b_inputs_clear, keys
 
+    """Evaluate a batch whose keys were retrieved, sending its tagged results"""
+    def _eval_pending(self, pending):
+        if pending is None:
+            return
+        batch, b_inputs_clear, keys = pending
+        results = self.ot.evaluate_batch(self.compiled, batch, b_inputs_clear, keys,
+                                         self.backend, tagged=True)
+        self._match_batch(batch, results)
 
-def psi(party, vals, output_mode):
+    """Map Bob's wires of each circuit of a batch to the bits of the requested values"""
+    def _inputs_batch(self, batch):
+        b_wires = self.circuit.get("bob", [])  # list of Bob's wires
+        b_inputs_clear = []
+        for js in batch["j"]:
+            bits_b = self.input_bits[js].ravel().tolist()
+            b_inputs_clear.append({
+                b_wires[i]: bits_b[i]
+                for i in range(len(b_wires))
+            })
+        return b_inputs_clear
+
+    """Return the input bits of each value: its binary32 representation, or its hash in hashed mode"""
+    def _bits(self, xs):
+        if self.hash:
+            return hashing.hash_bits(xs, self.hash["seed"], self.width)
+        return util.float_bits(xs)
+
+    """Record the values of a batch that are in the intersection"""
+    def _match_batch(self, batch, results):
+        out = self.circuit["out"]
+        for js, res in zip(batch["j"], results):
+            # one output per pair of values, row by row
+            bits = [res[w] for w in out]
+            for l, j in enumerate(js):
+                if any(bits[l::len(js)]):
+                    self.matched.append(self.inputs.item(j))
+        self._checkpoint()
+
+
+def psi(party, vals, output_mode, batch_size=None, backend="fernet", group=None,
+        ot_mode="base", ot_pool=None, bucketed=False, all_pairs=None, window=None,
+        workers=1, evaluators=None, node=None, tcp=False, metrics_path=None, profile_path=None,
+        trace_format="text", hash_fpr=None, session=None, pool_size=None,
+        pool_memory=circuit_pool.MEMORY, pool_spill=None):
+
+    if bucketed and all_pairs:
+        raise RuntimeError("Bucketed and all-pairs modes can't be used together")
+    if ot_mode in ("iknp", "pool") and not (batch_size or bucketed or all_pairs):
+        raise RuntimeError(f"{ot_mode} OTs transfer the keys of whole batches, use them along with a batch size, e.g. -B 100")
+    if window is not None and not (batch_size or bucketed or all_pairs):
+        raise RuntimeError("Pipelining sends batches ahead of the results, use it along with a batch size, e.g. -B 100")
+    if window is not None and window < 1:
+        raise RuntimeError("The window must hold at least one batch")
+    if hash_fpr is not None and bucketed:
+        raise RuntimeError("Bucketed mode hashes the 32-bit floats themselves, it can't be used along with hashed mode")
+    if hash_fpr is not None and not 0 < hash_fpr < 1:
+        raise RuntimeError("The false-positive rate must be between 0 and 1")
+    if session is not None:
+        checkpoint.journal_path(session, party)  # check the session ID
+    if pool_size is not None and not isinstance(yao.get_backend(backend), yao.AESBackend):
+        raise RuntimeError("The circuit pool holds circuits of fixed-size keys, use it along with -g aes or -g halfgates")
+    if pool_size is not None and pool_size < 1:
+        raise RuntimeError("The circuit pool must hold at least one circuit")
+    if workers < 1:
+        raise RuntimeError("At least one worker is needed")
+    if node is not None and not (evaluators and 0 <= node < len(evaluators)):
+        raise RuntimeError("The node must be the index of one of the --evaluators")
+    for (k, (host_k, port_k)), (l, (host_l, port_l)) in itertools.combinations(enumerate(evaluators or []), 2):
+        # node k listens on ports port_k to port_k + workers - 1, on its host,
+        # or on this machine if Bob serves all the nodes
+        same_machine = host_k == host_l or (party != "alice" and node is None)
+        if same_machine and abs(port_k - port_l) < workers:
+            raise RuntimeError(f"The ports of evaluator nodes {k} ({port_k}-{port_k + workers - 1}) "
+                               f"and {l} ({port_l}-{port_l + workers - 1}) overlap, space them "
+                               f"at least {workers} apart")
 
     if output_mode == "minimal":
         global tqdm
         tqdm = _id
 
-    def run_alice(vals, logger):
-        alice = Alice(vals, logger)
-        alice.setup()
-        return alice.run()
+    def output_path(path, logger, name):
+        """Insert the party (in test mode) and worker names before the extension of a path."""
+        parts = ([logger.party.lower()] if party == "test" else []) + ([name] if name else [])
+        root, ext = os.path.splitext(path)
+        return ".".join([root] + parts) + ext
+
+    def instrumented(run, logger, name):
+        """Run a party, recording its metrics and profiling it if asked to."""
+        metrics = instrumentation.Metrics(logger.party.lower()) if metrics_path else None
+        profiler = cProfile.Profile() if profile_path else None
+        if profiler:
+            profiler.enable()
+        try:
+            return run(metrics)
+        finally:
+            logger.close()
+            if profiler:
+                profiler.disable()
+                profiler.dump_stats(output_path(profile_path, logger, name))
+            if metrics:
+                metrics.export(output_path(metrics_path, logger, name))
+
+    def run_alice_worker(vals, logger, ot_pool=ot_pool, endpoint=None, name=None):
+        def run(metrics):
+            alice = Alice(vals, logger, batch_size=batch_size, backend=backend,
+                          group=group, ot_mode=ot_mode, ot_pool=ot_pool,
+                          bucketed=bucketed, all_pairs=all_pairs, window=window, hash_fpr=hash_fpr,
+                          # each worker pair has its own session
+                          session=session and ".".join([session] + ([name] if name else [])),
+                          # each worker has its own pool
+                          pool_size=pool_size, pool_memory=pool_memory,
+                          pool_spill=pool_spill and output_path(pool_spill, logger, name),
+                          worker=name, endpoint=endpoint, metrics=metrics)
+            try:
+                alice.setup()
+                return alice.run()
+            finally:
+                alice.close()
+        return instrumented(run, logger, name)
+
+    def run_bob_worker(vals, logger, ot_pool=ot_pool, endpoint=None, name=None):
+        def run(metrics):
+            bob = Bob(vals, logger, ot_pool=ot_pool, worker=name, endpoint=endpoint,
+                      metrics=metrics)
+            return bob.listen()
+        return instrumented(run, logger, name)
+
+    def run_workers(run, tasks, logger, ot_pool, peer=None):
+        """
+        Run a party on a process per task (name, values, endpoint), each
+        worker pair communicating on its own endpoint, and merge the
+        intersections they found. If a worker fails, or the peer process
+        running the other party in test mode, the other workers are
+        terminated and a RuntimeError is raised.
+        """
+        if len(tasks) == 1 and peer is None:
+            return run(tasks[0][1], logger, ot_pool, tasks[0][2])
+        results = Queue()
+
+        def work(name, vals, endpoint):
+            if len(tasks) == 1:  # a single worker, in a process of its own to watch the peer
+                worker_logger, pool, worker = logger, ot_pool, None
+            else:
+                worker_logger = util.Logger(logger.party, output_mode,
+                                            prepend=f"{logger.pre}[{name}] ", partial=True,
+                                            name=name, trace_format=trace_format)
+                # each worker keeps its own random OTs
+                pool = None if ot_pool is None else os.path.join(ot_pool, name)
+                worker = name
+            try:
+                results.put((name, run(vals, worker_logger, pool, endpoint, worker) or [], None))
+            except Exception as e:
+                results.put((name, None, f"{type(e).__name__}: {e}"))
+                raise
+
+        processes = {task[0]: Process(target=work, args=task) for task in tasks}
+        for process in processes.values():
+            process.start()
+        matched = []
+        try:
+            while len(matched) < len(processes):
+                try:
+                    name, result, error = results.get(timeout=WORKER_POLL)
+                except queue.Empty:
+                    # a worker that exited normally has put its result
+                    for name, process in processes.items():
+                        if process.exitcode not in (None, 0):
+                            raise RuntimeError(f"Worker {name} exited with code {process.exitcode}")
+                    if peer is not None and peer.exitcode not in (None, 0):
+                        raise RuntimeError(f"The other party exited with code {peer.exitcode}")
+                    continue
+                if error is not None:
+                    raise RuntimeError(f"Worker {name} failed: {error}")
+                matched.append(result)
+        finally:
+            for process in processes.values():
+                if process.exitcode is None and len(matched) < len(processes):
+                    process.terminate()
+                process.join()
+        matched = sorted(x for result in matched for x in result)
+        if len(tasks) > 1:
+            logger.minimal("{" + str(matched)[1:][:-1] + "}")
+        return matched
 
-    def run_bob(vals, logger):
-        bob = Bob(vals, logger)
-        return bob.listen()
+    # the sorted distinct values of a set
+    elements = util.float_set if hash_fpr is None else hashing.element_set
+
+    # Bob's sorted values are split among the evaluator nodes, each running
+    # its workers on the ports following its own
+    nodes = evaluators or [(util.SERVER_HOST, util.SERVER_PORT)]
+    name = lambda k, w: f"{k}.{w}" if len(nodes) > 1 else str(w)
+
+    def run_alice(vals, logger, ot_pool=ot_pool, peer=None):
+        # Alice's values are dealt to the workers, each comparing them with
+        # the values of every node
+        vals = elements(vals)
+        return run_workers(run_alice_worker, [
+            (name(k, w), vals[w::workers], util.garbler_endpoint(w, host, port))
+            for k, (host, port) in enumerate(nodes) for w in range(workers)
+        ], logger, ot_pool, peer)
+
+    def run_bob(vals, logger, ot_pool=ot_pool, child=False):
+        if child:
+            # terminated by Alice's process if she fails: terminate the workers too
+            signal.signal(signal.SIGTERM, lambda *_: sys.exit(1))
+        vals = elements(vals)
+        shards = [vals[len(vals) * k // len(nodes):len(vals) * (k + 1) // len(nodes)]
+                  for k in range(len(nodes))]
+        ports = [port if evaluators else util.LOCAL_PORT for _, port in nodes]
+        return run_workers(run_bob_worker, [
+            (name(k, w), shards[k], util.evaluator_endpoint(w, ports[k]))
+            for k in range(len(nodes)) if node is None or k == node for w in range(workers)
+        ], logger, ot_pool)
 
     def run_test(vals, logger_a, logger_b, logger):
         if len(vals) != 2:
             raise RuntimeError("You need to specify both sets when using test mode, e.g. python3.8 psi.py \"{1.2,2.5}\" \"{1.2,4.3}\"")
-        bob = Process(target=run_bob, args=(vals[1], logger_b))
-        e = bob.start()
-        result = run_alice(vals[0], logger_a)
-        v = bob.join()
-        intersection = sorted([a for a in vals[0] if a in vals[1]])
+        # each party keeps its own random OTs
+        pool_a, pool_b = (None, None) if ot_pool is None else \
+            (os.path.join(ot_pool, "alice"), os.path.join(ot_pool, "bob"))
+        if tcp or workers > 1 or evaluators:
+            bob = Process(target=run_bob, args=(vals[1], logger_b, pool_b, True))
+            bob.start()
+            try:
+                result = run_alice(vals[0], logger_a, pool_a, peer=bob)
+            except BaseException:
+                bob.terminate()
+                raise
+            finally:
+                bob.join()
+        else:
+            # both parties in this process, talking over an in-memory channel
+            endpoint = util.MEMORY_SCHEME + "psi"
+            bob = threading.Thread(target=run_bob_worker, args=(vals[1], logger_b, pool_b, endpoint),
+                                   daemon=True)  # not left waiting if Alice fails
+            bob.start()
+            result = run_alice_worker(vals[0], logger_a, pool_a, endpoint)
+            bob.join()
+        if hash_fpr is None:
+            intersection = np.intersect1d(util.float_set(vals[0]), util.float_set(vals[1])).tolist()
+        else:
+            keys_b = set(map(hashing.element_bytes, vals[1]))
+            intersection = [x for x in elements(vals[0]) if hashing.element_bytes(x) in keys_b]
         logger.info(f"Result computed without using Yao's protocol: {'{' + str(intersection)[1:][:-1] + '}'}")
         if set(result) == set(intersection):
             logger.info("Result is correct!")
@@ -211,13 +995,13 @@ def psi(party, vals, output_mode):
             logger.info("Result is wrong!")
 
     if party == "alice":
-        run_alice(vals[0], util.Logger("Alice", output_mode))
+        run_alice(vals[0], util.Logger("Alice", output_mode, trace_format=trace_format))
     elif party == "bob":
-        run_bob(vals[0], util.Logger("Bob", output_mode))
+        run_bob(vals[0], util.Logger("Bob", output_mode, trace_format=trace_format))
     elif party == "test":
         run_test(vals, 
-            util.Logger("Alice", output_mode, prepend="[Alice] "), 
-            util.Logger("Bob", output_mode, prepend="[Bob] "),
+            util.Logger("Alice", output_mode, prepend="[Alice] ", trace_format=trace_format),
+            util.Logger("Bob", output_mode, prepend="[Bob] ", trace_format=trace_format),
             util.Logger("test", output_mode, prepend="[-] ")
         )
     else:
@@ -226,6 +1010,7 @@ def psi(party, vals, output_mode):
 
 if __name__ == '__main__':
     import argparse
+    import math
 
     def init():
         output_modes = ["minimal", "info", "full"]
@@ -245,8 +1030,10 @@ if __name__ == '__main__':
             help="the party's set enclosed in braces and quotation marks\n" +
                  "e.g. \"{1.21, 10.88, 12.66e4, math.pi}\"\n" +
                  "if you are using test mode you need to specify two sets separated by a space\n" +
-                 "e.g. \"{1.3, 10.8}\" \"{8.4, 2.22}\"",
-            type=util.parse_float_set,
+                 "e.g. \"{1.3, 10.8}\" \"{8.4, 2.22}\"\n" +
+                 "or the path of a file of values separated by newlines or commas (e.g. CSV),\n" +
+                 f"or of raw little-endian float32 values if it ends with {' or '.join(util.RAW_EXTENSIONS)}",
+            type=str,
             nargs="*"
         )
         parser.add_argument("-o", 
@@ -256,11 +1043,196 @@ if __name__ == '__main__':
             help="the output mode:\n" + 
                  "\tminimal\t only prints the result followed by \\n\n" + 
                  "\tinfo\t shows additional information about what the party is doing and a progress bar (default)\n" + 
-                 "\tfull\t also outputs information about the OT in the files ot_Alice.txt, ot_Bob.txt and the garbled tables in tables.txt in the output folder\n"
+                 "\tfull\t also outputs information about the OT in the files ot_Alice.txt, ot_Bob.txt and the garbled tables in tables.txt in the output folder\n" +
+                 "\t\t (ot_Alice.0.txt, ... per worker; .trace files with --trace-format binary)\n"
+        )
+        parser.add_argument("-B", "--batch-size",
+            dest="batch_size",
+            type=int,
+            default=None,
+            help="send the garbled circuits in batches of the given size,\n" +
+                 "each batch in a single message along with batched OTs of Bob's keys\n" +
+                 "(default: one circuit at a time, one OT per Bob's wire)"
+        )
+        parser.add_argument("-g", "--garbling",
+            dest="backend",
+            choices=list(yao.BACKENDS),
+            default="fernet",
+            help="the garbling backend:\n" +
+                 "\tfernet\t encrypts each table row with nested Fernet tokens (default)\n" +
+                 "\taes\t uses 16-byte keys and a fixed-key AES hash\n" +
+                 "\thalfgates\t like aes, with two-ciphertext tables for AND-like gates (half-gates)"
+        )
+        parser.add_argument("--group",
+            dest="group",
+            choices=list(util.STANDARD_GROUPS),
+            default=None,
+            help="the standard group (RFC 3526) used by the OTs\n" +
+                 f"(default: a random {util.PRIME_BITS}-bit group generated once per session)"
+        )
+        parser.add_argument("--ot",
+            dest="ot_mode",
+            choices=ot.OT_MODES,
+            default="base",
+            help="how Bob's keys of a batch are transferred:\n" +
+                 "\tbase\t one public-key OT per key (default)\n" +
+                 f"\tiknp\t IKNP OT extension of {ot.SECURITY_PARAM} public-key OTs run once per session\n" +
+                 f"\tpool\t up to {ot.POOL_SIZE} random OTs precomputed during setup, refilled when\n" +
+                 "\t\t they run short, a single correction per key online"
+        )
+        parser.add_argument("--bucketed",
+            dest="bucketed",
+            action="store_true",
+            help="only compare the values hashed to the same bin (cuckoo hashing),\n" +
+                 "about n*log(n) circuits instead of n*m, sent one bin per batch by default"
+        )
+        parser.add_argument("--all-pairs",
+            dest="all_pairs",
+            type=int,
+            default=None,
+            metavar="K",
+            help="compare K of Alice's values with all of Bob's values per circuit,\n" +
+                 "transferring the keys of each value once per circuit (32*m OTs per circuit)"
+        )
+        parser.add_argument("--ot-pool",
+            dest="ot_pool",
+            default=None,
+            help="the directory storing the party's precomputed random OTs with --ot pool,\n" +
+                 "so that the unused ones are kept for the next session (default: in memory)"
+        )
+        parser.add_argument("--window",
+            dest="window",
+            type=int,
+            default=None,
+            metavar="W",
+            help="pipeline the batches: Alice garbles the next batch while the previous ones\n" +
+                 "are evaluated, and sends up to W batches ahead of Bob's results\n" +
+                 "(default: wait for the results of each batch)"
+        )
+        parser.add_argument("--hash",
+            dest="hash_fpr",
+            type=float,
+            nargs="?",
+            const=hashing.HASH_FPR,
+            default=None,
+            metavar="FPR",
+            help="compare keyed hashes of the elements, which may be ints, floats or strings,\n" +
+                 "using the narrowest eq circuit keeping the rate of false positives below\n" +
+                 f"FPR (default: 2^{round(math.log2(hashing.HASH_FPR))}); per pair of workers, not with --bucketed"
+        )
+        parser.add_argument("--session",
+            dest="session",
+            default=None,
+            metavar="ID",
+            help="record checkpoints of the session in the output folder after each batch,\n" +
+                 "and resume the session ID if it was interrupted, e.g. by a crash of either\n" +
+                 "party: run both parties again, Alice with the same options"
+        )
+        parser.add_argument("--pool",
+            dest="pool_size",
+            type=int,
+            default=None,
+            metavar="N",
+            help="with -g aes or halfgates, Alice garbles up to N circuits in the background,\n" +
+                 "starting before Bob connects, so that sending them only takes picking her keys;\n" +
+                 "circuits are used once and wiped from the pool (default: garble them when needed)"
+        )
+        parser.add_argument("--pool-memory",
+            dest="pool_memory",
+            type=int,
+            default=circuit_pool.MEMORY,
+            metavar="BYTES",
+            help=f"the maximum memory held by the circuit pool of each worker (default: {circuit_pool.MEMORY >> 20} MiB)"
+        )
+        parser.add_argument("--pool-spill",
+            dest="pool_spill",
+            default=None,
+            metavar="FILE",
+            help="spill the circuits of the pool beyond --pool-memory to the memory-mapped FILE,\n" +
+                 "deleted at the end of the session (default: hold fewer circuits; names added as\n" +
+                 "for --metrics)"
+        )
+        parser.add_argument("--workers",
+            dest="workers",
+            type=int,
+            default=1,
+            metavar="N",
+            help="run the party on N processes, Alice's values being dealt to them,\n" +
+                 f"worker w using port {util.LOCAL_PORT}+w; both parties need the same N (default: 1)"
+        )
+        parser.add_argument("--evaluators",
+            dest="evaluators",
+            type=util.parse_addresses,
+            default=None,
+            metavar="HOST:PORT,...",
+            help="split Bob's sorted set among several evaluator nodes, in this order:\n" +
+                 "Alice runs a session with each node concurrently, Bob serves every\n" +
+                 "node from this machine unless --node is given (default: a single Bob);\n" +
+                 "node k uses the ports PORT_k to PORT_k+N-1 with --workers N, which must not\n" +
+                 "overlap those of the other nodes of its machine"
+        )
+        parser.add_argument("--node",
+            dest="node",
+            type=int,
+            default=None,
+            metavar="K",
+            help="the index of the only evaluator node served by Bob, to spread them\n" +
+                 "over several machines (default: all of them)"
+        )
+        parser.add_argument("--tcp",
+            dest="tcp",
+            action="store_true",
+            help="in test mode, run Bob in a child process talking over TCP, instead of\n" +
+                 "a thread of the same process talking over an in-memory channel"
+        )
+        parser.add_argument("--metrics",
+            dest="metrics_path",
+            default=None,
+            metavar="FILE",
+            help="write the time spent in each phase (setup, garble, serialize, ot, evaluate,\n" +
+                 "wait) and counters of circuits, gates, OTs, round trips and bytes to FILE,\n" +
+                 "in the Prometheus text format if it ends with .prom, in JSON otherwise;\n" +
+                 "the party and worker names are added before the extension when needed"
+        )
+        parser.add_argument("--profile",
+            dest="profile_path",
+            default=None,
+            metavar="FILE",
+            help="profile the party with cProfile and write the stats to FILE,\n" +
+                 "to be read with pstats (names added as for --metrics)"
+        )
+        parser.add_argument("--trace-format",
+            dest="trace_format",
+            choices=util.TRACE_FORMATS,
+            default="text",
+            help="the format of the traces written in full mode:\n" +
+                 "\ttext\t readable .txt files (default)\n" +
+                 "\tbinary\t compact .trace files of raw records, printed with python util.py FILE"
         )
         psi(party=parser.parse_args().party,
-            vals=parser.parse_args().set,
-            output_mode=parser.parse_args().output_mode
+            vals=[util.parse_set(s, elements=parser.parse_args().hash_fpr is not None)
+                  for s in parser.parse_args().set],
+            output_mode=parser.parse_args().output_mode,
+            batch_size=parser.parse_args().batch_size,
+            backend=parser.parse_args().backend,
+            group=parser.parse_args().group,
+            ot_mode=parser.parse_args().ot_mode,
+            ot_pool=parser.parse_args().ot_pool,
+            bucketed=parser.parse_args().bucketed,
+            all_pairs=parser.parse_args().all_pairs,
+            window=parser.parse_args().window,
+            workers=parser.parse_args().workers,
+            evaluators=parser.parse_args().evaluators,
+            node=parser.parse_args().node,
+            tcp=parser.parse_args().tcp,
+            metrics_path=parser.parse_args().metrics_path,
+            profile_path=parser.parse_args().profile_path,
+            trace_format=parser.parse_args().trace_format,
+            hash_fpr=parser.parse_args().hash_fpr,
+            session=parser.parse_args().session,
+            pool_size=parser.parse_args().pool_size,
+            pool_memory=parser.parse_args().pool_memory,
+            pool_spill=parser.parse_args().pool_spill
         )
 
     init()
\ No newline at end of file
@@ -0,0 +1,65 @@
+"""
+Tests of the Bristol Fashion loader, run from this folder with python -m pytest.
+"""
+import itertools
+
+import pytest
+
+import bristol
+import yao
+
+# out = (a AND 1, b XOR 0), i.e. (a, b)
+CONSTANTS = """4 6
+2 1 1
+2 1 1
+1 1 1 2 EQ
+1 1 0 3 EQ
+2 1 0 2 4 AND
+2 1 1 3 5 XOR
+"""
+
+# out = a AND 1, with a single input wire
+SINGLE_INPUT = """2 3
+1 1
+1 1
+1 1 1 1 EQ
+2 1 0 1 2 AND
+"""
+
+
+def garbled_outputs(circuit, bits, backend):
+    """Garble and evaluate a circuit for the bits of its input wires, Alice's then Bob's."""
+    compiled = yao.compile_circuit(circuit)
+    garbled = yao.GarbledCircuit(compiled, backend=backend)
+    keys, pbits = garbled.get_keys(), garbled.get_pbits()
+    inputs = {w: (keys[w][b], pbits[w] ^ b)
+              for w, b in zip(circuit["alice"] + circuit["bob"], bits)}
+    a_inputs = {w: inputs[w] for w in circuit["alice"]}
+    b_inputs = {w: inputs[w] for w in circuit["bob"]}
+    pbits_out = {w: pbits[w] for w in circuit["out"]}
+    result = yao.evaluate(compiled, garbled.get_garbled_tables(), pbits_out,
+                          a_inputs, b_inputs, backend)
+    return [result[w] for w in circuit["out"]]
+
+
+@pytest.mark.parametrize("text, num_inputs", [(CONSTANTS, 2), (SINGLE_INPUT, 1)])
+@pytest.mark.parametrize("backend", list(yao.BACKENDS))
+def test_parse_constants(tmp_path, text, num_inputs, backend):
+    path = tmp_path / "constants.txt"
+    path.write_text(text)
+    circuit = bristol.parse_bristol(str(path))
+    # every gate reads wires that exist, and none XORs a wire with itself
+    wires = set(circuit["alice"] + circuit["bob"])
+    for gate in circuit["gates"]:
+        assert set(gate["in"]) <= wires
+        assert not (gate["type"] == "XOR" and len(set(gate["in"])) == 1)
+        wires.add(gate["id"])
+    for bits in itertools.product((0, 1), repeat=num_inputs):
+        assert garbled_outputs(circuit, list(bits), backend) == list(bits)
+
+
+def test_parse_constants_without_inputs(tmp_path):
+    path = tmp_path / "constant.txt"
+    path.write_text("1 1\n0\n1 1\n1 1 1 0 EQ\n")
+    with pytest.raises(RuntimeError):
+        bristol.parse_bristol(str(path))
@@ -0,0 +1,118 @@
+"""
+Tests of the oblivious transfers, run from this folder with python -m pytest:
+both parties run in this process and talk over an in-memory channel.
+"""
+import os
+import random
+import threading
+
+import numpy as np
+import pytest
+
+import ot
+import util
+
+GROUP = "modp1536"
+
+
+def transfer(endpoint, mode, batches, num_ots=None, pool_size=ot.POOL_SIZE,
+             pool_paths=(None, None)):
+    """
+    Transfer a batch of keys per list of Bob's bits with OTs of the given
+    mode, num_ots being announced in the setup (by default as many as
+    needed), and return the pairs of keys of each batch along with the keys
+    Bob received.
+    """
+    endpoint = util.MEMORY_SCHEME + endpoint
+    group = util.load_group(GROUP)
+    alice = ot.ObliviousTransfer(util.GarblerSocket(endpoint), util.Logger("Alice", "minimal"),
+                                 group=group, mode=mode, pool_path=pool_paths[0],
+                                 pool_size=pool_size)
+    bob = ot.ObliviousTransfer(util.EvaluatorSocket(endpoint), util.Logger("Bob", "minimal"),
+                               group=group, mode=mode, pool_path=pool_paths[1])
+    received = []
+
+    def run_bob():
+        bob.setup_evaluator()
+        for bits in batches:
+            bob.socket.receive()  # the garbled circuits of the batch
+            received.append(bob.receive_keys_batch([dict(enumerate(bits))]))
+            bob.socket.send(b"")  # the results of the batch
+
+    thread = threading.Thread(target=run_bob, daemon=True)
+    thread.start()
+    sent = []
+    try:
+        alice.setup_garbler(num_ots or sum(map(len, batches)))
+        for bits in batches:
+            keys = {w: ((os.urandom(16), 0), (os.urandom(16), 1)) for w in range(len(bits))}
+            sent.append(keys)
+            alice.get_result_batch({}, [keys])
+    finally:
+        thread.join()
+        alice.socket.close()
+    return sent, received
+
+
+def check_chosen_keys(batches, sent, received):
+    assert len(received) == len(batches)
+    for bits, keys, got in zip(batches, sent, received):
+        assert got == [keys[w][b] for w, b in enumerate(bits)]
+
+
+def random_batches(sizes):
+    return [[random.getrandbits(1) for _ in range(n)] for n in sizes]
+
+
+@pytest.mark.parametrize("mode", ot.OT_MODES)
+def test_batch_transfer(mode):
+    batches = random_batches([5, 17, 1])
+    check_chosen_keys(batches, *transfer(f"ot-{mode}", mode, batches))
+
+
+def test_pool_transfer_refills():
+    # fewer random OTs than needed are precomputed, the rest on the fly
+    batches = random_batches([6, 10, 12])
+    check_chosen_keys(batches, *transfer("ot-refill", "pool", batches, pool_size=8))
+
+
+def test_pool_transfer_across_sessions(tmp_path):
+    paths = (str(tmp_path / "alice"), str(tmp_path / "bob"))
+    batches = random_batches([9, 4])
+    # more random OTs are precomputed than used, e.g. for comparisons skipped
+    check_chosen_keys(batches, *transfer("ot-first", "pool", batches, num_ots=40,
+                                         pool_paths=paths))
+    alice, bob = ot.RandomOTPool.load(paths[0]), ot.RandomOTPool.load(paths[1])
+    assert alice.state() == bob.state() == (alice.pool_id, 13)
+    # the second session uses the random OTs left by the first one
+    check_chosen_keys(batches, *transfer("ot-second", "pool", batches, pool_paths=paths))
+    alice, bob = ot.RandomOTPool.load(paths[0]), ot.RandomOTPool.load(paths[1])
+    assert alice.state() == bob.state() == (alice.pool_id, 26)
+
+
+def test_pool_save_load_append(tmp_path):
+    path = str(tmp_path / "pool")
+    masks = np.frombuffer(os.urandom(10 * 16), np.uint8).reshape(10, 16)
+    choices = np.frombuffer(os.urandom(10), np.uint8) & 1
+    pool = ot.RandomOTPool("id", masks, choices)
+    pool.save(path)
+
+    loaded = ot.RandomOTPool.load(path)
+    assert loaded.state() == ("id", 0)
+    assert np.array_equal(loaded.masks, masks) and np.array_equal(loaded.choices, choices)
+
+    loaded.corrections([1, 0, 1, 1])  # the number of used OTs is saved at once
+    assert ot.RandomOTPool.load(path).state() == ("id", 4)
+
+    more = np.frombuffer(os.urandom(3 * 16), np.uint8).reshape(3, 16)
+    loaded.append(more, np.array([1, 0, 1], np.uint8))
+    reloaded = ot.RandomOTPool.load(path)
+    assert reloaded.state() == ("id", 0)
+    assert np.array_equal(reloaded.masks, np.concatenate((masks[4:], more)))
+    assert np.array_equal(reloaded.choices, np.concatenate((choices[4:], [1, 0, 1])))
+    # only the files of the last save are left
+    assert sorted(os.listdir(path)) == ["choices.2.npy", "masks.2.npy", "pool.json"]
+
+
+def test_pool_load_without_pool(tmp_path):
+    assert ot.RandomOTPool.load(str(tmp_path)) is None
@@ -0,0 +1,44 @@
+"""
+Tests of PSI runs, run from this folder with python -m pytest: both parties
+run in this process and talk over an in-memory channel.
+"""
+import threading
+
+import hashing
+import psi
+import util
+
+VALS_A = ["apple", 3, 4.5, -2, "kiwi", 10, 11]
+VALS_B = ["kiwi", 3.0, 7, 4.5, "pear"]
+INTERSECTION = {"kiwi", 3, 4.5}
+
+
+def run_psi(vals_a, vals_b, endpoint, **options):
+    """Run Alice with the given options against Bob and return her intersection."""
+    endpoint = util.MEMORY_SCHEME + endpoint
+    bob = psi.Bob(vals_b, util.Logger("Bob", "minimal"), endpoint=endpoint)
+    thread = threading.Thread(target=bob.listen, daemon=True)
+    thread.start()
+    alice = psi.Alice(vals_a, util.Logger("Alice", "minimal"), endpoint=endpoint, **options)
+    try:
+        alice.setup()
+        return alice.run()
+    finally:
+        alice.close()
+        thread.join()
+
+
+def test_hashed_all_pairs_hashes_each_set_once(monkeypatch):
+    hashed = []
+    hash_bits = hashing.hash_bits
+
+    def counted_hash_bits(xs, seed, width):
+        hashed.extend(xs)
+        return hash_bits(xs, seed, width)
+
+    monkeypatch.setattr(hashing, "hash_bits", counted_hash_bits)
+    matched = run_psi(VALS_A, VALS_B, "hashed", hash_fpr=hashing.HASH_FPR,
+                      all_pairs=2, batch_size=2)
+    assert set(matched) == INTERSECTION
+    # Alice's elements are hashed once, not once per batch
+    assert len(hashed) == len(VALS_A) + len(VALS_B)
@@ -0,0 +1,59 @@
+"""
+Tests of the wire protocol, run from this folder with python -m pytest.
+"""
+import numpy as np
+import pytest
+
+import util
+
+
+def plain(x):
+    """Return a message decoded by util.decode with its views turned into bytes and arrays."""
+    if isinstance(x, memoryview):
+        return bytes(x)
+    if isinstance(x, np.ndarray):
+        return x.copy()
+    if isinstance(x, (list, tuple)):
+        return type(x)(map(plain, x))
+    if isinstance(x, dict):
+        return {plain(key): plain(item) for key, item in x.items()}
+    return x
+
+
+def test_encode_decode():
+    big = bytes(range(256)) * (util.OUT_OF_BAND_MIN // 256 + 1)
+    array = np.arange(2 * util.OUT_OF_BAND_MIN, dtype=">u4").reshape(-1, 4)
+    msg = {
+        "scalars": [None, True, False, 0, -1, 2 ** 200, -2 ** 70, 1.5, -0.0, "é", ""],
+        "bytes": (b"", b"\x00\xff", big),
+        "array": np.array([[1, 0], [0, 1]], np.uint8),
+        3: ("nested", [{"j": [1, 2]}, ()]),
+    }
+    frames = util.encode(dict(msg, large=array))
+    assert len(frames) == 3  # the large bytes and array in frames of their own
+    decoded = plain(util.decode(frames))
+    large = decoded.pop("large")
+    assert large.dtype == array.dtype and np.array_equal(large, array)
+    assert np.array_equal(decoded.pop("array"), msg.pop("array"))
+    assert decoded == msg
+    assert isinstance(decoded["bytes"], tuple) and isinstance(decoded[3][1], list)
+
+
+def test_encode_unsupported():
+    with pytest.raises(RuntimeError):
+        util.encode({"set": {1, 2}})
+
+
+def test_decode_bad_magic():
+    frames = util.encode("OK")
+    frames[0] = b"XX" + bytes(frames[0][len(util.PROTOCOL_MAGIC):])
+    with pytest.raises(RuntimeError, match="wire protocol"):
+        util.decode(frames)
+
+
+def test_decode_bad_version():
+    frames = util.encode("OK")
+    header = len(util.PROTOCOL_MAGIC)
+    frames[0][header] = util.PROTOCOL_VERSION + 1
+    with pytest.raises(RuntimeError, match="version"):
+        util.decode(frames)
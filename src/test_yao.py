@@ -0,0 +1,106 @@
+"""
+Tests of the garbling backends, run from this folder with python -m pytest.
+
+Besides checking the results of garbled circuits, they play an evaluator
+holding one key per wire and check that it can't recover the free-XOR
+offset R by unmasking a fixed-key AES output from a garbled table and
+decrypting it, the key of the AES hash being public.
+"""
+import itertools
+import random
+
+import pytest
+from cryptography.hazmat.primitives.ciphers import Cipher, algorithms, modes
+
+import util
+import yao
+
+CIRCUIT = "circuits/eq32.json"
+AES_BACKENDS = ["aes", "halfgates"]
+
+
+def wire_values(compiled, bits):
+    """Return the clear bit of each wire index, given the bits of the input wires."""
+    values = [None] * len(compiled.wires)
+    for k, bit in zip(compiled.alice + compiled.bob, bits):
+        values[k] = bit
+    for gate in compiled.gates:
+        ins = [values[k] for k in gate.ins]
+        values[gate.out] = 1 ^ ins[0] if len(ins) < 2 else yao.BIT_OPS[gate.type](*ins)
+    return values
+
+
+def offset_candidates(backend, compiled, tables, keys):
+    """
+    Yield the guesses of R of an evaluator holding the given key of each
+    wire index: for each ciphertext of each gate, XORed with any of the
+    input keys, their hashes and the output key, decrypt it as AES_K(L ^ R ^ t)
+    for each input key L (or s(L)) and tweak t of the gate.
+    """
+    decrypt = Cipher(algorithms.AES(backend.FIXED_KEY), modes.ECB()).decryptor().update
+    for gate in compiled.non_xor_gates:
+        ins = [keys[k] for k in gate.ins]
+        tweaks = [2 * gate.id, 2 * gate.id + 1]
+        known = ins + backend.hash_each(ins, tweaks) + [keys[gate.out]]
+        table = tables[gate.id]
+        rows = table if isinstance(table, tuple) else table.values()
+        for row in rows:
+            for n in range(len(known) + 1):
+                for subset in itertools.combinations(known, n):
+                    masked = row
+                    for value in subset:
+                        masked = util.xor_bytes(masked, value)
+                    for key, tweak in itertools.product(ins, tweaks):
+                        tweak = tweak.to_bytes(backend.KEY_SIZE, "big")
+                        for x in (key, backend.sigma(key)):
+                            # for hashes AES_K(x ^ t) ^ x and AES_K(x ^ t) ^ x ^ t
+                            for unmask in (x, util.xor_bytes(x, tweak)):
+                                block = decrypt(util.xor_bytes(masked, unmask))
+                                yield util.xor_bytes(block, util.xor_bytes(x, tweak))
+
+
+def evaluator_keys(compiled, keys, bits):
+    """Return the key of each wire index that the evaluator gets for the given inputs."""
+    return [pair[bit] for pair, bit in zip(keys, wire_values(compiled, bits))]
+
+
+@pytest.mark.parametrize("backend", list(yao.BACKENDS))
+def test_garbled_circuit(backend):
+    compiled = yao.load_circuit(CIRCUIT)
+    rand = random.Random(0)
+    for equal in (False, True):
+        x = util.float_to_bit_list(rand.uniform(-1e6, 1e6))
+        y = x if equal else util.float_to_bit_list(rand.uniform(-1e6, 1e6))
+        garbled = yao.GarbledCircuit(compiled, backend=backend)
+        keys, pbits = garbled.get_keys(), garbled.get_pbits()
+        circuit = compiled.circuit
+        a_inputs = {w: (keys[w][b], pbits[w] ^ b) for w, b in zip(circuit["alice"], x)}
+        b_inputs = {w: (keys[w][b], pbits[w] ^ b) for w, b in zip(circuit["bob"], y)}
+        pbits_out = {w: pbits[w] for w in circuit["out"]}
+        result = yao.evaluate(compiled, garbled.get_garbled_tables(), pbits_out,
+                              a_inputs, b_inputs, backend)
+        assert list(result.values()) == [int(equal)]
+
+
+@pytest.mark.parametrize("backend", AES_BACKENDS)
+def test_garbled_circuit_hides_offset(backend):
+    compiled = yao.load_circuit(CIRCUIT)
+    garbled = yao.GarbledCircuit(compiled, backend=backend)
+    bits = [random.getrandbits(1) for _ in compiled.alice + compiled.bob]
+    keys = evaluator_keys(compiled, garbled.keys, bits)
+    secrets = {garbled.R, garbled.backend.sigma(garbled.R)}
+    assert not secrets & set(offset_candidates(garbled.backend, compiled,
+                                               garbled.get_garbled_tables(), keys))
+
+
+@pytest.mark.parametrize("backend", AES_BACKENDS)
+def test_garbled_circuit_batch_hides_offset(backend):
+    compiled = yao.load_circuit(CIRCUIT)
+    batch = yao.GarbledCircuitBatch(compiled, 4, backend)
+    for keys0, R, tables in zip(batch.keys, batch.R, batch.garbled_tables):
+        keys = [(key0.tobytes(), (key0 ^ R).tobytes()) for key0 in keys0]
+        bits = [random.getrandbits(1) for _ in compiled.alice + compiled.bob]
+        tables = yao.unpack_tables(compiled, tables, backend)
+        secrets = {R.tobytes(), batch.backend.sigma(R.tobytes())}
+        assert not secrets & set(offset_candidates(batch.backend, compiled, tables,
+                                                   evaluator_keys(compiled, keys, bits)))
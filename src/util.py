@@ -1,8 +1,12 @@
+import collections
+import instrumentation
 import json
-import operator
-import random
+import numpy as np
+import queue
 import secrets
 import sympy
+import threading
+import time
 import zmq
 import struct
 
@@ -10,37 +14,380 @@ import struct
 LOCAL_PORT = 4080
 SERVER_HOST = "localhost"
 SERVER_PORT = 4080
+MEMORY_SCHEME = "mem://"  # endpoints of in-memory channels, e.g. mem://psi
+RESULT = "RESULT"  # tag of the results sent by a pipelined Bob
 
+# WIRE PROTOCOL
+PROTOCOL_MAGIC = b"YP"
+PROTOCOL_VERSION = 1
+OUT_OF_BAND_MIN = 1024  # byte strings and arrays from this size get their own frame
 
-class Socket:
-    def __init__(self, socket_type):
+
+def encode(msg):
+    """Encode a message into zmq frames, without pickle.
+
+    The first frame holds PROTOCOL_MAGIC, PROTOCOL_VERSION and the message,
+    encoded as a tree of tagged values: None, bools, ints, floats, strings,
+    bytes, lists, tuples, dicts and NumPy arrays. Byte strings and arrays of
+    at least OUT_OF_BAND_MIN bytes are sent as zero-copy frames of their
+    own, referenced by their position in the message.
+
+    Returns:
+        The list of frames.
+    """
+    out = bytearray(PROTOCOL_MAGIC + bytes([PROTOCOL_VERSION]))
+    frames = [out]
+
+    def varint(n):
+        while n >= 0x80:
+            out.append((n & 0x7f) | 0x80)
+            n >>= 7
+        out.append(n)
+
+    def buffer(data):
+        if len(data) >= OUT_OF_BAND_MIN:
+            out.append(ord("B"))
+            varint(len(frames))
+            frames.append(data)
+        else:
+            out.append(ord("b"))
+            varint(len(data))
+            out.extend(data)
+
+    def value(x):
+        if x is None:
+            out.append(ord("N"))
+        elif x is True or x is False:
+            out.append(ord("T") if x else ord("F"))
+        elif isinstance(x, (int, np.integer)):
+            x = int(x)
+            data = x.to_bytes((x.bit_length() + 8) // 8, "big", signed=True)
+            out.append(ord("i"))
+            varint(len(data))
+            out.extend(data)
+        elif isinstance(x, float):
+            out.append(ord("f"))
+            out.extend(struct.pack(">d", x))
+        elif isinstance(x, str):
+            data = x.encode()
+            out.append(ord("s"))
+            varint(len(data))
+            out.extend(data)
+        elif isinstance(x, (bytes, bytearray, memoryview)):
+            buffer(x)
+        elif isinstance(x, np.ndarray):
+            x = np.ascontiguousarray(x)
+            out.append(ord("a"))
+            value(x.dtype.str)
+            value(x.shape)
+            buffer(memoryview(x).cast("B"))
+        elif isinstance(x, (list, tuple)):
+            out.append(ord("l") if isinstance(x, list) else ord("t"))
+            varint(len(x))
+            for item in x:
+                value(item)
+        elif isinstance(x, dict):
+            out.append(ord("d"))
+            varint(len(x))
+            for key, item in x.items():
+                value(key)
+                value(item)
+        else:
+            raise RuntimeError(f"Cannot encode a value of type {type(x).__name__}")
+
+    value(msg)
+    return frames
+
+
+def decode(frames):
+    """Decode a message from the zmq frames built by encode.
+
+    Byte strings received in frames of their own are returned as memoryviews
+    and arrays as read-only views of the frames, without copies.
+    """
+    data = memoryview(frames[0])
+    header = len(PROTOCOL_MAGIC) + 1
+    if bytes(data[:len(PROTOCOL_MAGIC)]) != PROTOCOL_MAGIC:
+        raise RuntimeError("Received a message that does not follow the wire protocol")
+    if data[header - 1] != PROTOCOL_VERSION:
+        raise RuntimeError(f"Received a message of protocol version {data[header - 1]}, "
+                           f"expected {PROTOCOL_VERSION}")
+    pos = header
+
+    def varint():
+        nonlocal pos
+        n, shift = 0, 0
+        while True:
+            byte = data[pos]
+            pos += 1
+            n |= (byte & 0x7f) << shift
+            shift += 7
+            if byte < 0x80:
+                return n
+
+    def chunk():
+        nonlocal pos
+        n = varint()
+        pos += n
+        return data[pos - n:pos]
+
+    def value():
+        nonlocal pos
+        tag = chr(data[pos])
+        pos += 1
+        if tag == "N":
+            return None
+        if tag in "TF":
+            return tag == "T"
+        if tag == "i":
+            return int.from_bytes(chunk(), "big", signed=True)
+        if tag == "f":
+            pos += 8
+            return struct.unpack(">d", data[pos - 8:pos])[0]
+        if tag == "s":
+            return str(chunk(), "utf-8")
+        if tag == "b":
+            return bytes(chunk())
+        if tag == "B":
+            return memoryview(frames[varint()])
+        if tag == "a":
+            dtype, shape, buf = value(), value(), value()
+            if np.dtype(dtype).hasobject:
+                raise RuntimeError("Received an array of Python objects")
+            return np.frombuffer(buf, dtype).reshape(shape)
+        if tag in "lt":
+            items = [value() for _ in range(varint())]
+            return items if tag == "l" else tuple(items)
+        if tag == "d":
+            return {value(): value() for _ in range(varint())}
+        raise RuntimeError(f"Received a message with unknown tag {tag!r}")
+
+    return value()
+
+
+class ZmqTransport:
+    """
+    Transport over a zmq socket, taking care of the envelopes of ROUTER and
+    DEALER sockets: messages are framed as with REQ, behind an empty delimiter.
+    """
+    def __init__(self, socket_type, endpoint, bind):
         self.socket = zmq.Context().socket(socket_type)
+        self.socket_type = socket_type
+        self.peer = None  # identity of the last peer a ROUTER received from
+        if bind:
+            self.socket.bind(endpoint)
+        else:
+            self.socket.connect(endpoint)
+
+    def send(self, frames):
+        if self.socket_type == zmq.ROUTER:
+            frames = [self.peer, b""] + frames
+        elif self.socket_type == zmq.DEALER:
+            frames = [b""] + frames
+        self.socket.send_multipart(frames, copy=False)
+
+    def receive(self):
+        frames = [frame.buffer for frame in self.socket.recv_multipart(copy=False)]
+        if self.socket_type == zmq.ROUTER:
+            self.peer = bytes(frames[0])
+            return frames[2:]
+        elif self.socket_type == zmq.DEALER:
+            return frames[1:]
+        return frames
+
+    def close(self):
+        self.socket.close(linger=0)
+
+
+class QueueTransport:
+    """
+    In-memory transport between the two sockets of a channel of the same
+    process, e.g. Alice and Bob running on two threads. The frames are
+    passed along without copies, as read-only views.
+    """
+    def __init__(self, endpoint, bind):
+        self.name = endpoint[len(MEMORY_SCHEME):]
+        with _CHANNELS_LOCK:
+            channel = _CHANNELS.setdefault(self.name, (queue.Queue(), queue.Queue()))
+        # the bound socket receives from the first queue, sends to the second one
+        self.inbox, self.outbox = channel if bind else channel[::-1]
+
+    def send(self, frames):
+        self.outbox.put([memoryview(frame).toreadonly() for frame in frames])
+
+    def receive(self):
+        return self.inbox.get()
+
+    def close(self):
+        with _CHANNELS_LOCK:
+            _CHANNELS.pop(self.name, None)
+
+
+_CHANNELS = {}  # pair of queues of each in-memory channel
+_CHANNELS_LOCK = threading.Lock()
+
+
+class Socket:
+    """
+    A socket sending messages encoded with the wire protocol, over zmq or
+    an in-memory channel for endpoints starting with MEMORY_SCHEME.
+    """
+    def __init__(self, socket_type, endpoint, bind=False, metrics=None):
+        if endpoint.startswith(MEMORY_SCHEME):
+            self.transport = QueueTransport(endpoint, bind)
+        else:
+            self.transport = ZmqTransport(socket_type, endpoint, bind)
+        self.metrics = metrics or instrumentation.NO_METRICS
+        # traffic of the socket, in both directions
+        self.messages = 0
+        self.bytes = 0
+        self.sent = False  # whether a message was sent since the last one received
 
     def send(self, msg):
-        self.socket.send_pyobj(msg)
+        with self.metrics.phase("serialize"):
+            frames = encode(msg)
+        self._count(frames, "sent")
+        self.sent = True
+        self.transport.send(frames)
 
     def receive(self):
-        return self.socket.recv_pyobj()
+        with self.metrics.phase("wait"):
+            frames = self.transport.receive()
+        self._count(frames, "received")
+        if self.sent:  # the answer to the messages sent
+            self.metrics.count("round_trips")
+            self.sent = False
+        with self.metrics.phase("serialize"):
+            return decode(frames)
+
+    def _count(self, frames, direction):
+        size = sum(memoryview(frame).nbytes for frame in frames)
+        self.messages += 1
+        self.bytes += size
+        self.metrics.count(f"messages_{direction}")
+        self.metrics.count(f"bytes_{direction}", size)
 
     def send_wait(self, msg):
         self.send(msg)
         return self.receive()
 
+    def close(self):
+        self.transport.close()
+
 
 class EvaluatorSocket(Socket):
-    def __init__(self, endpoint=f"tcp://*:{LOCAL_PORT}"):
-        super().__init__(zmq.REP)
-        self.socket.bind(endpoint)
+    """
+    Bob's socket, a ROUTER answering either a REQ Alice, in lockstep, or a
+    DEALER Alice pipelining her messages.
+
+    Once locked to the Alice of a session, the socket answers the messages
+    of any other peer, e.g. an Alice reaching the wrong worker, with an
+    error, and drops them.
+    """
+    def __init__(self, endpoint=None, metrics=None):
+        super().__init__(zmq.ROUTER, endpoint or evaluator_endpoint(), bind=True,
+                         metrics=metrics)
+        self.locked = None  # identity of the Alice of the session
+
+    def lock(self):
+        """Only accept the messages of the peer of the last message received."""
+        self.locked = getattr(self.transport, "peer", None)
+
+    def receive(self):
+        msg = super().receive()
+        while self.locked is not None and self.transport.peer != self.locked:
+            self.transport.send(encode(("ERROR", "Bob's worker is busy with another session")))
+            self.transport.peer = self.locked
+            msg = super().receive()
+        return msg
 
 
 class GarblerSocket(Socket):
-    def __init__(self, endpoint=f"tcp://{SERVER_HOST}:{SERVER_PORT}"):
-        super().__init__(zmq.REQ)
-        self.socket.connect(endpoint)
+    """
+    Alice's socket, a REQ one, or a DEALER one if pipelined, so that she
+    can send messages without waiting for Bob's answers.
+
+    A pipelined Bob sends the results of his evaluations as soon as they
+    are ready, tagged with RESULT: those received while waiting for another
+    message are kept until asked for with receive_result.
+    """
+    def __init__(self, endpoint=None, pipelined=False, metrics=None):
+        super().__init__(zmq.DEALER if pipelined else zmq.REQ, endpoint or garbler_endpoint(),
+                         metrics=metrics)
+        self.pipelined = pipelined
+        self.results = collections.deque()
+
+    def receive(self):
+        msg = super().receive()
+        while self.pipelined and is_result(msg):
+            self.results.append(msg[1])
+            msg = super().receive()
+        return msg
+
+    def receive_result(self):
+        """Return the next result sent by a pipelined Bob."""
+        while not self.results:
+            msg = super().receive()
+            if not is_result(msg):
+                raise RuntimeError(f"Expected a result, received {msg!r}")
+            self.results.append(msg[1])
+        return self.results.popleft()
+
+
+def evaluator_endpoint(worker=0, port=LOCAL_PORT):
+    """Return the endpoint bound by Bob's worker of the given index."""
+    return f"tcp://*:{port + worker}"
+
+
+def garbler_endpoint(worker=0, host=SERVER_HOST, port=SERVER_PORT):
+    """Return the endpoint that Alice's worker of the given index connects to."""
+    return f"tcp://{host}:{port + worker}"
+
+
+def parse_addresses(s: str):
+    """Parse a comma-separated list of host:port addresses into pairs (host, port)."""
+    addresses = []
+    for address in s.split(","):
+        host, _, port = address.strip().rpartition(":")
+        if not host or not port.isdigit():
+            raise RuntimeError(f"Invalid address {address!r}, expected host:port")
+        addresses.append((host, int(port)))
+    return addresses
+
+
+def is_result(msg):
+    """Return whether msg is a result sent by a pipelined Bob."""
+    return isinstance(msg, tuple) and len(msg) == 2 and isinstance(msg[0], str) and msg[0] == RESULT
 
 
 # PRIME GROUP
 PRIME_BITS = 64  # order of magnitude of prime in base 2
+FIXED_BASE_MIN_BITS = 512  # smallest prime using precomputed tables in gen_pow
+FIXED_BASE_WINDOW = 4  # number of exponent bits handled by each table row
+
+# Standard groups from RFC 3526, (prime, generator, exponent size in bits)
+# with exponents twice as large as the strength estimated by the RFC
+STANDARD_GROUPS = {
+    "modp1536": (int(
+        "FFFFFFFFFFFFFFFFC90FDAA22168C234C4C6628B80DC1CD129024E088A67CC74"
+        "020BBEA63B139B22514A08798E3404DDEF9519B3CD3A431B302B0A6DF25F1437"
+        "4FE1356D6D51C245E485B576625E7EC6F44C42E9A637ED6B0BFF5CB6F406B7ED"
+        "EE386BFB5A899FA5AE9F24117C4B1FE649286651ECE45B3DC2007CB8A163BF05"
+        "98DA48361C55D39A69163FA8FD24CF5F83655D23DCA3AD961C62F356208552BB"
+        "9ED529077096966D670C354E4ABC9804F1746C08CA237327FFFFFFFFFFFFFFFF",
+        16), 2, 240),
+    "modp2048": (int(
+        "FFFFFFFFFFFFFFFFC90FDAA22168C234C4C6628B80DC1CD129024E088A67CC74"
+        "020BBEA63B139B22514A08798E3404DDEF9519B3CD3A431B302B0A6DF25F1437"
+        "4FE1356D6D51C245E485B576625E7EC6F44C42E9A637ED6B0BFF5CB6F406B7ED"
+        "EE386BFB5A899FA5AE9F24117C4B1FE649286651ECE45B3DC2007CB8A163BF05"
+        "98DA48361C55D39A69163FA8FD24CF5F83655D23DCA3AD961C62F356208552BB"
+        "9ED529077096966D670C354E4ABC9804F1746C08CA18217C32905E462E36CE3B"
+        "E39E772C180E86039B2783A2EC07A28FB5C55DF06F4C52C9DE2BCBF695581718"
+        "3995497CEA956AE515D2261898FA051015728E5A8AACAA68FFFFFFFFFFFFFFFF",
+        16), 2, 320),
+}
+_GROUPS = {}  # standard groups already loaded, along with their precomputed tables
 
 
 def next_prime(num):
@@ -56,7 +403,9 @@ def gen_prime(num_bits):
 
 def xor_bytes(seq1, seq2):
     """XOR two byte sequence."""
-    return bytes(map(operator.xor, seq1, seq2))
+    n = min(len(seq1), len(seq2))
+    return (int.from_bytes(seq1[:n], "big") ^
+            int.from_bytes(seq2[:n], "big")).to_bytes(n, "big")
 
 
 def bits(num, width):
@@ -66,11 +415,14 @@ def bits(num, width):
 
 class PrimeGroup:
     """Cyclic abelian group of prime order 'prime'."""
-    def __init__(self, prime=None):
+    def __init__(self, prime=None, generator=None, exponent_bits=None):
         self.prime = prime or gen_prime(num_bits=PRIME_BITS)
         self.prime_m1 = self.prime - 1
         self.prime_m2 = self.prime - 2
-        self.generator = self.find_generator()
+        # size of random exponents, None to draw them from the whole group
+        self.exponent_bits = exponent_bits
+        self.generator = generator or self.find_generator()
+        self.table = None  # powers of the generator, computed by the first gen_pow
 
     def mul(self, num1, num2):
         "Multiply two elements." ""
@@ -82,15 +434,47 @@ class PrimeGroup:
 
     def gen_pow(self, exponent):  # generator exponentiation
         "Compute nth power of a generator." ""
-        return pow(self.generator, exponent, self.prime)
+        if self.prime.bit_length() < FIXED_BASE_MIN_BITS:
+            return pow(self.generator, exponent, self.prime)
+        if self.table is None:
+            self.table = self.precompute()
+
+        # multiply the precomputed powers matching each window of the exponent
+        result, mask = 1, (1 << FIXED_BASE_WINDOW) - 1
+        exponent %= self.prime_m1
+        for row in self.table:
+            if exponent == 0:
+                break
+            if exponent & mask:
+                result = (result * row[exponent & mask]) % self.prime
+            exponent >>= FIXED_BASE_WINDOW
+        return result
+
+    def precompute(self):
+        """Return the table of powers of the generator used by gen_pow.
+
+        Row i holds g^(d * 2^(w*i)) for each digit d of w bits, w being
+        FIXED_BASE_WINDOW.
+        """
+        table, base = [], self.generator
+        for _ in range(0, self.prime_m1.bit_length(), FIXED_BASE_WINDOW):
+            row = [1]
+            for _ in range((1 << FIXED_BASE_WINDOW) - 1):
+                row.append(self.mul(row[-1], base))
+            table.append(row)
+            base = self.mul(row[-1], base)
+        return table
 
     def inv(self, num):
         "Multiplicative inverse of an element." ""
-        return pow(num, self.prime_m2, self.prime)
+        return pow(num, -1, self.prime)
 
     def rand_int(self):  # random int in [1, prime-1]
-        "Return an random int in [1, prime - 1]." ""
-        return random.randint(1, self.prime_m1)
+        """Return a random int in [1, prime - 1], or of exponent_bits bits if set."""
+        # secret exponents of the OTs: draw them from the OS's CSPRNG
+        if self.exponent_bits:
+            return secrets.randbelow((1 << self.exponent_bits) - 1) + 1
+        return secrets.randbelow(self.prime_m1) + 1
 
     def find_generator(self):  # find random generator for group
         """Find a random generator for the group."""
@@ -104,9 +488,37 @@ class PrimeGroup:
             else:
                 return candidate
 
+    def params(self):
+        """Return the (prime, generator, exponent_bits) defining the group."""
+        return (self.prime, self.generator, self.exponent_bits)
+
     def __str__(self):
         return f"PrimeGroup(prime={self.prime}, generator={self.generator})"
 
+
+def load_group(group=None):
+    """Return the group to use for a whole session of OTs.
+
+    Args:
+        group: Optional; the name of a standard group, whose instance is
+            cached along with its precomputed tables, or the group's params.
+            A random group of PRIME_BITS bits is generated if omitted.
+    """
+    if group is None:
+        return PrimeGroup()
+    if not isinstance(group, str):
+        return PrimeGroup(*group)
+    if group not in STANDARD_GROUPS:
+        raise RuntimeError(f"Unknown group {group}. Possible values: {', '.join(STANDARD_GROUPS)}.")
+    if group not in _GROUPS:
+        _GROUPS[group] = PrimeGroup(*STANDARD_GROUPS[group])
+    return _GROUPS[group]
+
+# SETS
+RAW_EXTENSIONS = (".f32", ".bin")  # files of raw float32 values
+SET_CHUNK_LINES = 1 << 16  # lines of a text set parsed at once
+
+
 def parse_json(json_path):
     with open(json_path) as json_file:
         return json.load(json_file)
@@ -121,35 +533,153 @@ def parse_float_set(s: str):
     return float_list
 
 
+def load_float_set(path, chunk_lines=SET_CHUNK_LINES):
+    """
+    Load a set of floats from a file, without a Python object per value:
+    raw little-endian "IEEE 754 binary32" values if its extension is one of
+    RAW_EXTENSIONS, mapped with numpy.memmap, or else text values separated
+    by newlines, commas or spaces, e.g. a CSV column, parsed chunk_lines
+    lines at a time.
+
+    Returns:
+        The sorted array of the distinct values, as float64.
+    """
+    if path.endswith(RAW_EXTENSIONS):
+        return float_set(np.memmap(path, dtype="<f4", mode="r"))
+    chunks = []
+    with open(path) as f:
+        while lines := f.readlines(chunk_lines * 16):  # about 16 bytes per line
+            tokens = "".join(lines).replace(",", " ").split()
+            chunks.append(np.array(tokens, dtype=np.float64))
+    return float_set(np.concatenate(chunks) if chunks else [])
+
+
+def parse_element(s: str):
+    """Parse an element of a set: an int, a float, or else a string, without its quotes."""
+    s = s.strip()
+    for parse in (int, float):
+        try:
+            return parse(s)
+        except ValueError:
+            pass
+    return s.strip("\"'")
+
+
+def parse_element_set(s: str):
+    if s[1:][:-1].strip() == "": # empty set
+        return []
+    return [parse_element(x) for x in s[1:][:-1].split(",")]
+
+
+def load_element_set(path):
+    """
+    Load a set of elements of any type from a file of raw float32 values, as
+    load_float_set, or else of elements separated by newlines or commas.
+    """
+    if path.endswith(RAW_EXTENSIONS):
+        return load_float_set(path)
+    with open(path) as f:
+        return [parse_element(x) for line in f for x in line.split(",") if x.strip()]
+
+
+def parse_set(s: str, elements=False):
+    """
+    Parse a set given on the command line: enclosed in braces, or else the
+    path of a file. Its values are floats, or elements of any type (ints,
+    floats, strings) if elements is True.
+    """
+    if s.lstrip().startswith("{"):
+        return parse_element_set(s) if elements else parse_float_set(s)
+    return load_element_set(s) if elements else load_float_set(s)
+
+
+def float_set(vals):
+    """Return the sorted array of the distinct values of vals, as float64."""
+    return np.unique(np.asarray(vals, dtype=np.float64))
+
+
+def float_bits(xs):
+    """
+    Return the "IEEE 754 binary32" 32 bit representations of the floats in
+    xs, as an array of shape (len(xs), 32) of uint8 in {0, 1}, computed in a
+    single pass over their big-endian bytes.
+    """
+    data = np.asarray(xs, dtype=">f4").reshape(-1, 1)
+    return np.unpackbits(data.view(np.uint8), axis=1)
+
+
 def float_to_bit_list(x: float):
     """
     Convert a Python float into its "IEEE 754 binary32" 32 bit representation,
     returned as a list of 32 ints in {0, 1}.
     """
-    bytes_ = struct.pack('>f', x) # get big-endian binary representation of x
-    decoded_bytes = [b for b in bytes_] # turn bytes into integers
-    binary_bytes = [bin(i)[2:] for i in decoded_bytes] # turn ints into binary strings of max 8 bits
-    padded_bytes = [b.zfill(8) for b in binary_bytes]  # pad with leading 0s if needed
-    bits = ''.join(padded_bytes)
-    return [int(b) for b in bits]
+    bits = int.from_bytes(struct.pack('>f', x), "big")  # big-endian binary representation of x
+    return [(bits >> k) & 1 for k in range(31, -1, -1)]
 
 
-class Logger:
+def floats_to_bit_list(xs):
+    """Concatenate the 32 bit representations of the floats in xs."""
+    return float_bits(xs).ravel().tolist()
+
+
+def pack_bits(bits):
+    """Pack a list of bits into bytes, most significant bit first."""
+    packed = bytearray((len(bits) + 7) // 8)
+    for k, bit in enumerate(bits):
+        if bit:
+            packed[k >> 3] |= 0x80 >> (k & 7)
+    return bytes(packed)
+
 
-    def __init__(self, party, mode, prepend="[-] "):
+def unpack_bits(packed, n):
+    """Unpack the first 'n' bits of a byte sequence built by pack_bits."""
+    return [(packed[k >> 3] >> (7 - (k & 7))) & 1 for k in range(n)]
+
+
+# TRACES
+TRACE_FORMATS = ["text", "binary"]
+TRACE_BUFFER = 1 << 16  # bytes buffered before trace files are written to
+
+
+class Logger:
+    """
+    Print the progress of a party and, in full mode, trace the OTs and the
+    garbled tables to the files of the output folder.
+
+    Traces are formatted lazily, as in the logging module: the arguments of
+    ot and circuit are only turned into text, bytes as hex, when the trace is
+    enabled, and written to buffered files flushed by close. Binary traces
+    hold a sequence of records instead, each being its time (a big-endian
+    double) and its number of frames (a byte), followed by the frames
+    encoding the message and arguments as by encode, each prefixed with its
+    length (a big-endian uint32). read_trace turns them back into text.
+    """
+    def __init__(self, party, mode, prepend="[-] ", partial=False, name=None,
+                 trace_format="text"):
         self.party = party
         self.mode = mode
         self.pre = prepend
+        self.partial = partial  # whether the party only computes part of the result
+        self.binary = trace_format == "binary"
+        self.traces = {}  # buffered file of each enabled trace
+        self.lock = threading.Lock()  # a pipelined Alice garbles in another thread
         if mode == "full":
             if party != "test":
-                with open(f"output/ot_{party}.txt", "w") as f:
-                    f.write("")
+                self._open("ot", f"output/ot_{party}", name)
             if party == "Alice":
-                with open("output/tables.txt", "w") as f:
-                    f.write("")
+                self._open("circuit", "output/tables", name)
+
+    def _open(self, trace, path, name):
+        path += (f".{name}" if name else "") + (".trace" if self.binary else ".txt")
+        if self.binary:
+            self.traces[trace] = open(path, "wb", buffering=TRACE_BUFFER)
+        else:
+            self.traces[trace] = open(path, "w", buffering=TRACE_BUFFER)
 
     def minimal(self, s):
-        if self.mode == "minimal":
+        if self.partial:
+            self.info("Partial result: " + s)
+        elif self.mode == "minimal":
             print(s)
         else:
             self.info("Result: " + s)
@@ -158,12 +688,74 @@ class Logger:
         if self.mode in ["info", "full"]:
             print(self.pre + s)
 
-    def ot(self, s):
-        if self.mode == "full" and self.party != "test":
-            with open(f"output/ot_{self.party}.txt", "a") as f:
-                f.write(s + "\n")
+    def tracing(self, trace):
+        """Return whether the given trace (ot or circuit) is enabled."""
+        return trace in self.traces
 
-    def circuit(self, s):
-        if self.mode == "full":
-            with open("output/tables.txt", "a") as f:
-                f.write(s + "\n")
\ No newline at end of file
+    def ot(self, msg, *args):
+        if "ot" in self.traces:
+            self._trace("ot", msg, args)
+
+    def circuit(self, msg, *args):
+        if "circuit" in self.traces:
+            self._trace("circuit", msg, args)
+
+    def _trace(self, trace, msg, args):
+        with self.lock:
+            f = self.traces[trace]
+            if self.binary:
+                _write_record(f, msg, args)
+            else:
+                f.write((msg % tuple(map(_trace_arg, args)) if args else msg) + "\n")
+
+    def close(self):
+        """Flush and close the trace files."""
+        with self.lock:
+            for f in self.traces.values():
+                f.close()
+            self.traces = {}
+
+
+def _trace_arg(x):
+    """Return the text of an argument of a trace, bytes being written in hex."""
+    if isinstance(x, (bytes, bytearray, memoryview)):
+        return bytes(x).hex()
+    return x
+
+
+def _write_record(f, msg, args):
+    # values that encode does not support, e.g. groups, are traced as text
+    try:
+        frames = encode((msg, args))
+    except RuntimeError:
+        frames = encode((msg, tuple(str(_trace_arg(x)) for x in args)))
+    f.write(struct.pack(">dB", time.time(), len(frames)))
+    for frame in frames:
+        f.write(struct.pack(">I", len(frame)))
+        f.write(frame)
+
+
+def read_trace(path):
+    """Return the list of pairs (time, text) of the records of a binary trace."""
+    records = []
+    with open(path, "rb") as f:
+        while header := f.read(9):
+            t, n = struct.unpack(">dB", header)
+            frames = []
+            for _ in range(n):
+                size, = struct.unpack(">I", f.read(4))
+                frames.append(f.read(size))
+            msg, args = decode(frames)
+            records.append((t, msg % tuple(map(_trace_arg, args)) if args else msg))
+    return records
+
+
+if __name__ == '__main__':
+    import argparse
+
+    parser = argparse.ArgumentParser(description="Print a binary trace as text.")
+    parser.add_argument("trace", help="the trace file, e.g. output/ot_Alice.trace")
+    args = parser.parse_args()
+    for t, text in read_trace(args.trace):
+        stamp = time.strftime("%H:%M:%S", time.localtime(t)) + f"{t % 1:.6f}"[1:]
+        print(f"[{stamp}] {text}")
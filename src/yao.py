@@ -1,9 +1,17 @@
-import pickle
+import collections
+import gc
+import json
+import struct
 import random
 import os
+import tempfile
 import util
+import bristol
+import instrumentation
 import base64
+import numpy as np
 from cryptography.fernet import Fernet
+from cryptography.hazmat.primitives.ciphers import Cipher, algorithms, modes
 
 
 def encrypt(key, data):
@@ -34,60 +42,602 @@ def decrypt(key, data):
     return f.decrypt(data)
 
 
-def evaluate(circuit, g_tables, pbits_out, a_inputs, b_inputs):
-    """Evaluate yao circuit with given inputs.
+class FernetBackend:
+    """Garbling backend encrypting each table row with nested Fernet tokens.
+
+    Keys are base64-encoded 32-byte Fernet keys and each row holds key_out
+    followed by a byte holding encr_bit_out, encrypted once per input key.
+    """
+    name = "fernet"
+    half_gates = False
+
+    def gen_offset(self):
+        """Return a random free-XOR global offset."""
+        return base64.urlsafe_b64encode(os.urandom(32))
+
+    def gen_key(self, pbit):
+        """Return a random key (the p-bit is kept apart from the key)."""
+        return Fernet.generate_key()
+
+    def xor(self, key1, key2):
+        """XOR two keys."""
+        return base64.urlsafe_b64encode(util.xor_bytes(
+            base64.urlsafe_b64decode(key1),
+            base64.urlsafe_b64decode(key2)
+        ))
+
+    def encrypt(self, keys_in, tweak, key_out, encr_bit_out):
+        """Encrypt a table row with the keys of the gate's input wires."""
+        msg = key_out + bytes([encr_bit_out])
+        for key in reversed(keys_in):
+            msg = encrypt(key, msg)
+        return msg
+
+    def decrypt(self, keys_in, tweak, row):
+        """Decrypt a table row, returning the (key, encr_bit) it holds."""
+        for key in keys_in:
+            row = decrypt(key, row)
+        return row[:-1], row[-1]
+
+
+class AESBackend:
+    """Garbling backend based on a fixed-key AES hash.
+
+    Keys are raw 16-byte labels whose least significant bit is the encrypted
+    bit (point-and-permute), the global offset having its last bit set.
+    A row is the output key XORed with H(key, tweak) for each input key,
+    where H(x, t) = AES_K(s(x) ^ t) ^ s(x) for a fixed, public key K and
+    the linear orthomorphism s(x_L || x_R) = (x_L ^ x_R) || x_L on the
+    halves of x (Guo et al., 2020). The orthomorphism makes H circular
+    correlation robust: with H(x, t) = AES_K(x ^ t) ^ x ^ t, the evaluator
+    could unmask AES_K(A ^ R ^ t) from a row and decrypt it, K being
+    public, to get the free-XOR offset R.
+    """
+    name = "aes"
+    half_gates = False
+    KEY_SIZE = 16
+    FIXED_KEY = bytes(range(KEY_SIZE))
+
+    def __init__(self):
+        self.cipher = Cipher(algorithms.AES(self.FIXED_KEY), modes.ECB()).encryptor()
+
+    def gen_offset(self):
+        """Return a random free-XOR global offset, with its last bit set."""
+        offset = bytearray(os.urandom(self.KEY_SIZE))
+        offset[-1] |= 1
+        return bytes(offset)
+
+    def gen_key(self, pbit):
+        """Return a random key whose last bit is the given p-bit."""
+        key = bytearray(os.urandom(self.KEY_SIZE))
+        key[-1] = (key[-1] & 0xfe) | pbit
+        return bytes(key)
+
+    def xor(self, key1, key2):
+        """XOR two keys."""
+        return util.xor_bytes(key1, key2)
+
+    def sigma(self, key):
+        """Apply the orthomorphism s(x_L || x_R) = (x_L ^ x_R) || x_L to a key."""
+        half = self.KEY_SIZE // 2
+        return util.xor_bytes(key[:half], key[half:]) + key[:half]
+
+    def sigma_array(self, keys):
+        """Apply the orthomorphism to an array of keys of shape (..., KEY_SIZE)."""
+        half = self.KEY_SIZE // 2
+        left = keys[..., :half]
+        return np.concatenate((left ^ keys[..., half:], left), axis=-1)
+
+    def hash_each(self, keys, tweaks):
+        """Hash each key with its tweak, returning the list of hashes."""
+        sigmas = b"".join(self.sigma(key) for key in keys)
+        blocks = b"".join(
+            util.xor_bytes(sigmas[k:k + self.KEY_SIZE], tweak.to_bytes(self.KEY_SIZE, "big"))
+            for k, tweak in zip(range(0, len(sigmas), self.KEY_SIZE), tweaks)
+        )
+        pad = util.xor_bytes(self.cipher.update(blocks), sigmas)
+        return [pad[k:k + self.KEY_SIZE] for k in range(0, len(pad), self.KEY_SIZE)]
+
+    def tweaks(self, *tweaks):
+        """Return an array holding each tweak as a block of KEY_SIZE bytes."""
+        return np.frombuffer(b"".join(t.to_bytes(self.KEY_SIZE, "big") for t in tweaks),
+                             np.uint8).reshape(len(tweaks), self.KEY_SIZE)
+
+    def hash_array(self, keys, tweaks):
+        """Hash an array of keys of shape (..., KEY_SIZE) with a single AES call.
+
+        Args:
+            keys: The array of keys.
+            tweaks: An array of tweaks, as returned by the tweaks method,
+                broadcastable to the shape of the keys.
+        """
+        sigmas = self.sigma_array(keys)
+        blocks = sigmas ^ tweaks
+        pad = np.frombuffer(self.cipher.update(blocks.tobytes()), np.uint8)
+        return pad.reshape(blocks.shape) ^ sigmas
+
+    def hash(self, keys, tweak):
+        """Hash each key with its own tweak derived from 'tweak' and XOR the hashes."""
+        out = bytes(self.KEY_SIZE)
+        for pad in self.hash_each(keys, range(tweak, tweak + len(keys))):
+            out = util.xor_bytes(out, pad)
+        return out
+
+    def encrypt(self, keys_in, tweak, key_out, encr_bit_out):
+        """Encrypt a table row with the keys of the gate's input wires."""
+        return util.xor_bytes(key_out, self.hash(keys_in, 2 * tweak))
+
+    def decrypt(self, keys_in, tweak, row):
+        """Decrypt a table row, returning the (key, encr_bit) it holds."""
+        key = util.xor_bytes(row, self.hash(keys_in, 2 * tweak))
+        return key, key[-1] & 1
+
+
+class HalfGatesBackend(AESBackend):
+    """AES backend garbling AND-like gates with the half-gates technique.
+
+    An AND gate is split into a garbler half-gate and an evaluator half-gate,
+    whose tables hold a single ciphertext each, and its output keys are
+    derived from the input keys and the free-XOR offset. OR, NAND and NOR
+    gates are turned into AND gates by inverting their inputs and output,
+    which is free. Other gates keep their full table.
+    The garbler's ciphertext H(A, t) ^ H(A ^ R, t) ^ p_b R gives the
+    evaluator H(A ^ R, t) ^ R when p_b is 1, which is why the hash must be
+    circular correlation robust.
+    """
+    name = "halfgates"
+    half_gates = True
+
+    def garble_half_gate(self, key_a, key_b, offset, tweak):
+        """Garble an AND gate given the keys for bit 0 of its inputs.
+
+        Returns:
+            The key for bit 0 of the output and the gate's table (T_G, T_E).
+        """
+        key_a1, key_b1 = self.xor(key_a, offset), self.xor(key_b, offset)
+        pbit_a, pbit_b = key_a[-1] & 1, key_b[-1] & 1
+        h_a0, h_a1, h_b0, h_b1 = self.hash_each(
+            (key_a, key_a1, key_b, key_b1),
+            (2 * tweak, 2 * tweak, 2 * tweak + 1, 2 * tweak + 1))
+
+        # garbler half-gate: the garbler knows the p-bit of the second input
+        t_g = self.xor(self.xor(h_a0, h_a1), offset if pbit_b else bytes(self.KEY_SIZE))
+        w_g = self.xor(h_a0, t_g) if pbit_a else h_a0
+        # evaluator half-gate: the evaluator knows the encrypted bit of the second input
+        t_e = self.xor(self.xor(h_b0, h_b1), key_a)
+        w_e = self.xor(h_b0, self.xor(t_e, key_a)) if pbit_b else h_b0
+        return self.xor(w_g, w_e), (t_g, t_e)
+
+    def eval_half_gate(self, key_a, key_b, table, tweak):
+        """Evaluate an AND gate, returning the key of its output."""
+        t_g, t_e = table
+        h_a, h_b = self.hash_each((key_a, key_b), (2 * tweak, 2 * tweak + 1))
+        w_g = self.xor(h_a, t_g) if key_a[-1] & 1 else h_a
+        w_e = self.xor(h_b, self.xor(t_e, key_a)) if key_b[-1] & 1 else h_b
+        return self.xor(w_g, w_e)
+
+
+BACKENDS = {backend.name: backend
+            for backend in (FernetBackend, AESBackend, HalfGatesBackend)}
+
+# Logical function of each 2-input gate type, on bits or arrays of bits
+BIT_OPS = {
+    "OR": lambda b1, b2: b1 | b2,
+    "AND": lambda b1, b2: b1 & b2,
+    "XOR": lambda b1, b2: b1 ^ b2,
+    "NOR": lambda b1, b2: 1 ^ (b1 | b2),
+    "NAND": lambda b1, b2: 1 ^ (b1 & b2),
+    "XNOR": lambda b1, b2: 1 ^ (b1 ^ b2),
+}
+
+# Input and output inversions turning each gate into an AND gate,
+# used by the half-gates technique: gate(a, b) = ((a ^ x) and (b ^ y)) ^ z
+HALF_GATES = {
+    "AND": (0, 0, 0),
+    "NAND": (0, 0, 1),
+    "OR": (1, 1, 1),
+    "NOR": (1, 1, 0),
+}
+
+
+def get_backend(backend):
+    """Return a garbling backend instance given its name."""
+    if not isinstance(backend, str):
+        return backend
+    if backend not in BACKENDS:
+        raise RuntimeError(f"Unknown garbling backend {backend}. Possible values: {', '.join(BACKENDS)}.")
+    return BACKENDS[backend]()
+
+
+Gate = collections.namedtuple("Gate", ["id", "type", "inputs", "out", "ins"])
+Gate.__doc__ = """A compiled gate: its ID and type, the IDs of its input wires, and the
+indices of its output and input wires in the compiled circuit."""
+
+
+class CompiledCircuit:
+    """A circuit spec compiled once for garbling and evaluation.
+
+    Wire IDs are mapped to dense indices, so that anything attached to a wire
+    is stored in a flat list, and gates are sorted in topological order.
+    A compiled circuit can be saved to a binary file holding its gates as
+    arrays, which is memory-mapped when loaded back instead of re-parsing and
+    sorting the circuit spec.
 
     Args:
         circuit: A dict containing circuit spec.
+    """
+    MAGIC = b"YAOCIRC"
+    VERSION = 1
+    GATE_TYPES = ["XOR", "AND", "OR", "NOR", "NAND", "XNOR", "NOT"]
+
+    def __init__(self, circuit):
+        self._circuit = circuit
+        self.id = circuit["id"]
+        self.source = None  # what the circuit was compiled from, for caches
+        wires = set()  # set of circuit wires
+        for gate in circuit["gates"]:
+            wires.add(gate["id"])
+            wires.update(gate["in"])
+        for party in ("alice", "bob", "out"):
+            wires.update(circuit.get(party, []))
+
+        self.wires = sorted(wires)  # list mapping each index to its wire ID
+        self.index = {wire: k for k, wire in enumerate(self.wires)}
+        self.alice = [self.index[w] for w in circuit.get("alice", [])]
+        self.bob = [self.index[w] for w in circuit.get("bob", [])]
+        self.out = [self.index[w] for w in circuit["out"]]
+
+        self.gates = [  # list of gates in topological order
+            Gate(gate["id"], gate["type"], tuple(gate["in"]),
+                 self.index[gate["id"]],
+                 tuple(self.index[w] for w in gate["in"]))
+            for gate in self._sort_gates(circuit["gates"])
+        ]
+        self._index_gates()
+
+    def _index_gates(self):
+        outputs = set(gate.out for gate in self.gates)
+        self.inputs = [k for k in range(len(self.wires)) if k not in outputs]  # wires not computed by a gate
+        self.xor_gates = [gate for gate in self.gates if gate.type == "XOR"]
+        self.non_xor_gates = [gate for gate in self.gates if gate.type != "XOR"]
+        self.gate_types = collections.Counter(gate.type for gate in self.gates)
+
+    def _sort_gates(self, gates):
+        """Return the gates sorted so that each gate comes after its inputs."""
+        producers = set(gate["id"] for gate in gates)
+        pending = {}  # number of inputs of each gate not yet computed
+        users = collections.defaultdict(list)  # gates using each wire
+        for gate in gates:
+            deps = [w for w in gate["in"] if w in producers]
+            pending[gate["id"]] = len(deps)
+            for w in deps:
+                users[w].append(gate)
+
+        ready = collections.deque(g for g in gates if pending[g["id"]] == 0)
+        ordered = []
+        while ready:
+            gate = ready.popleft()
+            ordered.append(gate)
+            for user in users[gate["id"]]:
+                pending[user["id"]] -= 1
+                if pending[user["id"]] == 0:
+                    ready.append(user)
+
+        if len(ordered) != len(gates):
+            raise RuntimeError(f"Circuit {self.id} is not acyclic")
+        return ordered
+
+    @property
+    def circuit(self):
+        """The circuit spec, rebuilt from the gates if loaded from a binary file."""
+        if self._circuit is None:
+            self._circuit = {
+                "id": self.id,
+                "alice": [self.wires[w] for w in self.alice],
+                "bob": [self.wires[w] for w in self.bob],
+                "out": [self.wires[w] for w in self.out],
+                "gates": [{"id": gate.id, "type": gate.type, "in": list(gate.inputs)}
+                          for gate in self.gates],
+            }
+        return self._circuit
+
+    def save(self, path, source=None):
+        """Save the compiled circuit to a binary file.
+
+        The file holds a magic string, the version of the format, the length
+        of a JSON header describing the arrays, the header and the arrays,
+        each aligned on 8 bytes. The header also holds 'source', e.g. what a
+        cached circuit was compiled from, restored by load.
+        """
+        gate_ins = np.full((len(self.gates), 2), -1, np.int32)
+        for k, gate in enumerate(self.gates):
+            gate_ins[k, :len(gate.ins)] = gate.ins
+        arrays = {
+            "wires": np.array(self.wires, np.int64),
+            "alice": np.array(self.alice, np.int32),
+            "bob": np.array(self.bob, np.int32),
+            "out": np.array(self.out, np.int32),
+            "gate_types": np.array([self.GATE_TYPES.index(gate.type) for gate in self.gates],
+                                   np.uint8),
+            "gate_outs": np.array([gate.out for gate in self.gates], np.int32),
+            "gate_ins": gate_ins,
+        }
+        header, offset = {"id": self.id, "source": source, "arrays": {}}, 0
+        for name, array in arrays.items():
+            header["arrays"][name] = (array.dtype.str, array.shape, offset)
+            offset += (array.nbytes + 7) // 8 * 8
+        header = json.dumps(header).encode()
+        header += b" " * (-(len(self.MAGIC) + 5 + len(header)) % 8)
+
+        with open(path, "wb") as f:
+            f.write(self.MAGIC + struct.pack(">BI", self.VERSION, len(header)) + header)
+            for array in arrays.values():
+                f.write(array.tobytes())
+                f.write(bytes(-array.nbytes % 8))
+
+    @classmethod
+    def load(cls, path):
+        """Load a compiled circuit from a binary file written by save."""
+        data = np.asarray(np.memmap(path, np.uint8, "r"))  # plain views of the mapped file
+        start = len(cls.MAGIC) + 5
+        version, length = struct.unpack(">BI", data[len(cls.MAGIC):start].tobytes())
+        if data[:len(cls.MAGIC)].tobytes() != cls.MAGIC or version != cls.VERSION:
+            raise RuntimeError(f"{path} is not a compiled circuit of version {cls.VERSION}")
+        header = json.loads(data[start:start + length].tobytes())
+        start += length
+        arrays = {
+            name: data[start + offset:start + offset + np.dtype(dtype).itemsize * int(np.prod(shape))]
+            .view(dtype).reshape(shape)
+            for name, (dtype, shape, offset) in header["arrays"].items()
+        }
+
+        self = cls.__new__(cls)
+        self._circuit = None
+        self.id = header["id"]
+        self.source = header.get("source")
+        self.wires = arrays["wires"].tolist()
+        self.index = {wire: k for k, wire in enumerate(self.wires)}
+        self.alice = arrays["alice"].tolist()
+        self.bob = arrays["bob"].tolist()
+        self.out = arrays["out"].tolist()
+        wires = arrays["wires"]
+        gate_types = [cls.GATE_TYPES[t] for t in arrays["gate_types"].tolist()]
+        gate_ins = arrays["gate_ins"]
+        unary = (gate_ins[:, 1] < 0).tolist()
+        # the gates hold no reference cycles, don't let the garbage collector
+        # scan them over and over while they are created
+        gc_enabled = gc.isenabled()
+        gc.disable()
+        try:
+            self.gates = [
+                Gate(id, type, inputs[:1] if one else inputs, out, ins[:1] if one else ins)
+                for id, type, inputs, out, ins, one in zip(
+                    wires[arrays["gate_outs"]].tolist(), gate_types,
+                    list(map(tuple, wires[np.maximum(gate_ins, 0)].tolist())),
+                    arrays["gate_outs"].tolist(), list(map(tuple, gate_ins.tolist())), unary)
+            ]
+        finally:
+            if gc_enabled:
+                gc.enable()
+        self._index_gates()
+        return self
+
+
+def compile_circuit(circuit):
+    """Return the compiled form of a circuit, compiling it if needed."""
+    if isinstance(circuit, CompiledCircuit):
+        return circuit
+    return CompiledCircuit(circuit)
+
+
+def load_circuit(path, alice_values=1, cache=True):
+    """Load and compile a circuit, from a JSON or a Bristol Fashion file.
+
+    JSON files hold a list of circuits in the format of circuits/eq32.json,
+    of which the first one is loaded; other files are parsed as Bristol
+    Fashion. Unless disabled, the compiled circuit is cached in a binary
+    file next to the source, used as long as the size and modification time
+    of the source and the split of the inputs between Alice and Bob are the
+    ones it was compiled with.
+
+    Args:
+        path: The path of the file.
+        alice_values: Optional; the number of input values given by Alice
+            in a Bristol Fashion circuit, the following ones being Bob's.
+        cache: Optional; whether to use and write the binary cache.
+
+    Returns:
+        The CompiledCircuit.
+    """
+    cache_path = path + ".bin"
+    stat = os.stat(path)
+    source = {"size": stat.st_size, "mtime": stat.st_mtime_ns,
+              "alice_values": None if path.endswith(".json") else alice_values}
+    if cache and os.path.exists(cache_path):
+        try:
+            compiled = CompiledCircuit.load(cache_path)
+            if compiled.source == source:
+                return compiled
+        except RuntimeError:  # written by another version, compile it again
+            pass
+
+    if path.endswith(".json"):
+        circuit = util.parse_json(path)["circuits"][0]
+    else:
+        circuit = bristol.parse_bristol(path, alice_values)
+    compiled = CompiledCircuit(circuit)
+    if cache:
+        tmp = None
+        try:
+            # a file of its own, several workers may compile the circuit at once
+            fd, tmp = tempfile.mkstemp(dir=os.path.dirname(cache_path) or ".", suffix=".tmp")
+            os.close(fd)
+            compiled.save(tmp, source)
+            os.replace(tmp, cache_path)
+        except OSError:  # read-only location, keep going without cache
+            if tmp is not None and os.path.exists(tmp):
+                os.remove(tmp)
+    return compiled
+
+
+def table_layout(circuit, backend):
+    """Return where the garbled table of each gate is in a contiguous buffer.
+
+    Tables are laid out gate after gate in topological order. Only backends
+    with fixed-size keys (aes, halfgates) have a contiguous layout.
+
+    Args:
+        circuit: A CompiledCircuit.
+        backend: The garbling backend of the circuit.
+
+    Returns:
+        A list of (gate, offset, size) for each non-XOR gate, and the total size.
+    """
+    layout, offset = [], 0
+    for gate in circuit.non_xor_gates:
+        if backend.half_gates and gate.type in HALF_GATES:
+            size = 2 * backend.KEY_SIZE  # T_G and T_E
+        else:
+            size = (2 ** len(gate.ins)) * backend.KEY_SIZE  # one row per encrypted bits
+        layout.append((gate, offset, size))
+        offset += size
+    return layout, offset
+
+
+def unpack_tables(circuit, buffer, backend="halfgates"):
+    """Turn a contiguous buffer of garbled tables into a dict of garbled tables.
+
+    Args:
+        circuit: A CompiledCircuit, or a dict containing circuit spec.
+        buffer: The garbled tables laid out as given by table_layout.
+        backend: Optional; the garbling backend of the circuit.
+
+    Returns:
+        A dict mapping each gate to its garbled table, as expected by evaluate.
+    """
+    backend = get_backend(backend)
+    buffer = bytes(buffer)
+    n = backend.KEY_SIZE
+    tables = {}
+    for gate, offset, size in table_layout(compile_circuit(circuit), backend)[0]:
+        rows = [buffer[k:k + n] for k in range(offset, offset + size, n)]
+        if backend.half_gates and gate.type in HALF_GATES:
+            tables[gate.id] = tuple(rows)
+        elif len(gate.ins) < 2:
+            tables[gate.id] = {(0, ): rows[0], (1, ): rows[1]}
+        else:
+            tables[gate.id] = {(r >> 1, r & 1): row for r, row in enumerate(rows)}
+    return tables
+
+
+def pack_tables(circuit, tables, backend="halfgates"):
+    """Turn a dict of garbled tables into a contiguous buffer, the inverse of unpack_tables.
+
+    Args:
+        circuit: A CompiledCircuit, or a dict containing circuit spec.
+        tables: A dict mapping each gate to its garbled table.
+        backend: Optional; the garbling backend of the circuit.
+
+    Returns:
+        The garbled tables laid out as given by table_layout, as bytes.
+    """
+    backend = get_backend(backend)
+    rows = []
+    for gate, _, _ in table_layout(compile_circuit(circuit), backend)[0]:
+        table = tables[gate.id]
+        if backend.half_gates and gate.type in HALF_GATES:
+            rows.extend(table)
+        elif len(gate.ins) < 2:
+            rows.extend((table[(0, )], table[(1, )]))
+        else:
+            rows.extend(table[(r >> 1, r & 1)] for r in range(4))
+    return b"".join(rows)
+
+
+def unpack_inputs(wires, keys):
+    """Turn an array of keys of a backend with fixed-size keys into a dict of inputs.
+
+    Args:
+        wires: The IDs of the input wires.
+        keys: A (len(wires), KEY_SIZE) array holding the key of each wire.
+
+    Returns:
+        A dict mapping each wire to its (key, encr_bit) input, the encrypted
+        bit being the last bit of the key.
+    """
+    return {w: (key.tobytes(), int(key[-1] & 1)) for w, key in zip(wires, keys)}
+
+
+def evaluate(circuit, g_tables, pbits_out, a_inputs, b_inputs, backend="fernet",
+             metrics=None):
+    """Evaluate yao circuit with given inputs.
+
+    Args:
+        circuit: A CompiledCircuit, or a dict containing circuit spec.
         g_tables: The yao circuit garbled tables.
         pbits_out: The pbits of outputs.
         a_inputs: A dict mapping Alice's wires to (key, encr_bit) inputs.
         b_inputs: A dict mapping Bob's wires to (key, encr_bit) inputs.
+        backend: Optional; the garbling backend the circuit was garbled with.
+        metrics: Optional; the instrumentation.Metrics recording the evaluation.
 
     Returns:
         A dict mapping output wires with their result bit.
     """
-    gates = circuit["gates"]  # dict containing circuit gates
-    wire_outputs = circuit["out"]  # list of output wires
-    wire_inputs = {}  # dict containing Alice and Bob inputs
+    backend = get_backend(backend)
+    circuit = compile_circuit(circuit)
+    metrics = metrics or instrumentation.NO_METRICS
+    with metrics.phase("evaluate"):
+        evaluation = _evaluate(circuit, g_tables, pbits_out, a_inputs, b_inputs, backend)
+    metrics.count("circuits_evaluated")
+    instrumentation.count_gates(metrics, "gates_evaluated", circuit)
+    return evaluation
+
+
+def _evaluate(circuit, g_tables, pbits_out, a_inputs, b_inputs, backend):
+    index = circuit.index
+    wire_inputs = [None] * len(circuit.wires)  # (key, encr_bit) of each wire
     evaluation = {}  # dict containing result of evaluation
 
-    wire_inputs.update(a_inputs)
-    wire_inputs.update(b_inputs)
+    for w, value in a_inputs.items():
+        wire_inputs[index[w]] = value
+    for w, value in b_inputs.items():
+        wire_inputs[index[w]] = value
 
-    # Iterate over all gates
-    for gate in sorted(gates, key=lambda g: g["id"]):
-        gate_id, gate_in, msg = gate["id"], gate["in"], None
+    # Iterate over all gates, in topological order
+    for gate in circuit.gates:
+        gate_id, gate_in = gate.id, gate.ins
         # XOR gate: don't use the tables but compute res_bit and res_key using the free-XOR formula 
-        if gate["type"] == "XOR":
+        if gate.type == "XOR":
             key_a, encr_bit_a = wire_inputs[gate_in[0]]
             key_b, encr_bit_b = wire_inputs[gate_in[1]]
-            res_key = base64.urlsafe_b64encode(util.xor_bytes(
-                base64.urlsafe_b64decode(key_a), 
-                base64.urlsafe_b64decode(key_b)
-            ))  
+            res_key = backend.xor(key_a, key_b)
             res_bit = encr_bit_a ^ encr_bit_b
-            wire_inputs[gate_id] = (res_key, res_bit)
-            msg = None
+            wire_inputs[gate.out] = (res_key, res_bit)
+        # AND-like gate garbled with half-gates: derive the output key from the two ciphertexts
+        elif backend.half_gates and gate.type in HALF_GATES:
+            key_a, _ = wire_inputs[gate_in[0]]
+            key_b, _ = wire_inputs[gate_in[1]]
+            res_key = backend.eval_half_gate(key_a, key_b, g_tables[gate_id], gate_id)
+            wire_inputs[gate.out] = (res_key, res_key[-1] & 1)
         # NOT gate has only one input
-        elif (len(gate_in) < 2) and (gate_in[0] in wire_inputs):
+        elif len(gate_in) < 2:
             # Fetch input key associated with the gate's input wire
             key_in, encr_bit_in = wire_inputs[gate_in[0]]
             # Fetch the encrypted message in the gate's garbled table
             encr_msg = g_tables[gate_id][(encr_bit_in, )]
             # Decrypt message
-            msg = decrypt(key_in, encr_msg)
-        elif (gate_in[0] in wire_inputs) and (gate_in[1] in wire_inputs):
+            wire_inputs[gate.out] = backend.decrypt((key_in, ), gate_id, encr_msg)
+        else:
             key_a, encr_bit_a = wire_inputs[gate_in[0]]
             key_b, encr_bit_b = wire_inputs[gate_in[1]]
             encr_msg = g_tables[gate_id][(encr_bit_a, encr_bit_b)]
-            msg = decrypt(key_b, decrypt(key_a, encr_msg))
-        if msg:
-            wire_inputs[gate_id] = pickle.loads(msg)
+            wire_inputs[gate.out] = backend.decrypt((key_a, key_b), gate_id, encr_msg)
 
     # After all gates have been evaluated, we populate the dict of results
-    for out in wire_outputs:
-        evaluation[out] = wire_inputs[out][1] ^ pbits_out[out]
+    for out in circuit.out:
+        wire = circuit.wires[out]
+        evaluation[wire] = wire_inputs[out][1] ^ pbits_out[wire]
     return evaluation
 
 
@@ -95,16 +645,23 @@ class GarbledGate:
     """A representation of a garbled gate.
 
     Args:
-        gate: A dict containing gate spec.
-        keys: A dict mapping each wire to a pair of keys.
-        pbits: A dict mapping each wire to its p-bit.
+        gate: A compiled Gate.
+        keys: A list mapping each wire index to a pair of keys.
+        pbits: A list mapping each wire index to its p-bit.
+        backend: Optional; the garbling backend used to encrypt the table.
+        encrypt: Optional; whether to encrypt the table, False to only
+            build its clear representation, e.g. to print it.
     """
-    def __init__(self, gate, keys, pbits):
-        self.keys = keys  # dict of yao circuit keys
-        self.pbits = pbits  # dict of p-bits
-        self.input = gate["in"]  # list of inputs'ID
-        self.output = gate["id"]  # ID of output
-        self.gate_type = gate["type"]  # Gate type: OR, AND, ...
+    def __init__(self, gate, keys, pbits, backend=None, encrypt=True):
+        self.backend = backend or FernetBackend()
+        self.keys = keys  # list of yao circuit keys
+        self.pbits = pbits  # list of p-bits
+        self.input = gate.ins  # list of inputs' index
+        self.output = gate.out  # index of output
+        self.gate_id = gate.id  # ID of the gate and its output wire
+        self.wire_ids = gate.inputs + (gate.id, )  # IDs of inputs and output
+        self.gate_type = gate.type  # Gate type: OR, AND, ...
+        self.encrypt = encrypt
         self.garbled_table = {}  # The garbled table of the gate
         # A clear representation of the garbled table for debugging purposes
         self.clear_garbled_table = {}
@@ -122,6 +679,9 @@ class GarbledGate:
         # NOT gate is a special case since it has only one input
         if (self.gate_type == "NOT"):
             self._gen_garbled_table_not()
+        # AND-like gates are garbled with half-gates when the backend supports it
+        elif self.encrypt and self.backend.half_gates and self.gate_type in HALF_GATES:
+            self._gen_half_gate(*HALF_GATES[self.gate_type])
         # do not generate the table if it is a XOR gate
         elif self.gate_type != "XOR":
             operator = switch[self.gate_type]
@@ -130,6 +690,7 @@ class GarbledGate:
     def _gen_garbled_table_not(self):
         """Create the garbled table of a NOT gate."""
         inp, out = self.input[0], self.output
+        inp_id, out_id = self.wire_ids
 
         # For each entry in the garbled table
         for encr_bit_in in (0, 1):
@@ -143,13 +704,14 @@ class GarbledGate:
             key_in = self.keys[inp][bit_in]
             key_out = self.keys[out][bit_out]
 
-            # Serialize the output key along with the encrypted bit
-            msg = pickle.dumps((key_out, encr_bit_out))
-            # Encrypt message and add it to the garbled table
-            self.garbled_table[(encr_bit_in, )] = encrypt(key_in, msg)
+            # Encrypt the output key along with the encrypted bit
+            # and add it to the garbled table
+            if self.encrypt:
+                self.garbled_table[(encr_bit_in, )] = self.backend.encrypt(
+                    (key_in, ), self.gate_id, key_out, encr_bit_out)
             # Add to the clear table indexes of each keys
-            self.clear_garbled_table[(encr_bit_in, )] = [(inp, bit_in),
-                                                         (out, bit_out),
+            self.clear_garbled_table[(encr_bit_in, )] = [(inp_id, bit_in),
+                                                         (out_id, bit_out),
                                                          encr_bit_out]
 
     def _gen_garbled_table(self, operator):
@@ -159,6 +721,7 @@ class GarbledGate:
             operator: The logical function of to the 2-input gate type.
         """
         in_a, in_b, out = self.input[0], self.input[1], self.output
+        in_a_id, in_b_id, out_id = self.wire_ids
 
         # Same model as for the NOT gate except for 2 inputs instead of 1
         for encr_bit_a in (0, 1):
@@ -171,16 +734,36 @@ class GarbledGate:
                 key_b = self.keys[in_b][bit_b]
                 key_out = self.keys[out][bit_out]
 
-                msg = pickle.dumps((key_out, encr_bit_out))
-                self.garbled_table[(encr_bit_a, encr_bit_b)] = encrypt(
-                    key_a, encrypt(key_b, msg))
+                if self.encrypt:
+                    self.garbled_table[(encr_bit_a, encr_bit_b)] = self.backend.encrypt(
+                        (key_a, key_b), self.gate_id, key_out, encr_bit_out)
                 self.clear_garbled_table[(encr_bit_a, encr_bit_b)] = [
-                    (in_a, bit_a), (in_b, bit_b), (out, bit_out), encr_bit_out
+                    (in_a_id, bit_a), (in_b_id, bit_b), (out_id, bit_out),
+                    encr_bit_out
                 ]
 
+    def _gen_half_gate(self, inv_a, inv_b, inv_out):
+        """Create the two-ciphertext table of an AND-like gate.
+
+        The keys and p-bit of the output wire are derived from the ones of
+        the input wires, and added to the keys and p-bits of the circuit.
+
+        Args:
+            inv_a: Whether the first input is inverted.
+            inv_b: Whether the second input is inverted.
+            inv_out: Whether the output is inverted.
+        """
+        in_a, in_b, out = self.input[0], self.input[1], self.output
+        offset = self.backend.xor(*self.keys[in_a])
+        key_out, self.garbled_table = self.backend.garble_half_gate(
+            self.keys[in_a][inv_a], self.keys[in_b][inv_b], offset, self.gate_id)
+        keys_out = (key_out, self.backend.xor(key_out, offset))
+        self.keys[out] = (keys_out[inv_out], keys_out[1 - inv_out])
+        self.pbits[out] = self.keys[out][0][-1] & 1
+
     def print_garbled_table(self):
         """Print a clear representation of the garbled table."""
-        print(f"GATE: {self.output}, TYPE: {self.gate_type}")
+        print(f"GATE: {self.gate_id}, TYPE: {self.gate_type}")
         for k, v in self.clear_garbled_table.items():
             # If it's a 2-input gate
             if len(k) > 1:
@@ -203,7 +786,7 @@ class GarbledGate:
 
     def __str__(self):
         out = ""
-        out += f"GATE: {self.output}, TYPE: {self.gate_type}\n"
+        out += f"GATE: {self.gate_id}, TYPE: {self.gate_type}\n"
         for k, v in self.clear_garbled_table.items():
             # If it's a 2-input gate
             if len(k) > 1:
@@ -222,112 +805,80 @@ class GarbledCircuit:
     """A representation of a garbled circuit.
 
     Args:
-        circuit: A dict containing circuit spec.
+        circuit: A CompiledCircuit, or a dict containing circuit spec.
         pbits: Optional; a dict of p-bits for the given circuit.
+        backend: Optional; the name of the garbling backend to use.
+        metrics: Optional; the instrumentation.Metrics recording the garbling.
     """
-    def __init__(self, circuit, pbits={}):
-        self.R = base64.urlsafe_b64encode(os.urandom(32))
-        self.circuit = circuit
-        self.gates = circuit["gates"]  # list of gates
-        self.wires = set()  # list of circuit wires
-
-        self.pbits = {}  # dict of p-bits
-        self.keys = {}  # dict of keys
+    def __init__(self, circuit, pbits={}, backend="fernet", metrics=None):
+        self.backend = get_backend(backend)
+        self.R = self.backend.gen_offset()
+        self.circuit = compile_circuit(circuit)
+        self.gates = self.circuit.gates  # list of gates, in topological order
+        self.wires = range(len(self.circuit.wires))  # list of circuit wire indices
+
+        self.pbits = [None] * len(self.wires)  # p-bit of each wire
+        self.keys = [None] * len(self.wires)  # pair of keys of each wire
         self.garbled_tables = {}  # dict of garbled tables
 
-        # Retrieve all wire IDs from the circuit
-        for gate in self.gates:
-            self.wires.add(gate["id"])
-            self.wires.update(set(gate["in"]))
-        self.wires = list(self.wires)
-
-        self._gen_pbits(pbits)
-        self._gen_keys()
-        self._gen_garbled_tables()
-
-    def _gen_pbits(self, pbits):
-        """Create a dict mapping each wire to a p-bit according to the free-XOR technique."""
-        xor_gates = [gate for gate in self.gates if gate["type"] == "XOR"]
-        non_xor_gates = [gate for gate in self.gates if gate not in xor_gates]
-
-        xor_output_wires = list(set([gate["id"] for gate in xor_gates]))
-
-        for wire in self.wires:
-            if wire not in xor_output_wires:
-                self.pbits[wire] = random.randint(0, 1)
-
-        gates_remaining = xor_gates
-        wires_remaining = xor_output_wires
-        while len(wires_remaining) > 0:
-            for gate in gates_remaining:
-                if gate["id"] not in wires_remaining:
-                    gates_remaining.remove(gate)
-                elif gate["id"] in wires_remaining and gate["in"][0] in self.pbits and gate["in"][1] in self.pbits:
-                    self.pbits[gate["id"]] = self.pbits[gate["in"][0]] ^ self.pbits[gate["in"][1]]
-                    wires_remaining.remove(gate["id"])
-                    gates_remaining.remove(gate)
-
-    def _gen_keys(self):
-        """Create pair of keys for each wire according to the free-XOR technique."""
-
-        xor_gates = [gate for gate in self.gates if gate["type"] == "XOR"]
-        non_xor_gates = [gate for gate in self.gates if gate not in xor_gates]
-
-        xor_output_wires = list(set([gate["id"] for gate in xor_gates]))
-
-        for wire in self.wires:
-            if wire not in xor_output_wires:
-                k0 = Fernet.generate_key()
-                k1 = base64.urlsafe_b64encode(util.xor_bytes(base64.urlsafe_b64decode(k0), self.R))  
-                self.keys[wire] = (k0, k1)
+        metrics = metrics or instrumentation.NO_METRICS
+        with metrics.phase("garble"):
+            self._gen_garbled_circuit()
+        metrics.count("circuits_garbled")
+        instrumentation.count_gates(metrics, "gates_garbled", self.circuit)
 
+    def _gen_wire(self, wire):
+        """Create a random p-bit and pair of keys for a wire."""
+        self.pbits[wire] = random.randint(0, 1)
+        k0 = self.backend.gen_key(self.pbits[wire])
+        self.keys[wire] = (k0, self.backend.xor(k0, self.R))
+
+    def _gen_garbled_circuit(self):
+        """Create p-bits, keys and garbled tables in a single topological pass.
+
+        Following the free-XOR technique, the p-bit and keys of the output of a
+        XOR gate are derived from its inputs, which come first in topological
+        order; the keys of the output of an AND-like gate are derived as well
+        when using half-gates. Any other wire gets a random p-bit and keys.
         """
-        A wire $w$ might be the output of a XOR gate and also one of the inputs of another XOR gate 
-        however, the gates appear not necessarily in the correct order in the list of gates,
-        so we may need to iterate over the gates more than one time to make sure keys are assigned to each wire correctly
-        """
-        gates_remaining = xor_gates
-        wires_remaining = xor_output_wires
-        while len(wires_remaining) > 0:
-            for gate in gates_remaining:
-                if gate["id"] not in wires_remaining:
-                    gates_remaining.remove(gate)
-                elif gate["id"] in wires_remaining and gate["in"][0] in self.keys and gate["in"][1] in self.keys:
-                    k0 = base64.urlsafe_b64encode(util.xor_bytes(
-                            base64.urlsafe_b64decode(self.keys[gate["in"][0]][0]), 
-                            base64.urlsafe_b64decode(self.keys[gate["in"][1]][0])))
-                    k1 = base64.urlsafe_b64encode(util.xor_bytes(base64.urlsafe_b64decode(k0), self.R))
-                    self.keys[gate["id"]] = (k0, k1)
-                    wires_remaining.remove(gate["id"])
-                    gates_remaining.remove(gate)
-
-    def _gen_garbled_tables(self):
-        """Create the garbled table of each gate."""
+        for wire in self.circuit.inputs:
+            self._gen_wire(wire)
+
         for gate in self.gates:
-            garbled_gate = GarbledGate(gate, self.keys, self.pbits)
-            self.garbled_tables[gate["id"]] = garbled_gate.get_garbled_table()
+            if gate.type == "XOR":
+                in_a, in_b = gate.ins
+                k0 = self.backend.xor(self.keys[in_a][0], self.keys[in_b][0])
+                self.keys[gate.out] = (k0, self.backend.xor(k0, self.R))
+                self.pbits[gate.out] = self.pbits[in_a] ^ self.pbits[in_b]
+                continue
+            if not (self.backend.half_gates and gate.type in HALF_GATES):
+                self._gen_wire(gate.out)
+            garbled_gate = GarbledGate(gate, self.keys, self.pbits, self.backend)
+            self.garbled_tables[gate.id] = garbled_gate.get_garbled_table()
 
     def print_garbled_tables(self):
         """Print p-bits and a clear representation of all garbled tables."""
-        print(f"======== {self.circuit['id']} ========")
-        print(f"P-BITS: {self.pbits}")
+        print(f"======== {self.circuit.id} ========")
+        print(f"P-BITS: {self.get_pbits()}")
         for gate in self.gates:
-            garbled_table = GarbledGate(gate, self.keys, self.pbits)
+            garbled_table = GarbledGate(gate, self.keys, self.pbits, self.backend,
+                                        encrypt=False)
             garbled_table.print_garbled_table()
         print()
 
     def __str__(self):
         out = "\n"
-        out += "="*50 + f" {self.circuit['id']} " + "="*50 + "\n"
-        out += f"P-BITS: {self.pbits}\n"
+        out += "="*50 + f" {self.circuit.id} " + "="*50 + "\n"
+        out += f"P-BITS: {self.get_pbits()}\n"
         for gate in self.gates:
-            garbled_table = GarbledGate(gate, self.keys, self.pbits)
+            garbled_table = GarbledGate(gate, self.keys, self.pbits, self.backend,
+                                        encrypt=False)
             out += str(garbled_table)
         return out
 
     def get_pbits(self):
         """Return dict mapping each wire to its p-bit."""
-        return self.pbits
+        return dict(zip(self.circuit.wires, self.pbits))
 
     def get_garbled_tables(self):
         """Return dict mapping each gate to its garbled table."""
@@ -335,4 +886,141 @@ class GarbledCircuit:
 
     def get_keys(self):
         """Return dict mapping each wire to its pair of keys."""
-        return self.keys
+        return dict(zip(self.circuit.wires, self.keys))
+
+
+class GarbledCircuitBatch:
+    """A batch of copies of a circuit, each garbled with its own randomness.
+
+    The copies are garbled together with NumPy: keys are held in a
+    (size, wires, KEY_SIZE) array and each gate is garbled for every copy at
+    once, hashing the keys of all copies with a single AES call. The garbled
+    tables of each copy are laid out contiguously as given by table_layout,
+    in a (size, table_size) array.
+
+    Args:
+        circuit: A CompiledCircuit, or a dict containing circuit spec.
+        size: The number of copies to garble.
+        backend: Optional; the name of the garbling backend to use, aes or halfgates.
+        metrics: Optional; the instrumentation.Metrics recording the garbling.
+    """
+    def __init__(self, circuit, size, backend="halfgates", metrics=None):
+        self.backend = get_backend(backend)
+        if not isinstance(self.backend, AESBackend):
+            raise RuntimeError(f"Backend {self.backend.name} does not support batch garbling")
+        self.circuit = compile_circuit(circuit)
+        self.size = size
+        n = self.backend.KEY_SIZE
+
+        self.R = self._random((size, n))  # free-XOR offset of each copy
+        self.R[:, -1] |= 1
+        # key for bit 0 of each wire of each copy, the last bit being the p-bit
+        self.keys = self._random((size, len(self.circuit.wires), n))
+        self.layout, table_size = table_layout(self.circuit, self.backend)
+        self.garbled_tables = np.empty((size, table_size), np.uint8)
+
+        metrics = metrics or instrumentation.NO_METRICS
+        with metrics.phase("garble"):
+            self._gen_garbled_circuits()
+        metrics.count("circuits_garbled", size)
+        instrumentation.count_gates(metrics, "gates_garbled", self.circuit, size)
+        self.pbits = self.keys[:, :, -1] & 1  # p-bit of each wire of each copy
+
+    @staticmethod
+    def _random(shape):
+        """Return an array of random bytes of the given shape."""
+        return np.frombuffer(os.urandom(int(np.prod(shape))), np.uint8).reshape(shape).copy()
+
+    def _select(self, keys, bits):
+        """Return the keys for the given bits, from the keys for bit 0."""
+        return keys ^ (bits[..., None] * self.R)
+
+    def _gen_garbled_circuits(self):
+        """Create keys and garbled tables of all copies, gate after gate.
+
+        Keys of wires that are not derived from the free-XOR technique or
+        half-gates keep the random value they were initialized with.
+        """
+        keys, tables = self.keys, self.garbled_tables
+        layout = {gate.id: (offset, size) for gate, offset, size in self.layout}
+
+        for gate in self.circuit.gates:
+            if gate.type == "XOR":
+                keys[:, gate.out] = keys[:, gate.ins[0]] ^ keys[:, gate.ins[1]]
+                continue
+            offset, size = layout[gate.id]
+            if self.backend.half_gates and gate.type in HALF_GATES:
+                table = self._gen_half_gates(gate, *HALF_GATES[gate.type])
+            elif len(gate.ins) < 2:
+                table = self._gen_garbled_tables_not(gate)
+            else:
+                table = self._gen_garbled_tables(gate, BIT_OPS[gate.type])
+            tables[:, offset:offset + size] = table.reshape(self.size, size)
+
+    def _gen_garbled_tables_not(self, gate):
+        """Create the garbled table of a NOT gate for all copies."""
+        inp, out = self.keys[:, gate.ins[0]], self.keys[:, gate.out]
+        encr_bits = np.array([0, 1], np.uint8)[:, None]
+        bits_in = encr_bits ^ (inp[:, -1] & 1)
+        pads = self.backend.hash_array(self._select(inp, bits_in),
+                                       self.backend.tweaks(2 * gate.id))
+        rows = self._select(out, 1 ^ bits_in) ^ pads
+        return rows.transpose(1, 0, 2)
+
+    def _gen_garbled_tables(self, gate, operator):
+        """Create the 4-row garbled table of a 2-input gate for all copies."""
+        in_a, in_b = self.keys[:, gate.ins[0]], self.keys[:, gate.ins[1]]
+        out = self.keys[:, gate.out]
+        encr_bits_a = np.array([0, 0, 1, 1], np.uint8)[:, None]
+        encr_bits_b = np.array([0, 1, 0, 1], np.uint8)[:, None]
+        bits_a = encr_bits_a ^ (in_a[:, -1] & 1)
+        bits_b = encr_bits_b ^ (in_b[:, -1] & 1)
+        tweaks = self.backend.tweaks(2 * gate.id, 2 * gate.id + 1)[:, None, None]
+        pads = self.backend.hash_array(
+            np.stack((self._select(in_a, bits_a), self._select(in_b, bits_b))), tweaks)
+        rows = self._select(out, operator(bits_a, bits_b)) ^ pads[0] ^ pads[1]
+        return rows.transpose(1, 0, 2)
+
+    def _gen_half_gates(self, gate, inv_a, inv_b, inv_out):
+        """Create the tables of an AND-like gate for all copies with half-gates.
+
+        The keys of the output wire are derived from the ones of the inputs.
+        """
+        key_a = self.keys[:, gate.ins[0]] ^ (inv_a * self.R)
+        key_b = self.keys[:, gate.ins[1]] ^ (inv_b * self.R)
+        pbit_a, pbit_b = key_a[:, -1:] & 1, key_b[:, -1:] & 1
+        tweaks = self.backend.tweaks(2 * gate.id, 2 * gate.id + 1)[:, None, None]
+        h = self.backend.hash_array(np.stack((
+            np.stack((key_a, key_a ^ self.R)),
+            np.stack((key_b, key_b ^ self.R)),
+        )), tweaks)
+        (h_a0, h_a1), (h_b0, h_b1) = h
+
+        # garbler half-gate and evaluator half-gate
+        t_g = h_a0 ^ h_a1 ^ (pbit_b * self.R)
+        w_g = h_a0 ^ (pbit_a * t_g)
+        t_e = h_b0 ^ h_b1 ^ key_a
+        w_e = h_b0 ^ (pbit_b * (t_e ^ key_a))
+        self.keys[:, gate.out] = w_g ^ w_e ^ (inv_out * self.R)
+        return np.stack((t_g, t_e), axis=1)
+
+    def __str__(self):
+        out = "\n"
+        out += "="*50 + f" {self.circuit.id} x {self.size} " + "="*50 + "\n"
+        for k in range(self.size):
+            out += f"P-BITS {k}: {self.get_pbits(k)}\n"
+        return out
+
+    def get_pbits(self, k):
+        """Return dict mapping each wire of the k-th copy to its p-bit."""
+        return dict(zip(self.circuit.wires, self.pbits[k].tolist()))
+
+    def get_garbled_tables(self, k):
+        """Return dict mapping each gate of the k-th copy to its garbled table."""
+        return unpack_tables(self.circuit, self.garbled_tables[k], self.backend)
+
+    def get_keys(self, k):
+        """Return dict mapping each wire of the k-th copy to its pair of keys."""
+        keys0, keys1 = self.keys[k], self.keys[k] ^ self.R[k]
+        return {wire: (keys0[w].tobytes(), keys1[w].tobytes())
+                for w, wire in enumerate(self.circuit.wires)}